@@ -15,55 +15,97 @@ path = "/home/exacloud/lustre1/fnl_lab/projects/INFANT/GEN_INFANT/masking_test"
 
 import argparse
 import os
-from glob import glob
 import random
 
 # external libs
 import nipype.pipeline.engine as pe
-from nipype.interfaces import ants, utility, fsl
+from nipype import config
+from nipype.interfaces import utility, fsl
+
+from compress import Compress
+from ledger import LedgerRecord, fingerprint, pending
+from manifest import scan, pairs, shard, parse_shard
+from preflight import check, report_name, write_report
+from preprocess import PreprocessPair, first_image
+from resources import max_voxels, threads_per_task, registration_resources, warp_resources, plugin_args
+from template_store import uncompressed, uncompressed_all, DEFAULT_STORE_DIR
+from transform_cache import CachedRegistration, DEFAULT_CACHE_DIR
+from warp import ApplyTransformsNative
 
 
 def main():
     parser = generate_parser()
     args = parser.parse_args()
+    # duration and peak memory of every node, what costmodel.py is fitted on
+    config.enable_resource_monitor()
     path = args.path
     njobs = args.njobs
+    cache_dir = args.cachedir
+    store_dir = args.storedir
+    output_type = args.intermediate_type
 
     atlas = ['/home/groups/brainmri/infant/NIH_ATLASES/nihpd_asym_00-02_t1w.nii.gz',
                    '/home/exacloud/lustre1/fnl_lab/projects/INFANT/GEN_INFANT/masking_test/temp_nih_T2w_atl_float.nii.gz']
     atlas_brain = '/home/exacloud/lustre1/fnl_lab/projects/INFANT/GEN_INFANT/masking_test/temp_nih_T2w_atl_brain_float.nii.gz'
+    # every registration reads the atlases, inflate them once
+    atlas = uncompressed_all(atlas, store_dir)
+    atlas_brain = uncompressed(atlas_brain, store_dir)
 
     randint = '_twochannel'
     warped_dir = os.path.join('./nr_masking_dir', 'warped{}'.format(randint))
 
-    #create list of T1w and T2w images for each subject
-    pattern = os.path.join(path, '*/T1w_acpc_dc.nii.gz')
-    t1w_list = glob(pattern)
-
-    pattern = os.path.join(path, '*/T2w_acpc_dc.nii.gz')
-    t2w_list = glob(pattern)
-
-    #t1w_t2w_list = zip(t1w_list, t2w_list)
-    #t1w_t2w_list = list(t1w_t2w_list)
-
-    t1w_t2w_tuple = zip(t1w_list, t2w_list)
-    t1w_t2w_tuple = list(t1w_t2w_tuple)
-    t1w_t2w_list = [list(i) for i in t1w_t2w_tuple]
-
-    register(warped_dir, atlas, atlas_brain, t1w_t2w_list, t2w_list, n_jobs=njobs)
+    #T1w and T2w of each subject from the manifest of path, only directories changed since the last scan are listed
+    subjects = pairs(scan(path, args.manifest), ['T1w_acpc_dc', 'T2w_acpc_dc'])
+    if args.shard:
+        subjects = shard(subjects, *parse_shard(args.shard))
+
+    #drop subjects whose headers would only fail hours into SyN, voxel counts are kept for cost estimates
+    subjects, report = check(subjects)
+    write_report(report, os.path.join(warped_dir, report_name(args.shard)))
+    subject_ids = [subject for subject, _, _ in subjects]
+    t1w_t2w_list = [images for _, _, images in subjects]
+    t2w_list = [t2w for _, t2w in t1w_t2w_list]
+
+    #subjects finished by an earlier run are dropped before the graph is built
+    ledger_file = args.ledger or os.path.join(warped_dir, 'ledger.jsonl')
+    fingerprints = [fingerprint(t1w_t2w + atlas + [atlas_brain], stage='Brown_nl_masking')
+                    for t1w_t2w in t1w_t2w_list]
+    todo = pending(ledger_file, 'Brown_nl_masking', subject_ids, fingerprints)
+    print('%d of %d subjects done, %d to run' % (len(subject_ids) - len(todo), len(subject_ids), len(todo)))
+    if not todo:
+        return
+
+    register(warped_dir, atlas, atlas_brain, [t1w_t2w_list[i] for i in todo], [t2w_list[i] for i in todo],
+             n_jobs=njobs, cache_dir=cache_dir, output_type=output_type, ledger_file=ledger_file,
+             subject_ids=[subject_ids[i] for i in todo], fingerprints=[fingerprints[i] for i in todo])
 
 def generate_parser():
     parser = argparse.ArgumentParser(description='non-linear registration from Brown')
     parser.add_argument('path', help='path to images')
     parser.add_argument('--njobs', default=1, type=int, help='number of cpus to utilize')
+    parser.add_argument('--cachedir', default=DEFAULT_CACHE_DIR,
+                        help='transform store shared by all registration pipelines')
+    parser.add_argument('--storedir', default=DEFAULT_STORE_DIR,
+                        help='node-local directory atlases are decoded to once (default: /dev/shm)')
+    parser.add_argument('--intermediate_type', default='NIFTI', choices=['NIFTI', 'NIFTI_GZ'],
+                        help='format of the files passed between nodes, final outputs are always .nii.gz')
+    parser.add_argument('--ledger', help='per-subject completion ledger (default: <warped dir>/ledger.jsonl)')
+    parser.add_argument('--manifest', help='subject manifest of path (default: one per path in ~/.nlreg_cache)')
+    parser.add_argument('--shard', help='INDEX/COUNT: run only the INDEX-th of COUNT deterministic subject shards')
     return parser
 
-def register(warped_dir, atlas_image, atlas_image_brain, subject_T1ws_T2ws, subject_T2ws, n_jobs):
+def register(warped_dir, atlas_image, atlas_image_brain, subject_T1ws_T2ws, subject_T2ws, n_jobs, cache_dir=DEFAULT_CACHE_DIR,
+             output_type='NIFTI', ledger_file=None, subject_ids=None, fingerprints=None):
+
+    iterables = [('subject_image_list', subject_T1ws_T2ws),
+                 ('subject_image', subject_T2ws)]
+    if ledger_file:
+        iterables += [('subjectid', subject_ids), ('fingerprint', fingerprints)]
 
     input_spec = pe.Node(
-        utility.IdentityInterface(fields=['subject_image_list', 'subject_image', 'atlas_image', 'atlas_image_brain']),
-        iterables=[('subject_image_list', subject_T1ws_T2ws),
-                   ('subject_image', subject_T2ws)],
+        utility.IdentityInterface(fields=['subject_image_list', 'subject_image', 'atlas_image', 'atlas_image_brain',
+                                          'subjectid', 'fingerprint']),
+        iterables=iterables,
         synchronize=True,
         name='input_spec'
     )
@@ -83,8 +125,24 @@ def register(warped_dir, atlas_image, atlas_image_brain, subject_T1ws_T2ws, subj
     MI - option 32x16000: 32 bins, 16000 samples
     '''
 
+    # scheduling estimates: one registration per subject shares the cpus
+    subject_voxels = max_voxels(subject_T2ws)
+    atlas_voxels = max_voxels(atlas_image)
+    pair_threads = threads_per_task(n_jobs, len(subject_T2ws))
+
+    # the atlas channel the metrics read is matched to the subject's once, not in every ANTs stage
+    preprocess = pe.Node(
+        PreprocessPair(histogram_matching=True, cache_dir=cache_dir),
+        name='preprocess')
+    preprocess.inputs.moving_image = atlas_image[0]
+
+    moving_list = pe.Node(
+        utility.Merge(2, ravel_inputs=True),
+        name='moving_list')
+    moving_list.inputs.in2 = atlas_image[1:]
+
     reg = pe.Node(
-        ants.Registration(
+        CachedRegistration(
             dimension=3,
             output_transform_prefix="output_",
             #interpolation='BSpline',
@@ -102,33 +160,43 @@ def register(warped_dir, atlas_image, atlas_image_brain, subject_T1ws_T2ws, subj
             #winsorize_lower_quantile=0.05,
             #winsorize_upper_quantile=0.95,
             verbose=True,
-            use_histogram_matching=[True, True]
+            use_histogram_matching=[False, False],
+            cache_dir=cache_dir
         ),
-        name='calc_registration')
+        name='calc_registration',
+        **registration_resources(subject_voxels, atlas_voxels, ['Affine', 'SyN'], pair_threads))
 
     applytransforms = pe.Node(
-        ants.ApplyTransforms(
-            dimension=3,
-            interpolation='NearestNeighbor'),
-        name='apply_warpfield')
+        ApplyTransformsNative(
+            interpolation='NearestNeighbor',
+            output_type=output_type),
+        name='apply_warpfield',
+        **warp_resources(subject_voxels, atlas_voxels, 1, pair_threads))
 
     #Make warped atlas binary image
     #https://nipype.readthedocs.io/en/latest/interfaces/generated/interfaces.fsl/preprocess.html#bet
     binarize = pe.Node(
-        fsl.UnaryMaths(operation='bin'),
+        fsl.UnaryMaths(operation='bin', output_type=output_type),
         name='binarize')
 
     #apply binary warped atlas as mask to T2w
     #https://nipype.readthedocs.io/en/0.12.0/interfaces/generated/nipype.interfaces.fsl.maths.html#applymask
     applymask = pe.Node(
-        fsl.ApplyMask(),
+        fsl.ApplyMask(output_type=output_type),
         name='apply_mask')
 
+    #masked T2w is the deliverable, gzip it with pigz
+    compress = pe.Node(
+        Compress(),
+        name='compress_masked')
+
     wf = pe.Workflow(name='wf', base_dir=warped_dir)
 
     wf.connect(
-        [(input_spec, reg, [('atlas_image', 'moving_image'),
-                            ('subject_image_list', 'fixed_image')]), #create warp field to register atlas to subject
+        [(input_spec, preprocess, [(('subject_image_list', first_image), 'fixed_image')]),
+         (preprocess, moving_list, [('moving_image', 'in1')]),
+         (moving_list, reg, [('out', 'moving_image')]),
+         (input_spec, reg, [('subject_image_list', 'fixed_image')]), #create warp field to register atlas to subject
          (input_spec, applytransforms, [('atlas_image_brain', 'input_image'),
                                         ('subject_image', 'reference_image')]),
          (reg, applytransforms, [('forward_transforms', 'transforms')]) #apply warpfield to register atlas brain to subject
@@ -137,11 +205,21 @@ def register(warped_dir, atlas_image, atlas_image_brain, subject_T1ws_T2ws, subj
     wf.connect(applytransforms, 'output_image', binarize, 'in_file') #turn warped atlas brain into binary image to use as mask
     wf.connect(binarize, 'out_file', applymask, 'mask_file')
     wf.connect(input_spec, 'subject_image', applymask, 'in_file')
+    wf.connect(applymask, 'out_file', compress, 'in_file')
+
+    #mark the subject done once its masked T2w is written
+    if ledger_file:
+        record = pe.Node(
+            LedgerRecord(ledger_file=os.path.abspath(ledger_file), stage='Brown_nl_masking'),
+            name='ledger_record')
+        wf.connect(input_spec, 'subjectid', record, 'subject')
+        wf.connect(input_spec, 'fingerprint', record, 'fingerprint')
+        wf.connect(compress, 'out_file', record, 'in_files')
 
     wf.config['execution']['parameterize_dirs'] = False
 
     wf.write_graph()
-    output = wf.run(plugin='MultiProc', plugin_args={'n_procs' : n_jobs})
+    output = wf.run(plugin='MultiProc', plugin_args=plugin_args(n_jobs))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# standard lib
+
+'''
+Atlas pre-selection for joint label fusion.
+
+Every template gets a cheap low-resolution affine alignment to the subject and is scored
+inside the subject brain in process (similarity.py, MI or global correlation), the subject is
+read once instead of once per template by a MeasureImageSimilarity subprocess. Only the
+best n_atlases templates go on to the full Affine + SyN registration and fusion.
+'''
+
+import os
+
+# external libs
+import nipype.pipeline.engine as pe
+from nipype.interfaces import utility
+
+import similarity
+from moments import MomentsInitializer
+from preprocess import PreprocessPair
+from resources import image_voxels, max_voxels, threads_per_task, registration_resources, plugin_args
+from transform_cache import CachedRegistration, DEFAULT_CACHE_DIR
+from warp import ApplyTransformsNative
+
+
+def select_atlases(work_dir, subject_image, atlas_images, atlas_segmentations, n_atlases, metric='MI',
+                   n_jobs=1, cache_dir=DEFAULT_CACHE_DIR, output_type='NIFTI_GZ'):
+    '''returns the n_atlases best (atlas_images, atlas_segmentations), best first'''
+    if n_atlases is None or n_atlases >= len(atlas_images):
+        return atlas_images, atlas_segmentations
+
+    scores = score_atlases(work_dir, subject_image, atlas_images, metric, n_jobs, cache_dir, output_type)
+
+    # in-process MI and correlation are higher for more similar images
+    ranking = sorted(range(len(atlas_images)), key=lambda i: scores[i], reverse=True)[:n_atlases]
+    for i in ranking:
+        print('selected %s (similarity %s)' % (atlas_images[i], scores[i]))
+
+    return [atlas_images[i] for i in ranking], [atlas_segmentations[i] for i in ranking]
+
+
+def score_atlases(work_dir, subject_image, atlas_images, metric='MI', n_jobs=1, cache_dir=DEFAULT_CACHE_DIR,
+                  output_type='NIFTI_GZ'):
+    '''similarity of every atlas to subject_image after a low-resolution affine, in atlas order'''
+    input_spec = pe.Node(
+        utility.IdentityInterface(fields=['subject_image', 'atlas_image']),
+        iterables=[('atlas_image', atlas_images)],
+        name='input_spec'
+    )
+    input_spec.inputs.subject_image = subject_image
+
+    moments = pe.Node(
+        MomentsInitializer(),
+        name='init_moments')
+
+    preprocess = pe.Node(
+        PreprocessPair(histogram_matching=True, cache_dir=cache_dir),
+        name='preprocess')
+
+    # coarse levels only: ranking needs a rough alignment, not a converged one
+    reg = pe.Node(
+        CachedRegistration(
+            dimension=3,
+            output_transform_prefix="output_",
+            transforms=['Affine'],
+            transform_parameters=[(2.0,)],
+            shrink_factors=[[8, 4]],
+            smoothing_sigmas=[[3, 2]],
+            sigma_units=['vox'],
+            sampling_percentage=[0.05],
+            sampling_strategy=['Random'],
+            number_of_iterations=[[1000, 500]],
+            metric=['MI'],
+            metric_weight=[1],
+            radius_or_number_of_bins=[32],
+            use_histogram_matching=[False],
+            cache_dir=cache_dir
+        ),
+        name='calc_affine',
+        **registration_resources(image_voxels(subject_image), max_voxels(atlas_images), ['Affine'],
+                                 threads_per_task(n_jobs, len(atlas_images))))
+
+    applytransforms = pe.Node(
+        ApplyTransformsNative(
+            interpolation='Linear',
+            output_type=output_type),
+        name='apply_affine')
+
+    merge = pe.JoinNode(
+        utility.Merge(1, ravel_inputs=True),
+        joinsource='input_spec',
+        joinfield=['in1'],
+        name='merge'
+    )
+
+    wf = pe.Workflow(name='atlas_selection', base_dir=work_dir)
+
+    wf.connect(input_spec, 'subject_image', reg, 'fixed_image')
+    wf.connect(input_spec, 'atlas_image', preprocess, 'moving_image')
+    wf.connect(input_spec, 'subject_image', preprocess, 'fixed_image')
+    wf.connect(preprocess, 'moving_image', reg, 'moving_image')
+    wf.connect(input_spec, 'subject_image', moments, 'fixed_image')
+    wf.connect(input_spec, 'atlas_image', moments, 'moving_image')
+    wf.connect(moments, 'out_transform', reg, 'initial_moving_transform')
+
+    wf.connect(reg, 'forward_transforms', applytransforms, 'transforms')
+    wf.connect(input_spec, 'atlas_image', applytransforms, 'input_image')
+    wf.connect(input_spec, 'subject_image', applytransforms, 'reference_image')
+    wf.connect(applytransforms, 'output_image', merge, 'in1')
+
+    wf.config['execution']['parameterize_dirs'] = False
+
+    output = wf.run(plugin='MultiProc', plugin_args=plugin_args(n_jobs))
+
+    out_nodes = [n.name for n in output.nodes]
+    warped_images = list(output.nodes)[(out_nodes.index('merge'))].result.outputs.out
+
+    # subject images are skull-stripped, so the brain mask is everything non-zero
+    subject = similarity.load_image(subject_image)
+    mask = subject != 0
+    if metric == 'MI':
+        return [similarity.similarity(subject, similarity.load_image(w), 'MI', 32, mask=mask) for w in warped_images]
+    # normalised cross correlation over the whole mask
+    return [similarity.similarity(subject, similarity.load_image(w), 'GC', mask=mask) for w in warped_images]
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# standard lib
+
+'''
+Threads per registration vs registrations side by side, measured instead of guessed.
+
+A short registration of the kind nonlinear_reg.register runs (the Affine stage on its two coarsest
+levels and the first SyN level) is timed at several ITK thread counts, and Amdahl's law is fitted to
+the wall times:
+
+    seconds(threads) = serial + parallel / threads
+
+For a node of n_cpus cpus running n_tasks independent registrations, best_split() picks the threads
+per registration that maximises registrations finished per hour, processes = min(n_tasks, n_cpus // threads).
+The fitted curve is stored per cpu model in the tuning file, and resources.threads_per_task uses it
+whenever a curve for the current cpu model is there, so every pipeline schedules the measured split.
+
+usage: autotune.py fixed.nii.gz moving.nii.gz --ncpus 32 [--threads 1 2 4 8 16]
+'''
+
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+
+# external libs
+import numpy as np
+from nipype.interfaces import ants
+
+DEFAULT_TUNING_FILE = os.path.join(os.path.expanduser('~'), '.nlreg_cache', 'autotune.json')
+
+
+def main():
+    parser = generate_parser()
+    args = parser.parse_args()
+
+    n_cpus = args.ncpus or available_cpus()
+    threads = args.threads or [t for t in (1, 2, 4, 8, 16, 32, 64) if t <= n_cpus]
+
+    seconds = benchmark(args.fixed_image, args.moving_image, threads, args.repeats, args.workdir)
+    curve = fit_curve(threads, seconds)
+    save_curve(curve, args.tuning_file)
+
+    print('threads  seconds  fitted')
+    for t, s in zip(threads, seconds):
+        print('%7d  %7.1f  %6.1f' % (t, s, predict_seconds(curve, t)))
+    print('serial fraction %.3f' % (curve['serial'] / (curve['serial'] + curve['parallel'])))
+
+    split = best_split(curve, n_cpus, args.ntasks)
+    print('%d cpus: %d registrations x %d threads, %.1f benchmark registrations per hour'
+          % (n_cpus, split['processes'], split['threads'], split['per_hour']))
+    print('curve stored in %s for %s' % (args.tuning_file, curve['cpu']))
+
+
+def generate_parser():
+    parser = argparse.ArgumentParser(description='measure ITK thread scaling and choose processes x threads')
+    parser.add_argument('fixed_image', help='representative skull-stripped subject image')
+    parser.add_argument('moving_image', help='representative skull-stripped atlas image')
+    parser.add_argument('--ncpus', type=int, help='cpus of the nodes the pipelines run on (default: this allocation)')
+    parser.add_argument('--ntasks', type=int, help='independent registrations to split for (default: unlimited)')
+    parser.add_argument('--threads', type=int, nargs='+', help='thread counts to time (default: powers of two)')
+    parser.add_argument('--repeats', default=1, type=int, help='runs per thread count, the fastest is kept')
+    parser.add_argument('--workdir', help='scratch directory for the benchmark registrations')
+    parser.add_argument('--tuning_file', default=DEFAULT_TUNING_FILE, help='where the fitted curve is stored')
+    return parser
+
+
+def available_cpus():
+    if os.environ.get('SLURM_CPUS_PER_TASK'):
+        return int(os.environ['SLURM_CPUS_PER_TASK'])
+    return len(os.sched_getaffinity(0))
+
+
+def cpu_model():
+    '''the curve is a property of the core type, not of the host'''
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except IOError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def benchmark_registration(fixed_image, moving_image, n_threads):
+    return ants.Registration(
+        dimension=3,
+        output_transform_prefix='output_',
+        transforms=['Affine', 'SyN'],
+        transform_parameters=[(2.0,), (0.25,)],
+        shrink_factors=[[8, 4], [4]],
+        smoothing_sigmas=[[3, 2], [2]],
+        sigma_units=['vox'] * 2,
+        sampling_percentage=[0.05, None],
+        sampling_strategy=['Random', 'None'],
+        number_of_iterations=[[200, 100], [30]],
+        metric=['MI', 'CC'],
+        metric_weight=[1, 1],
+        radius_or_number_of_bins=[32, 8],
+        initial_moving_transform_com=1,
+        fixed_image=fixed_image,
+        moving_image=moving_image,
+        num_threads=n_threads)
+
+
+def benchmark(fixed_image, moving_image, threads, repeats=1, work_dir=None):
+    '''fastest wall time of the benchmark registration at every thread count'''
+    seconds = []
+    for n_threads in threads:
+        runs = []
+        for _ in range(repeats):
+            cwd = tempfile.mkdtemp(prefix='autotune_', dir=work_dir)
+            start = time.time()
+            benchmark_registration(fixed_image, moving_image, n_threads).run(cwd=cwd)
+            runs.append(time.time() - start)
+        seconds.append(min(runs))
+    return seconds
+
+
+def fit_curve(threads, seconds):
+    '''least-squares Amdahl fit seconds = serial + parallel / threads, both terms kept non-negative'''
+    threads = np.asarray(threads, dtype=np.float64)
+    seconds = np.asarray(seconds, dtype=np.float64)
+    if len(threads) < 2:
+        serial, parallel = 0.0, float(seconds[0] * threads[0])
+    else:
+        design = np.stack([np.ones_like(threads), 1.0 / threads], axis=1)
+        serial, parallel = np.linalg.lstsq(design, seconds, rcond=None)[0]
+        if serial < 0:
+            serial, parallel = 0.0, float(np.dot(seconds, 1.0 / threads) / np.dot(1.0 / threads, 1.0 / threads))
+        elif parallel < 0:
+            serial, parallel = float(seconds.mean()), 0.0
+    return {'cpu': cpu_model(), 'threads': [int(t) for t in threads], 'seconds': [float(s) for s in seconds],
+            'serial': float(serial), 'parallel': float(parallel)}
+
+
+def predict_seconds(curve, n_threads):
+    return curve['serial'] + curve['parallel'] / n_threads
+
+
+def best_split(curve, n_cpus, n_tasks=None):
+    '''
+    threads per registration maximising registrations per hour on n_cpus; for n_tasks registrations
+    the ones left over after full waves count, thread counts beyond the largest measured are not tried
+    '''
+    best = None
+    for n_threads in range(1, min(n_cpus, max(curve['threads'])) + 1):
+        processes = n_cpus // n_threads
+        if n_tasks:
+            processes = min(processes, n_tasks)
+            waves = -(-n_tasks // processes)
+            per_hour = 3600.0 * n_tasks / (waves * predict_seconds(curve, n_threads))
+        else:
+            per_hour = 3600.0 * processes / predict_seconds(curve, n_threads)
+        # a split only wins if it is clearly faster, ties go to fewer threads
+        if best is None or per_hour > best['per_hour'] * 1.01:
+            best = {'processes': processes, 'threads': n_threads, 'per_hour': per_hour}
+    return best
+
+
+def save_curve(curve, tuning_file=DEFAULT_TUNING_FILE):
+    curves = {}
+    if os.path.exists(tuning_file):
+        with open(tuning_file) as f:
+            curves = json.load(f)
+    curves[curve['cpu']] = curve
+    os.makedirs(os.path.dirname(os.path.abspath(tuning_file)), exist_ok=True)
+    tmp = tuning_file + '.tmp%d' % os.getpid()
+    with open(tmp, 'w') as f:
+        json.dump(curves, f, indent=1)
+    os.rename(tmp, tuning_file)
+
+
+def load_curve(tuning_file=DEFAULT_TUNING_FILE):
+    '''curve measured on this cpu model, None if there is none'''
+    if not os.path.exists(tuning_file):
+        return None
+    with open(tuning_file) as f:
+        return json.load(f).get(cpu_model())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+#!/usr/bin/env bash
+#SBATCH -A fnl_lab
+#SBATCH --mem-per-cpu 4G
+#SBATCH --time 4:00:00
+#SBATCH --cpus-per-task 32
+#SBATCH --output autotune_output.txt
+#SBATCH --error autotune_error.txt
+
+if [ $# -lt 2 ]; then
+  echo "REQUIRED: FIXED_IMAGE MOVING_IMAGE"
+  exit
+fi
+
+FIXED="$1"
+MOVING="$2"
+NCPUS=$SLURM_CPUS_PER_TASK
+
+python /home/users/moorlu/PycharmProjects/jlf/autotune.py "$FIXED" "$MOVING" --ncpus "$NCPUS" "${@:3}"
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# standard lib
+
+'''
+Joint label fusion for a whole cohort in one job.
+
+The manifest lists one subject per line, "subjectid subject_image" (whitespace or comma separated,
+lines starting with # are skipped). The template library is globbed and decoded onto node-local
+storage (template_store, /dev/shm by default) once, then the single-subject JLF workflow of
+joint_label_fusion_1ch is nested under a subject iterable, so every subject's registrations, warps and
+fusions share one MultiProc pool of --njobs cpus.
+
+fused labels are written to <outdir>/<subjectid>/out_label_fusion.nii.gz
+
+With --natlases every subject's templates are ranked first (atlas_selection) and each subject gets its own
+nested JLF workflow over its n best templates, still all in the one MultiProc pool.
+
+With --scratch the cohort runs in waves of --wave subjects on node-local scratch: subject images are
+staged there ahead of each wave (staging.py), the working directory lives there, and the fused labels
+are copied to <outdir> while the next wave computes.
+'''
+
+import argparse
+import os
+import re
+from glob import glob
+
+# external libs
+import nipype.pipeline.engine as pe
+from nipype import config
+from nipype.interfaces import io, utility
+
+from atlas_selection import select_atlases
+from joint_label_fusion_1ch import create_workflow
+from resources import max_voxels, plugin_args
+from staging import Stager, run_in_waves
+from template_store import uncompressed_all, prune, DEFAULT_STORE_DIR
+from transform_cache import DEFAULT_CACHE_DIR
+
+
+def main():
+    parser = generate_parser()
+    args = parser.parse_args()
+    # duration and peak memory of every node, what costmodel.py is fitted on
+    config.enable_resource_monitor()
+
+    subjects = read_manifest(args.manifest)
+    template_list = sorted(glob(os.path.join(args.joint_fusion_folder, 'Template*')))
+
+    atlas_images, atlas_segmentations = stage_templates(template_list, args.storedir)
+    print('%d subjects, %d templates staged in %s' % (len(subjects), len(template_list), args.storedir))
+
+    if args.scratch is None:
+        run_cohort(os.path.abspath(args.workdir), os.path.abspath(args.outdir), subjects, atlas_images,
+                   atlas_segmentations, n_jobs=args.njobs, cache_dir=args.cachedir, fusion=args.fusion,
+                   output_type=args.intermediate_type, n_atlases=args.natlases,
+                   selection_metric=args.selection_metric)
+        return
+
+    stager = Stager(args.scratch)
+    local_outdir = os.path.join(stager.scratch_dir, 'jlf_labels')
+
+    def run_wave(wave, local_inputs):
+        try:
+            run_cohort(os.path.join(stager.scratch_dir, 'jlf_work'), local_outdir,
+                       [(subjectid, images[0]) for (subjectid, _), images in zip(wave, local_inputs)], atlas_images,
+                       atlas_segmentations, n_jobs=args.njobs, cache_dir=args.cachedir, fusion=args.fusion,
+                       output_type=args.intermediate_type, n_atlases=args.natlases,
+                       selection_metric=args.selection_metric)
+        except RuntimeError as e:
+            # the subjects that did finish are still written back
+            print('wave %s failed: %s' % (' '.join(s for s, _ in wave), e))
+        for subjectid, _ in wave:
+            labels = os.path.join(local_outdir, subjectid, 'out_label_fusion.nii.gz')
+            if os.path.exists(labels):
+                stager.write_back([labels], [os.path.join(os.path.abspath(args.outdir), subjectid,
+                                                          'out_label_fusion.nii.gz')])
+
+    # every subject registers all (or natlases) templates, a wave of njobs // templates subjects keeps the cpus busy
+    wave_size = args.wave or max(1, args.njobs // min(len(atlas_images), args.natlases or len(atlas_images)))
+    run_in_waves([(subjectid, [image]) for subjectid, image in subjects], run_wave, stager, wave_size, args.ahead)
+
+
+def generate_parser():
+    parser = argparse.ArgumentParser(description='joint label fusion for every subject of a manifest')
+
+    parser.add_argument('manifest', help='text file with one "subjectid subject_image" per line')
+    parser.add_argument('joint_fusion_folder', help='path to joint label fusion atlas directory')
+    parser.add_argument('--njobs', default=1, type=int, help='number of cpus to utilize')
+    parser.add_argument('--workdir', default='./jlf_dir', help='nipype working directory')
+    parser.add_argument('--outdir', default='./jlf_dir/labels', help='fused labels go to <outdir>/<subjectid>')
+    parser.add_argument('--storedir', default=DEFAULT_STORE_DIR,
+                        help='node-local directory atlases are decoded to once (default: /dev/shm)')
+    parser.add_argument('--cachedir', default=DEFAULT_CACHE_DIR,
+                        help='transform store shared by all registration pipelines')
+    parser.add_argument('--fusion', default='ants', choices=['ants', 'native'],
+                        help='ants: AntsJointFusion. native: in-process block-parallel fusion')
+    parser.add_argument('--natlases', default=None, type=int,
+                        help='only register and fuse the n templates most similar to each subject (default: all)')
+    parser.add_argument('--selection_metric', default='MI', choices=['MI', 'NCC'],
+                        help='similarity used to rank templates for --natlases')
+    parser.add_argument('--intermediate_type', default='NIFTI', choices=['NIFTI', 'NIFTI_GZ'],
+                        help='format of the files passed between nodes, final outputs are always .nii.gz')
+    parser.add_argument('--scratch', help='node-local directory: stage subjects and work there, copy labels back')
+    parser.add_argument('--wave', type=int, help='with --scratch: subjects run together (default: njobs / templates)')
+    parser.add_argument('--ahead', type=int, help='with --scratch: subjects staged ahead (default: one wave)')
+
+    return parser
+
+
+def read_manifest(path):
+    '''[(subjectid, absolute subject_image path)] in manifest order'''
+    subjects = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            subjectid, subject_image = line.replace(',', ' ').split()[:2]
+            if not os.path.exists(subject_image):
+                raise IOError('%s: subject image %s does not exist' % (subjectid, subject_image))
+            subjects.append((subjectid, os.path.abspath(subject_image)))
+
+    subjectids = [s for s, _ in subjects]
+    duplicates = sorted(set(s for s in subjectids if subjectids.count(s) > 1))
+    if duplicates:
+        raise ValueError('subject ids listed more than once in %s: %s' % (path, ', '.join(duplicates)))
+    return subjects
+
+
+def stage_templates(template_list, store_dir=DEFAULT_STORE_DIR):
+    '''uncompressed T1w_brain/Segmentation of every template in store_dir, decoded unless already there'''
+    # templates earlier jobs left on the node and nobody used for a week
+    prune(store_dir)
+    atlas_images = uncompressed_all([os.path.join(t, 'T1w_brain.nii.gz') for t in template_list], store_dir)
+    atlas_segmentations = uncompressed_all([os.path.join(t, 'Segmentation.nii.gz') for t in template_list],
+                                           store_dir)
+    return atlas_images, atlas_segmentations
+
+
+def run_cohort(work_dir, out_dir, subjects, atlas_images, atlas_segmentations, n_jobs,
+               cache_dir=DEFAULT_CACHE_DIR, fusion='ants', output_type='NIFTI', n_atlases=None,
+               selection_metric='MI'):
+    reference_voxels = max_voxels([i for _, i in subjects])
+    wf = pe.Workflow(name='cohort', base_dir=work_dir)
+
+    if n_atlases is not None and n_atlases < len(atlas_images):
+        # subjects fuse different templates, so one nested workflow per subject instead of a subject iterable
+        for subjectid, subject_image in subjects:
+            images, segmentations = select_atlases(os.path.join(work_dir, 'selection', subjectid), subject_image,
+                                                   atlas_images, atlas_segmentations, n_atlases,
+                                                   metric=selection_metric, n_jobs=n_jobs, cache_dir=cache_dir,
+                                                   output_type=output_type)
+            node_name = re.sub(r'\W', '_', subjectid)
+            jlf = create_workflow(images, segmentations, n_jobs, cache_dir=cache_dir, fusion=fusion,
+                                  output_type=output_type, n_subjects=len(subjects),
+                                  reference_voxels=reference_voxels, name='jlf_%s' % node_name)
+            jlf.get_node('subject_spec').inputs.subject_image = subject_image
+
+            sink = pe.Node(io.DataSink(base_directory=out_dir, container=subjectid, parameterization=False),
+                           name='sink_%s' % node_name)
+            wf.connect(jlf, 'compress_labels.out_file', sink, '@label_fusion')
+    else:
+        subject_spec = pe.Node(
+            utility.IdentityInterface(fields=['subjectid', 'subject_image']),
+            iterables=[('subjectid', [s for s, _ in subjects]),
+                       ('subject_image', [i for _, i in subjects])],
+            synchronize=True,
+            name='subject_spec'
+        )
+
+        # atlas iterables nested under the subject iterable, fusion joins the atlases of one subject
+        jlf = create_workflow(atlas_images, atlas_segmentations, n_jobs, cache_dir=cache_dir, fusion=fusion,
+                              output_type=output_type, n_subjects=len(subjects),
+                              reference_voxels=reference_voxels, name='jlf')
+
+        sink = pe.Node(io.DataSink(base_directory=out_dir, parameterization=False), name='sink')
+
+        wf.connect(subject_spec, 'subject_image', jlf, 'subject_spec.subject_image')
+        wf.connect(subject_spec, 'subjectid', sink, 'container')
+        wf.connect(jlf, 'compress_labels.out_file', sink, '@label_fusion')
+
+    wf.config['execution']['parameterize_dirs'] = False
+
+    output = wf.run(plugin='MultiProc', plugin_args=plugin_args(n_jobs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+#!/usr/bin/env bash
+#SBATCH -A fnl_lab
+#SBATCH --mem-per-cpu 4G
+#SBATCH --time 36:00:00
+#SBATCH --cpus-per-task 32
+#SBATCH --output cohort_jlf_output.txt
+#SBATCH --error cohort_jlf_error.txt
+
+if [ $# -lt 2 ]; then
+  echo "REQUIRED: MANIFEST JLFFOLDER"
+  exit
+fi
+
+MANIFEST="$1"
+JLFFOLDER="$2"
+NCPUS=$SLURM_CPUS_PER_TASK
+
+python /home/users/moorlu/PycharmProjects/jlf/cohort_jlf.py "$MANIFEST" "$JLFFOLDER" --njobs "$NCPUS" "${@:3}"
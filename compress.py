@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# standard lib
+
+'''
+Intermediate image format and final compression.
+
+Nodes that only feed other nodes can write uncompressed NIfTI (output_type='NIFTI', the FSL names are
+used so the same value can be handed to fsl interfaces): the next node memory-maps it instead of
+inflating it, and nobody spends a single-threaded deflate on a file that is read once. The final
+deliverables go through a Compress node, which runs pigz on num_threads cpus when it is installed and
+falls back to the gzip module otherwise.
+'''
+
+import gzip
+import os
+import shutil
+import subprocess
+
+# external libs
+from nipype.interfaces.base import BaseInterface, BaseInterfaceInputSpec, TraitedSpec, File, traits, isdefined
+from nipype.utils.filemanip import split_filename
+
+OUTPUT_TYPES = {'NIFTI': '.nii', 'NIFTI_GZ': '.nii.gz'}
+
+
+def with_output_type(filename, output_type):
+    '''filename with its .nii/.nii.gz extension replaced by the one of output_type'''
+    for ext in ('.nii.gz', '.nii'):
+        if filename.endswith(ext):
+            filename = filename[:-len(ext)]
+            break
+    return filename + OUTPUT_TYPES[output_type]
+
+
+def compress(in_file, out_file=None, n_threads=1):
+    '''gzip in_file to out_file (default in_file + .gz), files that already are .gz are returned as they are'''
+    if in_file.endswith('.gz'):
+        return in_file
+    if out_file is None:
+        out_file = in_file + '.gz'
+
+    tmp = out_file + '.tmp%d' % os.getpid()
+    with open(tmp, 'wb') as out:
+        if shutil.which('pigz'):
+            subprocess.check_call(['pigz', '-c', '-p', str(n_threads), in_file], stdout=out)
+        else:
+            with open(in_file, 'rb') as f, gzip.GzipFile(fileobj=out, mode='wb', compresslevel=6) as gz:
+                shutil.copyfileobj(f, gz, 1 << 20)
+    os.rename(tmp, out_file)
+    return out_file
+
+
+class CompressInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='image to compress, passed through if it is .gz already')
+    out_file = traits.Str(desc='output file name, default <in_file basename>.nii.gz')
+    num_threads = traits.Int(1, usedefault=True, desc='pigz threads')
+
+
+class CompressOutputSpec(TraitedSpec):
+    out_file = File(exists=True)
+
+
+class Compress(BaseInterface):
+    '''compress a final output image into the node directory'''
+
+    input_spec = CompressInputSpec
+    output_spec = CompressOutputSpec
+
+    def _output_filename(self):
+        if self.inputs.in_file.endswith('.gz'):
+            return self.inputs.in_file
+        if isdefined(self.inputs.out_file):
+            return os.path.abspath(self.inputs.out_file)
+        _, base, _ = split_filename(self.inputs.in_file)
+        return os.path.abspath(base + '.nii.gz')
+
+    def _run_interface(self, runtime):
+        compress(self.inputs.in_file, self._output_filename(), self.inputs.num_threads)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = self._output_filename()
+        return outputs
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# standard lib
+
+'''
+Wall time and memory per stage, fitted on the nipype results of past runs, and SLURM requests from it.
+
+Every node directory of a finished run holds result_<node>.pklz with the node's inputs, its duration
+and, when the resource monitor was on (the pipelines switch it on), its peak memory. fit() turns each
+result into a sample of its stage (the node name: calc_registration, apply_warpfield,
+joint_label_fusion, ...) with one size feature
+
+    size = voxels x work x atlases
+
+    voxels: of the fixed/reference/target image (header only)
+    work: for registrations the sum over stages and levels of iterations / shrink^3, 1 otherwise
+    atlases: number of atlases a fusion node fuses, 1 otherwise
+
+and fits per stage seconds = a + b size and mem_gb = c + d voxels x atlases (least squares, kept
+non-negative). Every pipeline has its own model, ~/.nlreg_cache/costmodel_<pipeline>.json; fitting
+on more work dirs replaces the stages found there and keeps the others. predict_node() gives the
+cost of a ready nipype node, which slurm_batch.SLURMArrayPlugin uses for right-sized --time and
+--mem (plugin_args cost_model), and estimate prints the predicted cost of a whole cohort over the
+pipeline's stages and the sbatch arguments for it. With --submit the wrapper is submitted with
+those arguments, which take precedence over its #SBATCH defaults, and PATH as its only argument;
+--dry_run only prints them.
+
+Memory is only fitted for stages whose runs recorded their peak; for the others the plugin keeps the
+node's mem_gb from resources.py.
+
+usage:
+    costmodel.py fit ./nlreg_dir/warped_nlreg [more work dirs] --pipeline nonlinear_reg
+    costmodel.py estimate /path/to/subjects --pipeline nonlinear_reg --njobs 10 --submit nonlinear_reg.sh [--dry_run]
+'''
+
+import argparse
+import json
+import math
+import os
+import re
+import subprocess
+from glob import glob
+
+# external libs
+import numpy as np
+import nibabel as nib
+from nipype.utils.filemanip import loadpkl
+
+from resources import registration_resources
+
+DEFAULT_MODEL_DIR = os.path.join(os.path.expanduser('~'), '.nlreg_cache')
+
+# the stages that do the work in each pipeline, housekeeping nodes (compress, crop, ledger, ...) are left out
+PIPELINE_STAGES = {
+    'nonlinear_reg': ('init_moments', 'calc_registration', 'apply_warpfield'),
+    't1t2_nonlinear_reg': ('calc_registration', 'apply_warpfield'),
+    'Brown_nl_masking': ('calc_registration', 'apply_warpfield', 'apply_mask'),
+    'cohort_jlf': ('init_moments', 'preprocess', 'calc_registration', 'apply_warpfield', 'joint_label_fusion'),
+    'temp_debug': ('calc_registration', 'apply_warpfield_atlas', 'apply_warpfield_segs', 'joint_label_fusion'),
+}
+
+# wrappers that take PATH as their only argument, the only ones --submit can pass arguments to
+PATH_WRAPPERS = ('nonlinear_reg.sh', 't1t2_nonlinear_reg.sh', 'Brown_nl_masking.sh')
+
+# inputs the size of a node's work is read from, in order of preference
+REFERENCE_INPUTS = ('fixed_image', 'reference_image', 'target_image', 'box_image', 'in_file', 'input_image')
+
+# stages that fuse all atlases of a subject in one run, the others run once per atlas
+FUSION_STAGES = ('joint_label_fusion', 'jlf')
+
+
+def main():
+    parser = generate_parser()
+    args = parser.parse_args()
+    model_file = args.model or pipeline_model_file(args.pipeline)
+
+    if args.command == 'fit':
+        samples = collect(args.paths)
+        # stages fitted now replace their old fit, the other stages of the pipeline's model are kept
+        model = load_model(model_file)
+        model.update(fit(samples))
+        save_model(model, model_file)
+        for stage, params in sorted(model.items()):
+            print('%-24s %4d runs  %7.1f s + %.3g s/unit  mem %s' % (
+                stage, params['samples'], params['seconds'][0], params['seconds'][1],
+                'not recorded' if params['mem_gb'] is None else '%.2f GB + %.3g GB/voxel' % tuple(params['mem_gb'])))
+        print('model of %d results stored in %s' % (len(samples), model_file))
+        return
+
+    if args.submit and os.path.basename(args.submit) not in PATH_WRAPPERS:
+        parser.error('--submit only passes PATH to the wrapper, which only suits %s' % ', '.join(PATH_WRAPPERS))
+
+    # estimate: voxel counts from the headers of the cohort's subjects
+    from manifest import scan, pairs
+    from preflight import check
+
+    model = load_model(model_file)
+    assert model, 'no cost model in %s, fit one first' % model_file
+    stages = args.stages or PIPELINE_STAGES[args.pipeline]
+    missing = [stage for stage in stages if stage not in model]
+    if missing:
+        print('not in %s, left out of the estimate: %s' % (model_file, ', '.join(missing)))
+    subjects, report = check(pairs(scan(args.paths[0]), args.list))
+    voxels = [report['/'.join(filter(None, [s, session]))]['voxels'] for s, session, _ in subjects]
+    cost = cohort_cost(model, voxels, args.njobs, args.atlases, stages)
+    print('%d subjects: %.2f cpu hours, %.2f hours on %d cpus, %.1f GB peak' % (
+        len(voxels), cost['cpu_seconds'] / 3600.0, cost['seconds'] / 3600.0, args.njobs, cost['mem_gb']))
+    for stage, seconds in sorted(cost['stages'].items()):
+        print('    %-24s %.2f cpu hours' % (stage, seconds / 3600.0))
+
+    sbatch_args = sbatch_resources(cost['seconds'], cost['mem_gb'], args.njobs, args.safety)
+    print('sbatch %s' % ' '.join(sbatch_args))
+    if args.submit and not args.dry_run:
+        subprocess.check_call(['sbatch'] + sbatch_args + [args.submit] + args.paths)
+
+
+def generate_parser():
+    parser = argparse.ArgumentParser(description='fit stage costs on past runs, estimate and submit a cohort')
+    parser.add_argument('command', choices=['fit', 'estimate'],
+                        help='fit: fit the model on the work dirs. estimate: predict the cost of the subjects in path')
+    parser.add_argument('paths', nargs='+', help='fit: nipype work dirs. estimate: path to the subjects')
+    parser.add_argument('--pipeline', default='nonlinear_reg', choices=sorted(PIPELINE_STAGES),
+                        help='pipeline the work dirs / the estimate are of, each has its own model')
+    parser.add_argument('--model', help='model file (default: %s)' % pipeline_model_file('<pipeline>'))
+    parser.add_argument('--stages', nargs='+', help='estimate: stages to price (default: those of the pipeline)')
+    parser.add_argument('--list', nargs='+', default=['T1w_acpc_dc_restore_brain', 'T2w_acpc_dc_restore_brain'],
+                        metavar='MODALITY', help='estimate: images every subject needs')
+    parser.add_argument('--njobs', default=1, type=int, help='estimate: cpus of the job')
+    parser.add_argument('--atlases', default=1, type=int, help='estimate: atlases registered per subject')
+    parser.add_argument('--safety', default=1.5, type=float, help='requested time and memory over the prediction')
+    parser.add_argument('--submit', metavar='WRAPPER',
+                        help='estimate: sbatch WRAPPER PATH; only for wrappers whose one argument is PATH (%s)'
+                             % ', '.join(PATH_WRAPPERS))
+    parser.add_argument('--dry_run', action='store_true', help='estimate: only print what would be requested')
+    return parser
+
+
+def pipeline_model_file(pipeline):
+    return os.path.join(DEFAULT_MODEL_DIR, 'costmodel_%s.json' % pipeline)
+
+
+def _first_file(value):
+    while isinstance(value, (list, tuple)) and value:
+        value = value[0]
+    return value if isinstance(value, str) and os.path.exists(value) else None
+
+
+def registration_work(inputs):
+    '''sum over stages and levels of iterations / shrink^3, 1 for anything that is not a registration'''
+    iterations, shrinks = inputs.get('number_of_iterations'), inputs.get('shrink_factors')
+    if not isinstance(iterations, list) or not isinstance(shrinks, list):
+        return 1.0
+    return float(sum(i / float(s) ** 3 for stage_iterations, stage_shrinks in zip(iterations, shrinks)
+                     for i, s in zip(stage_iterations, stage_shrinks)))
+
+
+def node_features(inputs):
+    '''(voxels, work, atlases) of a node from its inputs, voxels None if no input image is readable'''
+    reference = next((f for f in (_first_file(inputs.get(name)) for name in REFERENCE_INPUTS) if f), None)
+    voxels = int(np.prod(nib.load(reference).shape[:3])) if reference else None
+    atlases = inputs.get('atlas_image')
+    atlases = len(atlases) if isinstance(atlases, list) else 1
+    return voxels, registration_work(inputs), atlases
+
+
+def stage_name(node_name):
+    '''calc_registration, and the MapNode child _calc_registration3 -> calc_registration'''
+    return re.sub(r'^_(.*?)\d+$', r'\1', node_name)
+
+
+def collect(work_dirs):
+    '''a sample per result file below work_dirs: {stage, seconds, mem_gb, voxels, work, atlases}'''
+    samples = []
+    for work_dir in work_dirs:
+        for result_file in glob(os.path.join(work_dir, '**', 'result_*.pklz'), recursive=True):
+            try:
+                result = loadpkl(result_file)
+                runtime = result.runtime
+                voxels, work, atlases = node_features(result.inputs or {})
+            except Exception:
+                continue
+            # MapNode parents hold a list of their children's runtimes, the children are collected themselves
+            if voxels is None or getattr(runtime, 'duration', None) is None:
+                continue
+            samples.append({'stage': stage_name(os.path.basename(result_file)[len('result_'):-len('.pklz')]),
+                            'seconds': float(runtime.duration), 'mem_gb': getattr(runtime, 'mem_peak_gb', None),
+                            'voxels': voxels, 'work': work, 'atlases': atlases})
+    return samples
+
+
+def _fit_line(x, y):
+    '''least squares y = a + b x with a, b >= 0'''
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    if len(x) > 1 and np.ptp(x) > 0:
+        a, b = np.linalg.lstsq(np.stack([np.ones_like(x), x], axis=1), y, rcond=None)[0]
+        if a >= 0 and b >= 0:
+            return [float(a), float(b)]
+        if a < 0:
+            return [0.0, float(np.dot(x, y) / np.dot(x, x))]
+    return [float(y.max()), 0.0]
+
+
+def fit(samples):
+    model = {}
+    for stage in sorted(set(s['stage'] for s in samples)):
+        runs = [s for s in samples if s['stage'] == stage]
+        size = [s['voxels'] * s['work'] * s['atlases'] for s in runs]
+        monitored = [s for s in runs if s['mem_gb']]
+        model[stage] = {
+            'samples': len(runs),
+            'seconds': _fit_line(size, [s['seconds'] for s in runs]),
+            'mem_gb': _fit_line([s['voxels'] * s['atlases'] for s in monitored],
+                                [s['mem_gb'] for s in monitored]) if monitored else None,
+            # the schedule the stage usually runs, for predictions from voxel counts alone
+            'work': float(np.median([s['work'] for s in runs])),
+        }
+    return model
+
+
+def predict(model, stage, voxels, work=None, atlases=1):
+    '''(seconds, mem_gb or None) of one run of stage, None if the stage was never seen'''
+    params = model.get(stage)
+    if params is None:
+        return None
+    work = params['work'] if work is None else work
+    a, b = params['seconds']
+    mem_gb = None
+    if params['mem_gb'] is not None:
+        c, d = params['mem_gb']
+        mem_gb = c + d * voxels * atlases
+    return a + b * voxels * work * atlases, mem_gb
+
+
+def predict_node(model, node):
+    '''predicted (seconds, mem_gb or None) of a nipype node whose inputs are set, None if unknown'''
+    try:
+        voxels, work, atlases = node_features(node.inputs.get())
+    except Exception:
+        return None
+    if voxels is None:
+        return None
+    return predict(model, stage_name(node.name), voxels, work, atlases)
+
+
+def cohort_cost(model, subject_voxels, n_cpus, atlases=1, stages=None):
+    '''
+    every one of stages (default: all of the model) that the model knows once per subject and atlas
+    (fusion once per subject), n_cpus runs at a time: {stages: cpu seconds per stage, cpu_seconds, seconds, mem_gb}; stages without recorded memory
+    count with the resources.py estimate of a SyN registration
+    '''
+    stages = [stage for stage in (model if stages is None else stages) if stage in model]
+    cpu_stages, longest, peak = {}, 0.0, 0.0
+    for voxels in subject_voxels:
+        chain = 0.0
+        for stage in stages:
+            fused = stage in FUSION_STAGES
+            seconds, mem_gb = predict(model, stage, voxels, atlases=atlases if fused else 1)
+            cpu_stages[stage] = cpu_stages.get(stage, 0.0) + seconds * (1 if fused else atlases)
+            chain += seconds
+            if mem_gb is None:
+                mem_gb = registration_resources(voxels, voxels, ['SyN'])['mem_gb']
+            peak = max(peak, mem_gb)
+        longest = max(longest, chain)
+    cpu_seconds = sum(cpu_stages.values())
+    concurrent = max(1, min(n_cpus, len(subject_voxels) * atlases))
+    # no faster than the slowest subject's stages one after the other
+    return {'stages': cpu_stages, 'cpu_seconds': cpu_seconds, 'seconds': max(longest, cpu_seconds / concurrent),
+            'mem_gb': peak * concurrent}
+
+
+def format_time(seconds):
+    minutes = int(math.ceil(seconds / 60.0))
+    return '%d:%02d:00' % (minutes // 60, minutes % 60)
+
+
+def request_seconds(seconds, safety=1.5, min_seconds=600):
+    '''
+    time limit for a predicted run: safety over the prediction, rounded up to 10 minutes below an hour
+    and to whole hours above, so similar nodes end up in the same array
+    '''
+    seconds = max(min_seconds, seconds * safety)
+    step = 600 if seconds < 3600 else 3600
+    return int(math.ceil(seconds / step) * step)
+
+
+def sbatch_resources(seconds, mem_gb, n_cpus, safety=1.5, min_seconds=600, min_mem_gb=1):
+    '''sbatch arguments for a predicted run, with safety over the prediction'''
+    return ['--time=%s' % format_time(request_seconds(seconds, safety, min_seconds)),
+            '--mem=%dM' % int(math.ceil(max(min_mem_gb, (mem_gb or 0) * safety) * 1024)),
+            '--cpus-per-task=%d' % n_cpus]
+
+
+def save_model(model, model_file):
+    os.makedirs(os.path.dirname(os.path.abspath(model_file)), exist_ok=True)
+    tmp = model_file + '.tmp%d' % os.getpid()
+    with open(tmp, 'w') as f:
+        json.dump(model, f, indent=1, sort_keys=True)
+    os.rename(tmp, model_file)
+
+
+def load_model(model_file):
+    '''the stored model, empty if there is none'''
+    if not os.path.exists(model_file):
+        return {}
+    with open(model_file) as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    main()
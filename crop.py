@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# standard lib
+
+'''
+Brain bounding-box crop before registration, and the way back.
+
+The subject and atlas images are skull-stripped, yet SyN (CC radius 8) and fusion run over the whole
+field of view. crop() cuts an image to the bounding box of its non-zero voxels plus padding. The affine
+is shifted by the crop offset, so the physical space and therefore every ANTs transform computed on
+cropped images stay the same as for the originals. Only images resampled onto a cropped grid have to go
+back: uncrop() places them at the recorded offset in the original grid.
+
+The offset, original shape and original image are recorded in a JSON sidecar next to the crop:
+    {"source": "/abs/T2w_acpc_dc_restore_brain.nii.gz", "shape": [x, y, z], "offset": [i, j, k]}
+'''
+
+import json
+import os
+
+# external libs
+import numpy as np
+import nibabel as nib
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec, TraitedSpec, File, InputMultiPath,
+                                    OutputMultiPath, traits, isdefined)
+from nipype.utils.filemanip import split_filename
+
+from compress import OUTPUT_TYPES
+
+
+def bounding_box(data, padding=10):
+    '''slices of the non-zero voxels of data (first volume if 4D) grown by padding, the whole image if empty'''
+    if data.ndim > 3:
+        data = data.reshape(data.shape[:3] + (-1,))[..., 0]
+    box = []
+    for axis in range(3):
+        nonzero = np.nonzero(np.any(data != 0, axis=tuple(a for a in range(3) if a != axis)))[0]
+        if nonzero.size == 0:
+            return tuple(slice(0, n) for n in data.shape[:3])
+        box.append(slice(int(max(0, nonzero[0] - padding)), int(min(data.shape[axis], nonzero[-1] + 1 + padding))))
+    return tuple(box)
+
+
+def crop(in_file, box, out_file):
+    image = nib.load(in_file)
+    data = np.asanyarray(image.dataobj)[box]
+    offset = np.eye(4)
+    offset[:3, 3] = [s.start for s in box]
+    out = nib.Nifti1Image(data, image.affine.dot(offset), image.header)
+    out.set_data_dtype(data.dtype)
+    nib.save(out, out_file)
+    return os.path.abspath(out_file)
+
+
+def write_sidecar(source, box, sidecar):
+    with open(sidecar, 'w') as f:
+        json.dump({'source': os.path.abspath(source),
+                   'shape': [int(n) for n in nib.load(source).shape[:3]],
+                   'offset': [s.start for s in box]}, f)
+    return os.path.abspath(sidecar)
+
+
+def uncrop(in_file, sidecar, out_file):
+    '''in_file (on a grid cropped as recorded in sidecar) back on the original grid, zero outside the box'''
+    with open(sidecar) as f:
+        record = json.load(f)
+    source = nib.load(record['source'])
+    image = nib.load(in_file)
+    data = np.asanyarray(image.dataobj)
+
+    full = np.zeros(tuple(record['shape']) + data.shape[3:], dtype=data.dtype)
+    full[tuple(slice(o, o + n) for o, n in zip(record['offset'], data.shape[:3]))] = data
+    out = nib.Nifti1Image(full, source.affine, source.header)
+    out.set_data_dtype(data.dtype)
+    nib.save(out, out_file)
+    return os.path.abspath(out_file)
+
+
+def _cropped_name(in_file, output_type):
+    _, base, _ = split_filename(in_file)
+    return os.path.abspath(base + '_crop' + OUTPUT_TYPES[output_type])
+
+
+class CropInputSpec(BaseInterfaceInputSpec):
+    box_image = File(exists=True, mandatory=True, desc='skull-stripped image the bounding box is taken from')
+    in_files = InputMultiPath(File(exists=True), desc='more images on the grid of box_image, cut to the same box')
+    padding = traits.Int(10, usedefault=True, desc='voxels kept around the brain on every side')
+    output_type = traits.Enum('NIFTI', 'NIFTI_GZ', usedefault=True)
+
+
+class CropOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='cropped box_image')
+    out_files = OutputMultiPath(File(exists=True), desc='cropped in_files, in order')
+    sidecar = File(exists=True, desc='json record of the crop, for Uncrop')
+
+
+class Crop(BaseInterface):
+    '''cut images to the padded bounding box of the brain in box_image'''
+
+    input_spec = CropInputSpec
+    output_spec = CropOutputSpec
+
+    def _run_interface(self, runtime):
+        box = bounding_box(np.asanyarray(nib.load(self.inputs.box_image).dataobj), self.inputs.padding)
+        outputs = self._list_outputs()
+        crop(self.inputs.box_image, box, outputs['out_file'])
+        for in_file, out_file in zip(self._in_files(), outputs['out_files']):
+            crop(in_file, box, out_file)
+        write_sidecar(self.inputs.box_image, box, outputs['sidecar'])
+        return runtime
+
+    def _in_files(self):
+        return self.inputs.in_files if isdefined(self.inputs.in_files) else []
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = _cropped_name(self.inputs.box_image, self.inputs.output_type)
+        outputs['out_files'] = [_cropped_name(f, self.inputs.output_type) for f in self._in_files()]
+        outputs['sidecar'] = os.path.abspath('crop.json')
+        return outputs
+
+
+class UncropInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='image on a cropped grid')
+    sidecar = File(exists=True, mandatory=True, desc='json record written by Crop')
+    output_type = traits.Enum('NIFTI', 'NIFTI_GZ', usedefault=True)
+
+
+class UncropOutputSpec(TraitedSpec):
+    out_file = File(exists=True)
+
+
+class Uncrop(BaseInterface):
+    '''put an image computed on a cropped grid back on the original grid'''
+
+    input_spec = UncropInputSpec
+    output_spec = UncropOutputSpec
+
+    def _run_interface(self, runtime):
+        uncrop(self.inputs.in_file, self.inputs.sidecar, self._list_outputs()['out_file'])
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        _, base, _ = split_filename(self.inputs.in_file)
+        outputs['out_file'] = os.path.abspath(base + OUTPUT_TYPES[self.inputs.output_type])
+        return outputs
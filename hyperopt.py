@@ -8,8 +8,15 @@ test registration of T1w and T2w (.nii.gz files)
 '''
 
 import argparse
+import hashlib
+import json
+import math
 import os
 import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # external libs
 import numpy as np
@@ -17,24 +24,37 @@ import skopt
 import nipype.pipeline.engine as pe
 from nipype.interfaces import ants, utility
 from skopt.space import Integer, Real, Categorical
-from skopt.utils import use_named_args
 from skopt.callbacks import CheckpointSaver
+from skopt.utils import create_result
+
+import manifest
+import similarity
+from preprocess import PreprocessPair
+from transform_cache import file_digest
+from warp import ApplyTransformsNative
 
 def main():
     parser = generate_parser()
 
     args = parser.parse_args()
+    if args.eta < 2:
+        parser.error('--eta must be at least 2')
     path = args.path
     njobs = args.njobs
     ncalls = args.ncalls
+    nparallel = args.nparallel
+    mode = args.mode
+    eta = args.eta
+    scratch = args.scratch
 
-    paired_image_list = get_images(path)
+    paired_image_list = get_images(path, args.manifest)
     print(paired_image_list)
 
     # truncate
     paired_image_list = paired_image_list[:20]
 
-    optimize(os.path.join(path, 'optimize'), paired_image_list=paired_image_list, n_jobs=njobs, n_calls=ncalls)
+    optimize(os.path.join(path, 'optimize'), paired_image_list=paired_image_list, n_jobs=njobs, n_calls=ncalls,
+             n_parallel=nparallel, mode=mode, eta=eta, scratch=scratch)
 
 
 def generate_parser():
@@ -43,27 +63,30 @@ def generate_parser():
     parser.add_argument('path', help='path to T1w and T2w images')
     parser.add_argument('--njobs', default=1, type=int, help='number of cpus to utilize')
     parser.add_argument('--ncalls', default=11, type=int, help='number of calls to fitness function')
+    parser.add_argument('--nparallel', default=1, type=int,
+                        help='number of trials evaluated concurrently, sharing --njobs cpus')
+    parser.add_argument('--mode', default='bayes', choices=['bayes', 'halving'],
+                        help='bayes: GP optimisation at full fidelity. halving: successive halving of ncalls '
+                             'random candidates, starting on few subjects and coarse pyramid levels')
+    parser.add_argument('--eta', default=3, type=int, help='halving: keep 1/eta of the candidates per rung (>= 2)')
+    parser.add_argument('--scratch', default=None,
+                        help='directory for per-trial workspaces, e.g. node-local disk or /dev/shm '
+                             '(default: <path>/optimize/trials)')
+    parser.add_argument('--manifest', default=None,
+                        help='subject manifest of path (default: one per path in ~/.nlreg_cache)')
 
     return parser
 
 
-def get_images(path):
-
+def get_images(path, manifest_file=None):
+    '''(T1w, T2w) of every anat folder, from the manifest of path instead of walking the tree'''
     assert os.path.isdir(path), '%s is not a directory!' % path
-    image_pairs = []
-    for root, directories, files in filter(lambda x: os.path.basename(x[0]) == 'anat',
-                                           os.walk(path)):
-        T1ws = [f for f in files if 'T1w.nii.gz' in f]
-        T2ws = [f for f in files if 'T2w.nii.gz' in f]
-        if len(T1ws) and len(T2ws):
-            image_pairs.append((os.path.join(root, T1ws[0]),
-                                os.path.join(root, T2ws[0])))
-        else:
-            print('%s does not have a pair of T1w, T2w' % root)
+    manifest_file = manifest.scan(path, manifest_file)
+    return [tuple(images) for _, _, images in manifest.pairs(manifest_file, ['T1w', 'T2w'], datatype='anat')]
 
-    return image_pairs
-
-def optimize(wd='./optimize', paired_image_list=[], n_jobs=1, n_calls=10):
+def optimize(wd='./optimize', paired_image_list=[], n_jobs=1, n_calls=10, n_parallel=1, mode='bayes', eta=3,
+             scratch=None):
+    wd = os.path.abspath(wd)
     if not os.path.exists(wd):
         os.makedirs(wd)
     os.chdir(wd)
@@ -71,9 +94,27 @@ def optimize(wd='./optimize', paired_image_list=[], n_jobs=1, n_calls=10):
     best_images = os.path.join(wd, 'best_images')
     # warped_dir = os.path.join(wd, 'warped_images')
 
+    # every trial gets its own workspace under scratch, the best one is kept under trials
+    trials_dir = os.path.join(wd, 'trials')
+    scratch = os.path.abspath(scratch) if scratch else trials_dir
+    for d in (trials_dir, scratch):
+        if not os.path.exists(d):
+            os.makedirs(d)
+
+    # deleting gigabytes of warps on Lustre is slow, do it off the critical path
+    pruner = ThreadPoolExecutor(max_workers=1)
+
     # initialize best accuracy score
     global best_fitness
     best_fitness = 0.0
+    best_lock = threading.Lock()
+
+    # fixed images are scored against every trial's warps, decode them once
+    fixed_arrays = {t1w: similarity.load_image(t1w) for t1w, t2w in paired_image_list}
+
+    # evaluated points survive restarts, keyed on the point, the images it was scored on and its fidelity
+    cache_file = os.path.join(wd, 'fitness_cache.jsonl')
+    fitness_cache = load_fitness_cache(cache_file)
 
     dim_metric = Categorical(categories=['CC', 'MI'], name='metric')
     dim_radius = Integer(2, 8, name='radius')
@@ -91,34 +132,65 @@ def optimize(wd='./optimize', paired_image_list=[], n_jobs=1, n_calls=10):
         dim_histogram
     ]
 
-    @use_named_args(dimensions=dimensions)
-    def fitness(metric, radius, n_subsamples, mi_bins, histomatching):
-        similarities = np.zeros((len(paired_image_list),))
-        #randint = np.random.randint(100000, 999999, +1)
-        randint = np.array([1000])
-        warped_dir = os.path.join(wd, 'warped{}'.format(randint[0]))
+    def fitness(x, trial, ncpus=n_jobs, n_subjects=None, drop_levels=0):
+        metric, radius, n_subsamples, mi_bins, histomatching = x
+        image_list = paired_image_list[:n_subjects]
+
+        # skopt regularly proposes integer/categorical points it has already seen
+        key = fitness_key(x, dataset_fingerprint(image_list), drop_levels)
+        if key in fitness_cache:
+            print('cached fitness for %s' % key)
+            return -np.mean(fitness_cache[key]['similarities'])
+
+        start = time.time()
+        # concurrent trials each run their own workflow, so they need their own directory
+        warped_dir = tempfile.mkdtemp(prefix='warped{}_'.format(trial), dir=scratch)
         #for i, (t1w, t2w) in enumerate(paired_image_list):
-        t1w, t2w = zip(*paired_image_list)
-        similarities = register(warped_dir, t1w, t2w, metric, radius, n_subsamples, mi_bins, histomatching, n_jobs)
+        t1w, t2w = zip(*image_list)
+        similarities = register(warped_dir, t1w, t2w, metric, radius, n_subsamples, mi_bins, histomatching, ncpus,
+                                drop_levels)
         fitness = np.mean(similarities)
 
+        record = {'key': key, 'similarities': list(similarities), 'runtime': time.time() - start}
+        with best_lock:
+            fitness_cache[key] = record
+            with open(cache_file, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+        # low fidelity scores are not comparable with full ones, only those may become best_images
+        full_fidelity = len(image_list) == len(paired_image_list) and drop_levels == 0
+
         global best_fitness
-        if fitness > best_fitness:
-            # copy folder of output transforms, maybe with values of metric, radius, etc.
-            print('new best fitness score: %s\nprevious: %s' % (fitness, best_fitness))
-            if os.path.exists(best_images):
-                shutil.rmtree(best_images)
-            shutil.copytree(warped_dir, best_images)
-            best_fitness = fitness
-        shutil.rmtree(warped_dir)
+        with best_lock:
+            if full_fidelity and fitness > best_fitness:
+                # keep folder of output transforms, maybe with values of metric, radius, etc.
+                print('new best fitness score: %s\nprevious: %s' % (fitness, best_fitness))
+                # a rename when scratch is under wd, a single copy back from node-local scratch otherwise
+                kept_dir = os.path.join(trials_dir, os.path.basename(warped_dir))
+                if kept_dir != warped_dir:
+                    shutil.move(warped_dir, kept_dir)
+                previous = promote(kept_dir, best_images)
+                if previous:
+                    pruner.submit(shutil.rmtree, previous, True)
+                best_fitness = fitness
+                warped_dir = None
+        if warped_dir:
+            pruner.submit(shutil.rmtree, warped_dir, True)
 
         return -fitness
 
-    def register(warped_dir, fixed_images, moving_images, metric, radius, n_subsamples, mi_bins, histomatching, ncpus=1):
+    def register(warped_dir, fixed_images, moving_images, metric, radius, n_subsamples, mi_bins, histomatching, ncpus=1,
+                 drop_levels=0):
         shrink_factors = [2 ** i for i in range(n_subsamples - 1, -1, -1)]
         smoothing_sigmas = list(range(n_subsamples - 1, -1, -1))
         convergence = [100 + i for i in shrink_factors]
 
+        # low fidelity: stop the pyramid before its finest levels
+        n_levels = max(1, n_subsamples - drop_levels)
+        shrink_factors = shrink_factors[:n_levels]
+        smoothing_sigmas = smoothing_sigmas[:n_levels]
+        convergence = convergence[:n_levels]
+
         #save all warped output images to a folder and save them w/ subject id
         #file_basename = os.path.basename(fixed_image)
         #split_text1 = os.path.splitext(file_basename)
@@ -132,6 +204,13 @@ def optimize(wd='./optimize', paired_image_list=[], n_jobs=1, n_calls=10):
             name='inputs'
         )
 
+        # winsorised/matched images are cached under wd and shared by every trial with the same histomatching
+        preprocess = pe.Node(
+            PreprocessPair(winsorize_lower_quantile=0.05, winsorize_upper_quantile=0.95,
+                           histogram_matching=histomatching,
+                           store_dir=os.path.join(wd, 'preprocessed')),
+            name='preprocess')
+
         reg = pe.Node(
             ants.Registration(
             dimension=3,
@@ -147,30 +226,22 @@ def optimize(wd='./optimize', paired_image_list=[], n_jobs=1, n_calls=10):
             number_of_iterations=[convergence],
             metric=[metric],
             radius_or_number_of_bins=[radius],
-            winsorize_lower_quantile=0.05,
-            winsorize_upper_quantile=0.95,  # clips high and low intensity data
             verbose=True,
-            use_histogram_matching=[histomatching]
+            use_histogram_matching=[False]
         ),
         name='calc_registration')
         if metric == 'MI':
             reg.inputs.radius_or_number_of_bins = [mi_bins]
 
         applytransforms = pe.Node(
-            ants.ApplyTransforms(
-                dimension=3,
-                interpolation='BSpline'),
+            ApplyTransformsNative(
+                interpolation='BSpline',
+                # read straight back for scoring, not worth a gzip round trip
+                output_type='NIFTI'),
                 name='apply_warpfield'
         )
 
-        # Image similarity
-        sim = pe.Node(ants.MeasureImageSimilarity(), name='calc_similarity')
-        # assign attribute values to sim:
-        sim.inputs.dimension = 3
-        sim.inputs.metric = 'MI'
-        sim.inputs.radius_or_number_of_bins = 32
-        sim.inputs.sampling_percentage = 1.0
-
+        # collect warped images, similarity is computed in process once the workflow finishes
         merge = pe.JoinNode(
             utility.Merge(1, ravel_inputs=True),
             joinsource='inputs',
@@ -180,33 +251,178 @@ def optimize(wd='./optimize', paired_image_list=[], n_jobs=1, n_calls=10):
 
         wf = pe.Workflow(name='wf', base_dir=warped_dir)
         wf.connect(
-            [(inputs, reg, [('fixed_image', 'fixed_image'), ('moving_image', 'moving_image')]),
-             (inputs, applytransforms, [('fixed_image', 'reference_image'), ('moving_image', 'input_image')]),
-             (inputs, sim, [('fixed_image', 'fixed_image')])
+            [(inputs, preprocess, [('fixed_image', 'fixed_image'), ('moving_image', 'moving_image')]),
+             (preprocess, reg, [('fixed_image', 'fixed_image'), ('moving_image', 'moving_image')]),
+             (inputs, applytransforms, [('fixed_image', 'reference_image'), ('moving_image', 'input_image')])
              ]
         )
         wf.connect(reg, 'forward_transforms', applytransforms, 'transforms')
-        wf.connect(applytransforms, 'output_image', sim, 'moving_image')
-        wf.connect(sim, 'similarity', merge, 'in1')
+        wf.connect(applytransforms, 'output_image', merge, 'in1')
         wf.config['execution']['parameterize_dirs'] = False
 
         wf.write_graph()
         output = wf.run(plugin='MultiProc', plugin_args={'n_procs' : ncpus})
 
         out_nodes = [n.name for n in output.nodes]
-        similarities = list(output.nodes)[(out_nodes.index('merge'))].result.outputs.out
-        # similarities = list(output.nodes)[0].result.outputs.out
+        warped_images = list(output.nodes)[(out_nodes.index('merge'))].result.outputs.out
+        # MI, 32 bins, every voxel: same settings the MeasureImageSimilarity node used
+        similarities = [similarity.mutual_information(fixed_arrays[fixed_image], similarity.load_image(warped_image),
+                                                      bins=32)
+                        for fixed_image, warped_image in zip(fixed_images, warped_images)]
         return similarities
 
     checkpoint_callback = CheckpointSaver('./result.pkl', store_objective=False)
 
-    search_result = skopt.gp_minimize(
-        func=fitness, dimensions=dimensions, acq_func='EI', n_calls=n_calls, n_jobs=1, callback=[checkpoint_callback],
-        x0=x0
-    )
+    def evaluate(batch, first_trial, **fidelity):
+        # share the cpus between the trials in flight
+        ncpus = [max(1, n_jobs // len(batch) + (i < n_jobs % len(batch))) for i in range(len(batch))]
+        with ThreadPoolExecutor(max_workers=len(batch)) as executor:
+            futures = [executor.submit(fitness, x, first_trial + i, ncpus[i], **fidelity) for i, x in enumerate(batch)]
+            return [f.result() for f in futures]
+
+    if mode == 'halving':
+        search_result = successive_halving(evaluate, dimensions, x0, len(paired_image_list),
+                                           n_candidates=n_calls, n_parallel=n_parallel, eta=eta)
+        checkpoint_callback(search_result)
+        pruner.shutdown(wait=True)
+        print(search_result.x)
+        return
+
+    # ask/tell instead of gp_minimize so that a batch of points can be evaluated at once,
+    # same GP/EI settings and number of random starts as gp_minimize
+    optimizer = skopt.Optimizer(dimensions, base_estimator='GP', acq_func='EI', n_initial_points=10)
+
+    # warm start from a previous (e.g. preempted) run; result.pkl is not used, it records neither the
+    # images nor the sign convention its points were scored with
+    x_prior, y_prior = prior_evaluations(fitness_cache, dataset_fingerprint(paired_image_list), optimizer.space)
+    if x_prior:
+        print('warm start from %d previous evaluations' % len(x_prior))
+        search_result = optimizer.tell(x_prior, y_prior)
+        best_fitness = max(best_fitness, -min(y_prior))
+
+    n_done = len(x_prior)
+    if n_done >= n_calls:
+        batch = []
+    elif list(x0) in x_prior:
+        batch = [optimizer.ask()]
+    else:
+        batch = [list(x0)]
+    while batch:
+        y = evaluate(batch, n_done)
+
+        search_result = optimizer.tell(batch, y)
+        checkpoint_callback(search_result)
+        n_done += len(batch)
+
+        n_points = min(n_parallel, n_calls - n_done)
+        if n_points > 1:
+            # constant liar: points still being evaluated are assumed to score the current minimum
+            batch = optimizer.ask(n_points=n_points, strategy='cl_min')
+        else:
+            batch = [optimizer.ask()] if n_points == 1 else []
 
+    pruner.shutdown(wait=True)
     print(search_result.x)
 
+
+def promote(trial_dir, best_images):
+    '''point best_images at trial_dir with an atomic symlink swap, returns the directory it pointed to before'''
+    previous = None
+    if os.path.islink(best_images):
+        previous = os.path.realpath(best_images)
+    elif os.path.isdir(best_images):
+        # full copy left by an earlier version of this script
+        previous = '{}.old{}'.format(best_images, int(time.time()))
+        os.rename(best_images, previous)
+
+    tmp_link = best_images + '.tmp'
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(trial_dir, tmp_link)
+    os.replace(tmp_link, best_images)
+    return previous
+
+
+def dataset_fingerprint(image_list):
+    '''hash of the contents of every (T1w, T2w) pair, in order'''
+    sha = hashlib.sha1()
+    for pair in image_list:
+        for image in pair:
+            sha.update(file_digest(image).encode())
+    return sha.hexdigest()
+
+
+def _native(value):
+    # skopt hands out numpy scalars, which json can't serialise
+    return value.item() if hasattr(value, 'item') else value
+
+
+def fitness_key(x, fingerprint, drop_levels=0):
+    return json.dumps([[_native(v) for v in x], fingerprint, drop_levels])
+
+
+def load_fitness_cache(cache_file):
+    fitness_cache = {}
+    if os.path.exists(cache_file):
+        with open(cache_file) as f:
+            for line in f:
+                # a job killed mid-write leaves a truncated last line
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                fitness_cache[record['key']] = record
+    return fitness_cache
+
+
+def prior_evaluations(fitness_cache, fingerprint, space):
+    '''full fidelity (x, y) pairs of the fitness cache scored on the images with this fingerprint'''
+    x_prior, y_prior = [], []
+    for key, record in fitness_cache.items():
+        x, record_fingerprint, drop_levels = json.loads(key)
+        if record_fingerprint == fingerprint and drop_levels == 0 and x in space and x not in x_prior:
+            x_prior.append(x)
+            y_prior.append(-float(np.mean(record['similarities'])))
+    return x_prior, y_prior
+
+
+def successive_halving(evaluate, dimensions, x0, n_subjects, n_candidates, n_parallel=1, eta=3):
+    '''
+    evaluate(batch, first_trial, n_subjects=..., drop_levels=...) returns the objective of each point.
+    Each rung keeps the best 1/eta of the candidates and gives the survivors eta times the subjects
+    and one more pyramid level, the last rung runs on all subjects at full resolution.
+    '''
+    space = skopt.space.Space(dimensions)
+    candidates = [list(x0)] + space.rvs(n_samples=max(0, n_candidates - 1))
+
+    # floor(log_eta(candidates)) + 1, in integers: math.log(243, 3) is 4.999...
+    n_rungs = 1
+    while eta ** n_rungs <= len(candidates):
+        n_rungs += 1
+
+    trial = 0
+    for rung in range(n_rungs):
+        remaining = n_rungs - 1 - rung
+        fidelity = {'n_subjects': max(1, int(math.ceil(n_subjects / float(eta ** remaining)))),
+                    'drop_levels': remaining}
+        print('rung %d: %d candidates on %d subjects, %d finest levels dropped'
+              % (rung, len(candidates), fidelity['n_subjects'], remaining))
+
+        y = []
+        for start in range(0, len(candidates), n_parallel):
+            y += evaluate(candidates[start:start + n_parallel], trial, **fidelity)
+            trial += n_parallel
+
+        ranking = sorted(range(len(candidates)), key=lambda i: y[i])
+        if remaining:
+            n_keep = max(1, int(math.ceil(len(candidates) / float(eta))))
+            candidates = [candidates[i] for i in ranking[:n_keep]]
+
+    result = create_result([candidates[i] for i in ranking], [y[i] for i in ranking], space)
+    # CheckpointSaver/skopt.dump expect the specs gp_minimize records
+    result.specs = {'args': {'n_candidates': n_candidates, 'eta': eta}, 'function': 'successive_halving'}
+    return result
+
 #execute:
 if __name__ == '__main__':
     main()
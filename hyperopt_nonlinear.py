@@ -5,6 +5,9 @@
 nifti location for testing: /home/groups/brainmri/infant/EXITO/unprocessed/niftis/*
 test registration of T1w and T2w (.nii.gz files)
 
+--mode halving searches with hyperopt.successive_halving: early rungs score many candidates on few
+subjects with the finest levels of every stage's pyramid (Rigid, Affine and SyN) dropped, only the
+survivors are registered in full.
 '''
 
 import argparse
@@ -18,13 +21,17 @@ import skopt
 import nipype.pipeline.engine as pe
 from nipype.interfaces import ants, utility
 from skopt.space import Integer, Real, Categorical
-from skopt.utils import use_named_args
 from skopt.callbacks import CheckpointSaver
 
+import similarity
+from hyperopt import successive_halving
+
 def main():
     parser = generate_parser()
 
     args = parser.parse_args()
+    if args.eta < 2:
+        parser.error('--eta must be at least 2')
     path = args.path
     njobs = args.njobs
     ncalls = args.ncalls
@@ -35,7 +42,8 @@ def main():
     # truncate
     paired_image_list = paired_image_list[:20]
 
-    optimize(os.path.join(path, 'optimize'), paired_image_list=paired_image_list, n_jobs=njobs, n_calls=ncalls)
+    optimize(os.path.join(path, 'optimize'), paired_image_list=paired_image_list, n_jobs=njobs, n_calls=ncalls,
+             mode=args.mode, eta=args.eta)
 
 
 def generate_parser():
@@ -44,6 +52,10 @@ def generate_parser():
     parser.add_argument('path', help='path to T1w and T2w images')
     parser.add_argument('--njobs', default=1, type=int, help='number of cpus to utilize')
     parser.add_argument('--ncalls', default=11, type=int, help='number of calls to fitness function')
+    parser.add_argument('--mode', default='bayes', choices=['bayes', 'halving'],
+                        help='bayes: GP optimisation at full fidelity. halving: successive halving of ncalls '
+                             'random candidates, starting on few subjects and coarse pyramid levels')
+    parser.add_argument('--eta', default=3, type=int, help='halving: keep 1/eta of the candidates per rung (>= 2)')
 
     return parser
 
@@ -57,14 +69,13 @@ def get_images(path):
         T1ws = [f for f in files if 'T1w.nii.gz' in f]
         T2ws = [f for f in files if 'T2w.nii.gz' in f]
         if len(T1ws) and len(T2ws):
-            image_pairs.append( # (os.path.join(root, T1ws[0]),
-                                os.path.join(root, T2ws[0])) # )
+            image_pairs.append((os.path.join(root, T1ws[0]), os.path.join(root, T2ws[0])))
         else:
             print('%s does not have a pair of T1w, T2w' % root)
 
     return image_pairs
 
-def optimize(wd='./optimize', paired_image_list=[], n_jobs=1, n_calls=10):
+def optimize(wd='./optimize', paired_image_list=[], n_jobs=1, n_calls=10, mode='bayes', eta=3):
     if not os.path.exists(wd):
         os.makedirs(wd)
     os.chdir(wd)
@@ -92,19 +103,21 @@ def optimize(wd='./optimize', paired_image_list=[], n_jobs=1, n_calls=10):
         dim_histogram
     ]
 
-    @use_named_args(dimensions=dimensions)
-    def fitness(metric, radius, n_subsamples, mi_bins, histomatching):
-        similarities = np.zeros((len(paired_image_list),))
-        #randint = np.random.randint(100000, 999999, +1)
-        randint = np.array([1000])
-        warped_dir = os.path.join(wd, 'warped{}'.format(randint[0]))
+    def fitness(x, trial, n_subjects=None, drop_levels=0):
+        metric, radius, n_subsamples, mi_bins, histomatching = x
+        image_list = paired_image_list[:n_subjects]
+        warped_dir = os.path.join(wd, 'warped{}'.format(trial))
         #for i, (t1w, t2w) in enumerate(paired_image_list):
-        t1w, t2w = zip(*paired_image_list)
-        similarities = register(warped_dir, t1w, t2w, metric, radius, n_subsamples, mi_bins, histomatching, n_jobs)
+        t1w, t2w = zip(*image_list)
+        similarities = register(warped_dir, t1w, t2w, metric, radius, n_subsamples, mi_bins, histomatching, n_jobs,
+                                drop_levels)
         fitness = np.mean(similarities)
 
+        # low fidelity scores are not comparable with full ones, only those may become best_images
+        full_fidelity = len(image_list) == len(paired_image_list) and drop_levels == 0
+
         global best_fitness
-        if fitness > best_fitness:
+        if full_fidelity and fitness > best_fitness:
             # copy folder of output transforms, maybe with values of metric, radius, etc.
             print('new best fitness score: %s\nprevious: %s' % (fitness, best_fitness))
             if os.path.exists(best_images):
@@ -115,11 +128,18 @@ def optimize(wd='./optimize', paired_image_list=[], n_jobs=1, n_calls=10):
 
         return -fitness
 
-    def register(warped_dir, fixed_images, moving_images, metric, radius, n_subsamples, mi_bins, histomatching, ncpus=1):
+    def register(warped_dir, fixed_images, moving_images, metric, radius, n_subsamples, mi_bins, histomatching, ncpus=1,
+                 drop_levels=0):
         shrink_factors = [2 ** i for i in range(n_subsamples - 1, -1, -1)]
         smoothing_sigmas = list(range(n_subsamples - 1, -1, -1))
         convergence = [100 + i for i in shrink_factors]
 
+        # low fidelity: stop every stage's pyramid before its finest levels
+        n_levels = max(1, n_subsamples - drop_levels)
+        shrink_factors = shrink_factors[:n_levels]
+        smoothing_sigmas = smoothing_sigmas[:n_levels]
+        convergence = convergence[:n_levels]
+
         #save all warped output images to a folder and save them w/ subject id
         #file_basename = os.path.basename(fixed_image)
         #split_text1 = os.path.splitext(file_basename)
@@ -139,23 +159,22 @@ def optimize(wd='./optimize', paired_image_list=[], n_jobs=1, n_calls=10):
             output_transform_prefix="output_",
             interpolation='BSpline',
             transforms=['Rigid', 'Affine', 'SyN'],
-            transform_parameters=[(0.1,), (2.0), (0.25, 3.0, 0.0)],
-            shrink_factors=[shrink_factorsRigid, shrink_factorsAff, shrink_factorsSyN],
-            smoothing_sigmas=[smoothing_sigmasRigid, smoothing_sigmasAff, smoothing_sigmasSyN],
-            sigma_units=['vox'],
-            sampling_percentage=[0.05],
-            sampling_strategy=['Random'],
-            number_of_iterations=[convergenceRigid, convergenceAff, convergenceSyN],
-            metric=[metricRig, metricAff, metricSyN],
-            radius_or_number_of_bins=[radiusR, radiusA, radiusS],
+            transform_parameters=[(0.1,), (2.0,), (0.25, 3.0, 0.0)],
+            # the linear stages run MI, the searched metric drives SyN
+            shrink_factors=[shrink_factors] * 3,
+            smoothing_sigmas=[smoothing_sigmas] * 3,
+            sigma_units=['vox'] * 3,
+            sampling_percentage=[0.05, 0.05, None],
+            sampling_strategy=['Random', 'Random', 'None'],
+            number_of_iterations=[convergence] * 3,
+            metric=['MI', 'MI', metric],
+            radius_or_number_of_bins=[mi_bins, mi_bins, mi_bins if metric == 'MI' else radius],
             winsorize_lower_quantile=0.05,
             winsorize_upper_quantile=0.95,  # clips high and low intensity data
             verbose=True,
-            use_histogram_matching=[histomatchingR,histomatchingA, histomatchingS]
+            use_histogram_matching=[histomatching] * 3
         ),
         name='calc_registration')
-        if metric == 'MI':
-            reg.inputs.radius_or_number_of_bins = [mi_bins]
 
         applytransforms = pe.Node(
             ants.ApplyTransforms(
@@ -164,14 +183,6 @@ def optimize(wd='./optimize', paired_image_list=[], n_jobs=1, n_calls=10):
                 name='apply_warpfield'
         )
 
-        # Image similarity
-        sim = pe.Node(ants.MeasureImageSimilarity(), name='calc_similarity')
-        # assign attribute values to sim:
-        sim.inputs.dimension = 3
-        sim.inputs.metric = # 'MI'   use either CC or maybe MSE?
-        sim.inputs.radius_or_number_of_bins = 32
-        sim.inputs.sampling_percentage = 1.0
-
         merge = pe.JoinNode(
             utility.Merge(1, ravel_inputs=True),
             joinsource='inputs',
@@ -182,28 +193,38 @@ def optimize(wd='./optimize', paired_image_list=[], n_jobs=1, n_calls=10):
         wf = pe.Workflow(name='wf', base_dir=warped_dir)
         wf.connect(
             [(inputs, reg, [('fixed_image', 'fixed_image'), ('moving_image', 'moving_image')]),
-             (inputs, applytransforms, [('fixed_image', 'reference_image'), ('moving_image', 'input_image')]),
-             (inputs, sim, [('fixed_image', 'fixed_image')])
+             (inputs, applytransforms, [('fixed_image', 'reference_image'), ('moving_image', 'input_image')])
              ]
         )
         wf.connect(reg, 'forward_transforms', applytransforms, 'transforms')
-        wf.connect(applytransforms, 'output_image', sim, 'moving_image')
-        wf.connect(sim, 'similarity', merge, 'in1')
+        wf.connect(applytransforms, 'output_image', merge, 'in1')
         wf.config['execution']['parameterize_dirs'] = False
 
         wf.write_graph()
         output = wf.run(plugin='MultiProc', plugin_args={'n_procs' : ncpus})
 
         out_nodes = [n.name for n in output.nodes]
-        similarities = list(output.nodes)[(out_nodes.index('merge'))].result.outputs.out
-        # similarities = list(output.nodes)[0].result.outputs.out
-        return similarities
+        warped_images = list(output.nodes)[(out_nodes.index('merge'))].result.outputs.out
+        # scored in process like hyperopt.py, MI with 32 bins over every voxel, higher is better
+        return [similarity.mutual_information(similarity.load_image(fixed_image), similarity.load_image(warped_image),
+                                              bins=32)
+                for fixed_image, warped_image in zip(fixed_images, warped_images)]
 
     checkpoint_callback = CheckpointSaver('./result2.pkl', store_objective=False)
 
+    if mode == 'halving':
+        def evaluate(batch, first_trial, **fidelity):
+            return [fitness(x, first_trial + i, **fidelity) for i, x in enumerate(batch)]
+
+        search_result = successive_halving(evaluate, dimensions, x0, len(paired_image_list), n_candidates=n_calls,
+                                           eta=eta)
+        checkpoint_callback(search_result)
+        print(search_result.x)
+        return
+
     search_result = skopt.gp_minimize(
-        func=fitness, dimensions=dimensions, acq_func='EI', n_calls=n_calls, n_jobs=1, callback=[checkpoint_callback],
-        x0=x0
+        func=lambda x: fitness(x, 1000), dimensions=dimensions, acq_func='EI', n_calls=n_calls, n_jobs=1,
+        callback=[checkpoint_callback], x0=x0
     )
 
     print(search_result.x)
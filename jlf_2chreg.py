@@ -14,6 +14,16 @@ import random
 import nipype.pipeline.engine as pe
 from nipype.interfaces import ants, utility
 
+from compress import Compress, with_output_type
+from moments import MomentsInitializer
+from preprocess import PreprocessPair
+from resources import (image_voxels, max_voxels, threads_per_task, registration_resources, warp_resources,
+                       fusion_resources, plugin_args)
+from template_store import uncompressed_all, DEFAULT_STORE_DIR
+from transform_cache import CachedRegistration, DEFAULT_CACHE_DIR
+from warp import WarpAtlas
+from joint_fusion import ConsensusMask, FillConsensus
+
 
 def main():
     parser = generate_parser()
@@ -24,6 +34,9 @@ def main():
     jlf_folder = args.joint_fusion_folder
     subid = args.subject_id
     njobs = args.njobs
+    cache_dir = args.cachedir
+    output_type = args.intermediate_type
+    store_dir = args.storedir
 
     pattern = os.path.join(jlf_folder, 'Template*')
     template_list = glob(pattern)
@@ -36,6 +49,10 @@ def main():
     for i in template_list:
         atlas_segmentations.append(os.path.join(i, "Segmentation.nii.gz"))
 
+    # every registration and warp reads the templates, inflate them once
+    atlas_images = uncompressed_all(atlas_images, store_dir)
+    atlas_segmentations = uncompressed_all(atlas_segmentations, store_dir)
+
     #randint = random.randint(1,100)
     warped_dir = os.path.join('./jlf_2chreg_dir', 'jlf{}'.format(subid))
 
@@ -46,7 +63,8 @@ def main():
     #make list of subject T1w and T2w
     subject_Tws = [subject_T1w, subject_T2w]
 
-    register(warped_dir, subject_Tws, atlas_images, atlas_segmentations, n_jobs=njobs)
+    register(warped_dir, subject_Tws, atlas_images, atlas_segmentations, n_jobs=njobs, cache_dir=cache_dir,
+             output_type=output_type)
 
 def generate_parser():
     parser = argparse.ArgumentParser(description='non-linear registration from Brown')
@@ -56,10 +74,17 @@ def generate_parser():
     parser.add_argument('joint_fusion_folder', help='path to joint label fusion atlas directory')
     parser.add_argument('subject_id', help='subject id')
     parser.add_argument('--njobs', default=1, type=int, help='number of cpus to utilize')
+    parser.add_argument('--cachedir', default=DEFAULT_CACHE_DIR,
+                        help='transform store shared by all registration pipelines')
+    parser.add_argument('--storedir', default=DEFAULT_STORE_DIR,
+                        help='node-local directory atlases are decoded to once (default: /dev/shm)')
+    parser.add_argument('--intermediate_type', default='NIFTI', choices=['NIFTI', 'NIFTI_GZ'],
+                        help='format of the files passed between nodes, final outputs are always .nii.gz')
 
     return parser
 
-def register(warped_dir, subject_Tws, atlas_images, atlas_segmentations, n_jobs):
+def register(warped_dir, subject_Tws, atlas_images, atlas_segmentations, n_jobs, cache_dir=DEFAULT_CACHE_DIR,
+             output_type='NIFTI'):
 
     #create list for subject T1w and T2w because Nipype requires inputs to be in list format specifically fr JLF node
     sub_T1w_list = []
@@ -89,8 +114,23 @@ def register(warped_dir, subject_Tws, atlas_images, atlas_segmentations, n_jobs)
     MI - option 32x16000: 32 bins, 16000 samples
     '''
 
+    # scheduling estimates: one registration per atlas shares the cpus
+    subject_voxels = image_voxels(subject_Tws[0])
+    atlas_voxels = max_voxels(atlas_images)
+    pair_threads = threads_per_task(n_jobs, len(atlas_images))
+
+    # start the affine from aligned centres of mass and principal axes instead of identity
+    moments = pe.Node(
+        MomentsInitializer(),
+        name='init_moments')
+
+    # histogram matching to the T1w (the channel the metrics read) once per atlas, not in every ANTs stage
+    preprocess = pe.Node(
+        PreprocessPair(histogram_matching=True, cache_dir=cache_dir),
+        name='preprocess')
+
     reg = pe.Node(
-        ants.Registration(
+        CachedRegistration(
             dimension=3,
             output_transform_prefix="output_",
             #interpolation='BSpline',
@@ -108,23 +148,25 @@ def register(warped_dir, subject_Tws, atlas_images, atlas_segmentations, n_jobs)
             #winsorize_lower_quantile=0.05,
             #winsorize_upper_quantile=0.95,
             verbose=True,
-            use_histogram_matching=[True, True]
+            use_histogram_matching=[False, False],
+            cache_dir=cache_dir
         ),
-        name='calc_registration')
-
-    applytransforms_atlas = pe.Node(
-        ants.ApplyTransforms(
-            interpolation='BSpline',
-            dimension=3,
-        ),
-        name='apply_warpfield_atlas')
-
-    applytransforms_segs = pe.Node(
-        ants.ApplyTransforms(
-            interpolation='NearestNeighbor',
-            dimension=3
-        ),
-        name='apply_warpfield_segs')
+        name='calc_registration',
+        **registration_resources(subject_voxels, atlas_voxels, ['Affine', 'SyN'], pair_threads))
+
+    # compose the affine + SyN chain once, then resample atlas (BSpline) and labels (NearestNeighbor) together
+    applytransforms = pe.Node(
+        WarpAtlas(output_type=output_type),
+        name='apply_warpfield',
+        **warp_resources(subject_voxels, atlas_voxels, 2, pair_threads))
+
+    # only fuse where the warped segmentations disagree, grown by the search radius
+    consensus = pe.JoinNode(
+        ConsensusMask(dilation_radius=[3, 3, 3], output_type=output_type),
+        joinsource='input_spec',
+        joinfield=['atlas_segmentation_image'],
+        name='consensus_mask'
+    )
 
     jointlabelfusion = pe.JoinNode(
         ants.AntsJointFusion(
@@ -133,29 +175,47 @@ def register(warped_dir, subject_Tws, atlas_images, atlas_segmentations, n_jobs)
             beta=2.0,
             patch_radius=[2, 2, 2],
             search_radius=[3, 3, 3],
-            out_label_fusion = 'out_label_fusion.nii.gz',
+            out_label_fusion = with_output_type('out_label_fusion.nii.gz', output_type),
         ),
         joinsource='input_spec',
         joinfield=['atlas_image', 'atlas_segmentation_image'],
-        name='joint_label_fusion'
+        name='joint_label_fusion',
+        **fusion_resources(subject_voxels, len(atlas_images), n_jobs)
     )
 
-    wf = pe.Workflow(name='wf', base_dir=warped_dir)
+    fill = pe.Node(
+        FillConsensus(output_type=output_type),
+        name='fill_consensus')
 
-    wf.connect(input_spec, 'subject_dual_Tws', reg, 'fixed_image')
-    wf.connect(input_spec, 'atlas_image', reg, 'moving_image')
+    compress = pe.Node(
+        Compress(out_file='out_label_fusion.nii.gz', num_threads=n_jobs),
+        name='compress_labels')
 
-    wf.connect(reg, 'forward_transforms', applytransforms_atlas, 'transforms')
-    wf.connect(input_spec, 'atlas_image', applytransforms_atlas, 'input_image')
-    wf.connect(input_spec, 'subject_Txw', applytransforms_atlas, 'reference_image')
+    wf = pe.Workflow(name='wf', base_dir=warped_dir)
 
-    wf.connect(reg, 'forward_transforms', applytransforms_segs, 'transforms')
-    wf.connect(input_spec, 'atlas_segmentation', applytransforms_segs, 'input_image')
-    wf.connect(input_spec, 'subject_Txw', applytransforms_segs, 'reference_image')
+    wf.connect(input_spec, 'subject_dual_Tws', reg, 'fixed_image')
+    wf.connect(input_spec, 'atlas_image', preprocess, 'moving_image')
+    wf.connect(input_spec, 'subject_Txw', preprocess, 'fixed_image')
+    wf.connect(preprocess, 'moving_image', reg, 'moving_image')
+    wf.connect(input_spec, 'subject_Txw', moments, 'fixed_image')
+    wf.connect(input_spec, 'atlas_image', moments, 'moving_image')
+    wf.connect(moments, 'out_transform', reg, 'initial_moving_transform')
+
+    wf.connect(reg, 'forward_transforms', applytransforms, 'transforms')
+    wf.connect(input_spec, 'atlas_image', applytransforms, 'atlas_image')
+    wf.connect(input_spec, 'atlas_segmentation', applytransforms, 'atlas_segmentation')
+    wf.connect(input_spec, 'subject_Txw', applytransforms, 'reference_image')
 
     wf.connect(input_spec, 'subject_Txw_list', jointlabelfusion, 'target_image')
-    wf.connect(applytransforms_atlas, 'output_image', jointlabelfusion, 'atlas_image')
-    wf.connect(applytransforms_segs, 'output_image', jointlabelfusion, 'atlas_segmentation_image')
+    wf.connect(applytransforms, 'warped_atlas', jointlabelfusion, 'atlas_image')
+    wf.connect(applytransforms, 'warped_segmentation', jointlabelfusion, 'atlas_segmentation_image')
+
+    wf.connect(applytransforms, 'warped_segmentation', consensus, 'atlas_segmentation_image')
+    wf.connect(consensus, 'mask_image', jointlabelfusion, 'mask_image')
+    wf.connect(jointlabelfusion, 'out_label_fusion', fill, 'label_fusion')
+    wf.connect(consensus, 'consensus_image', fill, 'consensus_image')
+    wf.connect(consensus, 'mask_image', fill, 'mask_image')
+    wf.connect(fill, 'out_label_fusion', compress, 'in_file')
 
     wf.config['execution']['parameterize_dirs'] = False
     #wf.config['execution']['remove_unnecessary_outputs'] = False
@@ -165,7 +225,7 @@ def register(warped_dir, subject_Tws, atlas_images, atlas_segmentations, n_jobs)
     wf.write_graph()
 
     #Nipype plugins specify how workflow should be executed
-    output = wf.run(plugin='MultiProc', plugin_args={'n_procs' : n_jobs})
+    output = wf.run(plugin='MultiProc', plugin_args=plugin_args(n_jobs))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
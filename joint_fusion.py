@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# standard lib
+
+'''
+In-process joint label fusion (Wang et al., Multi-Atlas Segmentation with Joint Label Fusion, PAMI 2013).
+
+For every target voxel each warped atlas is searched within search_radius for the patch (patch_radius)
+that correlates best with the target patch. With the normalised (zero mean, unit variance) patch
+differences d_i of the matched patches, the atlas dependency matrix is
+
+    M(i, j) = mean_over_patch(|d_i| * |d_j|) ** beta + alpha * I
+
+and the atlas weights w = M^-1 1 / (1^T M^-1 1) vote for the label each atlas has at its matched location.
+
+Best matches are found with box filters over the whole block (one filter per atlas and search offset),
+the dependency matrices and weights are computed for all voxels of a block at once. The volume is split
+into blocks with a halo of patch_radius + search_radius, the blocks are fused in a process pool.
+Voxels on which every atlas already has the same label can be filled in without fusion.
+
+ConsensusMask and FillConsensus do the same around ants.AntsJointFusion: the voxels where the warped
+segmentations disagree, dilated by the search radius, become its mask_image, and the labels of the
+voxels outside the mask (on which all atlases agree) are filled back in after fusion.
+'''
+
+import os
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+# external libs
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec, TraitedSpec, File, InputMultiPath,
+                                    traits, isdefined)
+
+from compress import with_output_type
+
+
+def _patch_view(array, patch_shape):
+    # read-only view of every patch_shape window, indexed by the window's first voxel
+    shape = tuple(np.subtract(array.shape, patch_shape) + 1) + tuple(patch_shape)
+    return np.lib.stride_tricks.as_strided(array, shape=shape, strides=array.strides * 2, writeable=False)
+
+
+def _normalise(patches):
+    patches = patches - patches.mean(axis=-1, keepdims=True)
+    std = patches.std(axis=-1, keepdims=True)
+    return np.divide(patches, std, out=np.zeros_like(patches), where=std > 0)
+
+
+def fuse_block(target, atlases, segmentations, alpha, beta, patch_radius, search_radius, fuse=None):
+    '''
+    target: halo-padded block, atlases/segmentations: (n_atlases,) + target.shape
+    fuse: bool mask of the block core (target.shape minus the halo), voxels outside it take atlas 0's label
+    returns the fused labels of the block core
+    '''
+    pr = np.asarray(patch_radius)
+    sr = np.asarray(search_radius)
+    halo = pr + sr
+    core_shape = tuple(np.subtract(target.shape, 2 * halo))
+    patch_shape = tuple(2 * pr + 1)
+    n_atlases = len(atlases)
+
+    labels = segmentations[(0,) + tuple(slice(h, h + c) for h, c in zip(halo, core_shape))].copy()
+    if fuse is None:
+        fuse = np.ones(core_shape, dtype=bool)
+    if not fuse.any():
+        return labels
+    voxels = np.nonzero(fuse)
+
+    # target statistics over the core plus patch radius
+    inner = tuple(slice(s, s + c + 2 * p) for s, c, p in zip(sr, core_shape, pr))
+    core = tuple(slice(p, p + c) for p, c in zip(pr, core_shape))
+    t_inner = target[inner]
+    t_mean = ndimage.uniform_filter(t_inner, patch_shape, mode='nearest')[core]
+    t_var = ndimage.uniform_filter(t_inner * t_inner, patch_shape, mode='nearest')[core] - t_mean ** 2
+
+    target_patches = _normalise(_patch_view(t_inner, patch_shape)[voxels].reshape(len(voxels[0]), -1))
+
+    differences = np.empty((n_atlases,) + target_patches.shape, dtype=np.float32)
+    votes = np.empty((n_atlases, len(voxels[0])), dtype=segmentations.dtype)
+    offsets = list(itertools.product(*[range(-r, r + 1) for r in sr]))
+    for i in range(n_atlases):
+        atlas = atlases[i]
+        a_mean = ndimage.uniform_filter(atlas, patch_shape, mode='nearest')
+        a_var = ndimage.uniform_filter(atlas * atlas, patch_shape, mode='nearest') - a_mean ** 2
+
+        best = np.full(core_shape, -np.inf, dtype=np.float32)
+        best_offset = np.zeros((3,) + core_shape, dtype=np.intp)
+        for offset in offsets:
+            shifted = tuple(slice(s + o, s + o + c + 2 * p) for s, o, c, p in zip(sr, offset, core_shape, pr))
+            centre = tuple(slice(h + o, h + o + c) for h, o, c in zip(halo, offset, core_shape))
+            cross = ndimage.uniform_filter(t_inner * atlas[shifted], patch_shape, mode='nearest')[core]
+            # patch correlation, maximising it minimises the normalised patch SSD
+            denominator = np.sqrt(np.maximum(t_var * a_var[centre], 1e-12))
+            correlation = (cross - t_mean * a_mean[centre]) / denominator
+            better = correlation > best
+            best[better] = correlation[better]
+            best_offset[:, better] = np.reshape(offset, (3, 1))
+
+        offset = best_offset[(slice(None),) + voxels]
+        starts = tuple(sr[axis] + voxels[axis] + offset[axis] for axis in range(3))
+        atlas_patches = _normalise(_patch_view(atlas, patch_shape)[starts].reshape(len(voxels[0]), -1))
+        differences[i] = np.abs(atlas_patches - target_patches)
+        votes[i] = segmentations[i][tuple(s + pr[axis] for axis, s in enumerate(starts))]
+
+    dependency = np.einsum('ivp,jvp->vij', differences, differences) / differences.shape[-1]
+    dependency = dependency ** beta + alpha * np.eye(n_atlases)
+    weights = np.linalg.solve(dependency, np.ones((len(voxels[0]), n_atlases, 1)))[..., 0]
+    weights /= weights.sum(axis=1, keepdims=True)
+
+    candidates = np.unique(votes)
+    posteriors = np.stack([np.sum(weights * (votes == label).T, axis=1) for label in candidates])
+    labels[voxels] = candidates[np.argmax(posteriors, axis=0)]
+    return labels
+
+
+def _fuse_block(args):
+    return args[0], fuse_block(*args[1:])
+
+
+def joint_label_fusion(target, atlases, segmentations, alpha=0.1, beta=2.0, patch_radius=(2, 2, 2),
+                       search_radius=(3, 3, 3), block_size=32, n_procs=1, skip_consensus=True, mask=None):
+    '''
+    target: 3D array, atlases/segmentations: sequences of 3D arrays on the target grid
+    mask: only fuse inside mask, elsewhere take the first atlas' label
+    '''
+    target = np.asarray(target, dtype=np.float32)
+    atlases = np.stack([np.asarray(a, dtype=np.float32) for a in atlases])
+    segmentations = np.stack([np.asarray(s) for s in segmentations])
+    halo = np.add(patch_radius, search_radius)
+
+    # a copy: the caller's mask is not narrowed by the consensus test below
+    fuse = np.ones(target.shape, dtype=bool) if mask is None else np.array(mask, dtype=bool)
+    if skip_consensus:
+        fuse &= np.any(segmentations != segmentations[0], axis=0)
+
+    # pad once so every block, including those on the border, has a full halo
+    padding = [(h, h) for h in halo]
+    target_padded = np.pad(target, padding, mode='edge')
+    atlases_padded = np.pad(atlases, [(0, 0)] + padding, mode='edge')
+    segmentations_padded = np.pad(segmentations, [(0, 0)] + padding, mode='edge')
+
+    labels = segmentations[0].copy()
+    blocks = []
+    for start in itertools.product(*[range(0, n, block_size) for n in target.shape]):
+        core = tuple(slice(s, min(s + block_size, n)) for s, n in zip(start, target.shape))
+        if not fuse[core].any():
+            continue
+        padded = tuple(slice(c.start, c.stop + 2 * h) for c, h in zip(core, halo))
+        blocks.append((core, target_padded[padded], atlases_padded[(slice(None),) + padded],
+                       segmentations_padded[(slice(None),) + padded], alpha, beta, patch_radius, search_radius,
+                       fuse[core]))
+
+    if n_procs > 1:
+        with ProcessPoolExecutor(max_workers=n_procs) as executor:
+            results = list(executor.map(_fuse_block, blocks))
+    else:
+        results = [_fuse_block(block) for block in blocks]
+    for core, block_labels in results:
+        labels[core] = block_labels
+
+    return labels
+
+
+def disagreement_mask(segmentation_files, radius=(3, 3, 3)):
+    '''
+    voxels where the segmentations do not all carry the same label, dilated by radius (voxels per axis)
+    returns (mask, labels of the first segmentation), the segmentations are read one at a time
+    '''
+    labels = np.asarray(nib.load(segmentation_files[0]).dataobj)
+    disagree = np.zeros(labels.shape, dtype=bool)
+    for f in segmentation_files[1:]:
+        disagree |= np.asarray(nib.load(f).dataobj) != labels
+    structure = np.ones(tuple(2 * np.asarray(radius) + 1), dtype=bool)
+    return ndimage.binary_dilation(disagree, structure=structure), labels
+
+
+def _save(data, reference, out_file):
+    out = nib.Nifti1Image(data, reference.affine, reference.header)
+    out.set_data_dtype(data.dtype)
+    nib.save(out, out_file)
+    return os.path.abspath(out_file)
+
+
+class ConsensusMaskInputSpec(BaseInterfaceInputSpec):
+    atlas_segmentation_image = InputMultiPath(File(exists=True), mandatory=True, desc='warped atlas segmentations')
+    dilation_radius = traits.List(traits.Int, [3, 3, 3], usedefault=True, minlen=3, maxlen=3,
+                                  desc='grow the disagreement by this many voxels, the JLF search radius')
+    mask_image = traits.Str('disagreement_mask.nii.gz', usedefault=True)
+    consensus_image = traits.Str('consensus_labels.nii.gz', usedefault=True)
+    output_type = traits.Enum('NIFTI_GZ', 'NIFTI', usedefault=True, desc='format of the outputs')
+
+
+class ConsensusMaskOutputSpec(TraitedSpec):
+    mask_image = File(exists=True, desc='voxels that need fusion')
+    consensus_image = File(exists=True, desc='labels all atlases agree on outside mask_image, 0 inside')
+
+
+class ConsensusMask(BaseInterface):
+    '''mask of the voxels joint label fusion has to decide, and the labels of all the others'''
+
+    input_spec = ConsensusMaskInputSpec
+    output_spec = ConsensusMaskOutputSpec
+
+    def _run_interface(self, runtime):
+        reference = nib.load(self.inputs.atlas_segmentation_image[0])
+        mask, labels = disagreement_mask(self.inputs.atlas_segmentation_image, self.inputs.dilation_radius)
+        labels[mask] = 0
+        print('fusing %d of %d voxels (%.1f%%)' % (mask.sum(), mask.size, 100.0 * mask.mean()))
+
+        outputs = self._list_outputs()
+        _save(mask.astype(np.uint8), reference, outputs['mask_image'])
+        _save(labels, reference, outputs['consensus_image'])
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['mask_image'] = os.path.abspath(with_output_type(self.inputs.mask_image, self.inputs.output_type))
+        outputs['consensus_image'] = os.path.abspath(with_output_type(self.inputs.consensus_image,
+                                                                      self.inputs.output_type))
+        return outputs
+
+
+class FillConsensusInputSpec(BaseInterfaceInputSpec):
+    label_fusion = File(exists=True, mandatory=True, desc='fused labels, only valid inside mask_image')
+    consensus_image = File(exists=True, mandatory=True)
+    mask_image = File(exists=True, mandatory=True)
+    out_label_fusion = traits.Str('out_label_fusion.nii.gz', usedefault=True)
+    output_type = traits.Enum('NIFTI_GZ', 'NIFTI', usedefault=True, desc='format of out_label_fusion')
+
+
+class FillConsensusOutputSpec(TraitedSpec):
+    out_label_fusion = File(exists=True)
+
+
+class FillConsensus(BaseInterface):
+    '''fused labels inside the disagreement mask, consensus labels everywhere else'''
+
+    input_spec = FillConsensusInputSpec
+    output_spec = FillConsensusOutputSpec
+
+    def _run_interface(self, runtime):
+        consensus = nib.load(self.inputs.consensus_image)
+        labels = np.asarray(consensus.dataobj)
+        mask = np.asarray(nib.load(self.inputs.mask_image).dataobj) > 0
+        fused = np.asarray(nib.load(self.inputs.label_fusion).dataobj)
+        labels[mask] = fused[mask]
+        _save(labels, consensus, self._list_outputs()['out_label_fusion'])
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_label_fusion'] = os.path.abspath(with_output_type(self.inputs.out_label_fusion,
+                                                                       self.inputs.output_type))
+        return outputs
+
+
+class JointFusionNativeInputSpec(BaseInterfaceInputSpec):
+    target_image = InputMultiPath(File(exists=True), mandatory=True, desc='target image, only the first is used')
+    atlas_image = InputMultiPath(File(exists=True), mandatory=True, desc='warped atlas images')
+    atlas_segmentation_image = InputMultiPath(File(exists=True), mandatory=True, desc='warped atlas segmentations')
+    mask_image = File(exists=True, desc='only fuse inside this mask')
+    alpha = traits.Float(0.1, usedefault=True, desc='regularisation of the dependency matrix')
+    beta = traits.Float(2.0, usedefault=True, desc='exponent of the patch differences')
+    patch_radius = traits.List(traits.Int, [2, 2, 2], usedefault=True, minlen=3, maxlen=3)
+    search_radius = traits.List(traits.Int, [3, 3, 3], usedefault=True, minlen=3, maxlen=3)
+    skip_consensus = traits.Bool(True, usedefault=True, desc='copy labels all atlases agree on without fusing')
+    block_size = traits.Int(32, usedefault=True, desc='edge length of the blocks fused in parallel')
+    num_threads = traits.Int(1, usedefault=True, desc='number of processes fusing blocks')
+    out_label_fusion = traits.Str('out_label_fusion.nii.gz', usedefault=True)
+    output_type = traits.Enum('NIFTI_GZ', 'NIFTI', usedefault=True, desc='format of out_label_fusion')
+
+
+class JointFusionNativeOutputSpec(TraitedSpec):
+    out_label_fusion = File(exists=True)
+
+
+class JointFusionNative(BaseInterface):
+    '''drop-in for ants.AntsJointFusion (label fusion output only) that runs in process'''
+
+    input_spec = JointFusionNativeInputSpec
+    output_spec = JointFusionNativeOutputSpec
+
+    def _run_interface(self, runtime):
+        target = nib.load(self.inputs.target_image[0])
+        mask = None
+        if isdefined(self.inputs.mask_image):
+            mask = np.asarray(nib.load(self.inputs.mask_image).dataobj) > 0
+
+        labels = joint_label_fusion(
+            np.asarray(target.dataobj, dtype=np.float32),
+            [np.asarray(nib.load(f).dataobj, dtype=np.float32) for f in self.inputs.atlas_image],
+            [np.asarray(nib.load(f).dataobj) for f in self.inputs.atlas_segmentation_image],
+            alpha=self.inputs.alpha, beta=self.inputs.beta, patch_radius=self.inputs.patch_radius,
+            search_radius=self.inputs.search_radius, block_size=self.inputs.block_size,
+            n_procs=self.inputs.num_threads, skip_consensus=self.inputs.skip_consensus, mask=mask)
+
+        _save(labels, target, self._list_outputs()['out_label_fusion'])
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_label_fusion'] = os.path.abspath(with_output_type(self.inputs.out_label_fusion,
+                                                                       self.inputs.output_type))
+        return outputs
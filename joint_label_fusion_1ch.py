@@ -24,6 +24,18 @@ import random
 import nipype.pipeline.engine as pe
 from nipype.interfaces import ants, utility
 
+from atlas_selection import select_atlases
+from compress import Compress, with_output_type
+from crop import Crop, Uncrop
+from moments import MomentsInitializer
+from preprocess import PreprocessPair
+from resources import (max_voxels, threads_per_task, registration_resources, warp_resources,
+                       fusion_resources, plugin_args)
+from joint_fusion import JointFusionNative, ConsensusMask, FillConsensus
+from template_store import uncompressed_all, DEFAULT_STORE_DIR
+from transform_cache import CachedRegistration, DEFAULT_CACHE_DIR
+from warp import WarpAtlas
+
 
 def main():
     parser = generate_parser()
@@ -32,6 +44,12 @@ def main():
     jlf_folder = args.joint_fusion_folder
     subjectid = args.subjectid
     njobs = args.njobs
+    cache_dir = args.cachedir
+    store_dir = args.storedir
+    n_atlases = args.natlases
+    selection_metric = args.selection_metric
+    fusion = args.fusion
+    output_type = args.intermediate_type
 
     pattern = os.path.join(jlf_folder, 'Template*')
     template_list = glob(pattern)
@@ -44,17 +62,27 @@ def main():
     for i in template_list:
         atlas_segmentations.append(os.path.join(i, "Segmentation.nii.gz"))
 
+    # every registration and warp reads the templates, inflate them once
+    atlas_images = uncompressed_all(atlas_images, store_dir)
+    atlas_segmentations = uncompressed_all(atlas_segmentations, store_dir)
+
 
     #randint = random.randint(1,100)
     warped_dir = os.path.join('./jlf_dir', 'jlf{}'.format(subjectid))
 
+    # rank templates on a cheap affine alignment, only the best go on to SyN and fusion
+    atlas_images, atlas_segmentations = select_atlases(warped_dir, subject_image, atlas_images, atlas_segmentations,
+                                                       n_atlases, metric=selection_metric, n_jobs=njobs,
+                                                       cache_dir=cache_dir, output_type=output_type)
+
     # subject T1w brain image
     #subject_T1w = os.path.join(subject_dir, 'T1w_acpc_dc_restore_brain.nii.gz')
     #subject_T2w = os.path.join(subject_dir, 'T2w_acpc_dc_restore_brain.nii.gz')
 
     #subject_Tws = [subject_T1w, subject_T2w]
 
-    register(warped_dir, subject_image, atlas_images, atlas_segmentations, n_jobs=njobs)
+    register(warped_dir, subject_image, atlas_images, atlas_segmentations, n_jobs=njobs, cache_dir=cache_dir,
+             fusion=fusion, output_type=output_type)
 
 
 def generate_parser():
@@ -64,24 +92,64 @@ def generate_parser():
     parser.add_argument('joint_fusion_folder', help='path to joint label fusion atlas directory')
     parser.add_argument('subjectid', help='whatever name you want for subfolder')
     parser.add_argument('--njobs', default=1, type=int, help='number of cpus to utilize')
+    parser.add_argument('--cachedir', default=DEFAULT_CACHE_DIR,
+                        help='transform store shared by all registration pipelines')
+    parser.add_argument('--storedir', default=DEFAULT_STORE_DIR,
+                        help='node-local directory atlases are decoded to once (default: /dev/shm)')
+    parser.add_argument('--natlases', default=None, type=int,
+                        help='only register and fuse the n most similar templates (default: all)')
+    parser.add_argument('--selection_metric', default='MI', choices=['MI', 'NCC'],
+                        help='similarity used to rank templates for --natlases')
+    parser.add_argument('--fusion', default='ants', choices=['ants', 'native'],
+                        help='ants: AntsJointFusion. native: in-process block-parallel fusion on --njobs cpus')
+    parser.add_argument('--intermediate_type', default='NIFTI', choices=['NIFTI', 'NIFTI_GZ'],
+                        help='format of the files passed between nodes, final outputs are always .nii.gz')
 
     return parser
 
 
-def register(warped_dir, subject_T1w, atlas_images, atlas_segmentations, n_jobs):
-    sub_Tw1_list = []
-    sub_Tw1_list.append(subject_T1w)
+def register(warped_dir, subject_T1w, atlas_images, atlas_segmentations, n_jobs, cache_dir=DEFAULT_CACHE_DIR,
+             fusion='ants', output_type='NIFTI'):
+    wf = create_workflow(atlas_images, atlas_segmentations, n_jobs, cache_dir=cache_dir, fusion=fusion,
+                         output_type=output_type)
+    wf.base_dir = warped_dir
+
+    # set subject_spec
+    wf.get_node('subject_spec').inputs.subject_image = subject_T1w
+
+    wf.config['execution']['parameterize_dirs'] = False
+
+    wf.write_graph()
+    output = wf.run(plugin='MultiProc', plugin_args=plugin_args(n_jobs))
+
+
+def create_workflow(atlas_images, atlas_segmentations, n_jobs, cache_dir=DEFAULT_CACHE_DIR, fusion='ants',
+                    output_type='NIFTI', n_subjects=1, reference_voxels=None, name='wf'):
+    '''
+    registration, warping and fusion of every atlas for one subject; set subject_spec.subject_image, or
+    connect it when the workflow is nested in a cohort workflow
+    registration and fusion run on the brain bounding box, intermediates are written as output_type,
+    the fused labels on the subject grid are compress_labels.out_file (.nii.gz)
+    n_subjects, reference_voxels (largest subject image, default largest template): scheduling estimates
+    '''
+    atlas_voxels = max_voxels(atlas_images)
+    reference_voxels = reference_voxels or atlas_voxels
+    # every subject/atlas pair is registered and warped independently
+    pair_threads = threads_per_task(n_jobs, n_subjects * len(atlas_images))
+
+    # outside the atlas iterables, so the subject is cropped once
+    subject_spec = pe.Node(
+        utility.IdentityInterface(fields=['subject_image']),
+        name='subject_spec'
+    )
 
     input_spec = pe.Node(
         utility.IdentityInterface(
-            fields=['subject_image', 'sub_image_list', 'atlas_image', 'atlas_segmentation']),
+            fields=['atlas_image', 'atlas_segmentation']),
         iterables=[('atlas_image', atlas_images), ('atlas_segmentation', atlas_segmentations)],
         synchronize=True,
         name='input_spec'
     )
-    # set input_spec
-    input_spec.inputs.subject_image = subject_T1w
-    input_spec.inputs.sub_image_list = sub_Tw1_list  # need to do this bc JLF requires target image to be a list
 
     '''
     CC[x, x, 1, 8]: [fixed, moving, weight, radius]
@@ -93,8 +161,31 @@ def register(warped_dir, subject_T1w, atlas_images, atlas_segmentations, n_jobs)
     MI - option 32x16000: 32 bins, 16000 samples
     '''
 
+    # start the affine from aligned centres of mass and principal axes instead of identity
+    moments = pe.Node(
+        MomentsInitializer(),
+        name='init_moments')
+
+    crop_subject = pe.Node(
+        Crop(output_type=output_type),
+        name='crop_subject')
+
+    crop_atlas = pe.Node(
+        Crop(output_type=output_type),
+        name='crop_atlas')
+
+    # JLF requires target image to be a list
+    target_list = pe.Node(
+        utility.Merge(1),
+        name='target_list')
+
+    # histogram matching once per cropped atlas/subject pair, not in every ANTs stage
+    preprocess = pe.Node(
+        PreprocessPair(histogram_matching=True, cache_dir=cache_dir),
+        name='preprocess')
+
     reg = pe.Node(
-        ants.Registration(
+        CachedRegistration(
             dimension=3,
             output_transform_prefix="output_",
             collapse_output_transforms = False,
@@ -113,59 +204,99 @@ def register(warped_dir, subject_T1w, atlas_images, atlas_segmentations, n_jobs)
             # winsorize_lower_quantile=0.05,
             # winsorize_upper_quantile=0.95,
             verbose=True,
-            use_histogram_matching=[True, True]
-        ),
-        name='calc_registration')
-
-    applytransforms_atlas = pe.Node(
-        ants.ApplyTransforms(
-            interpolation='BSpline',
-            dimension=3,
-        ),
-        name='apply_warpfield_atlas')
-
-    applytransforms_segs = pe.Node(
-        ants.ApplyTransforms(
-            interpolation='NearestNeighbor',
-            dimension=3
+            use_histogram_matching=[False, False],
+            cache_dir=cache_dir
         ),
-        name='apply_warpfield_segs')
-
-    jointlabelfusion = pe.JoinNode(
-        ants.AntsJointFusion(
-            dimension=3,
+        name='calc_registration',
+        **registration_resources(reference_voxels, atlas_voxels, ['Affine', 'SyN'], pair_threads))
+
+    # compose the affine + SyN chain once, then resample atlas (BSpline) and labels (NearestNeighbor) together
+    applytransforms = pe.Node(
+        WarpAtlas(output_type=output_type),
+        name='apply_warpfield',
+        **warp_resources(reference_voxels, atlas_voxels, 2, pair_threads))
+
+    if fusion == 'native':
+        # same weighting, blocks fused in parallel and consensus voxels skipped
+        jlf_interface = JointFusionNative(
             alpha=0.1,
             beta=2.0,
             patch_radius=[2, 2, 2],
             search_radius=[3, 3, 3],
             out_label_fusion='out_label_fusion.nii.gz',
-        ),
+            output_type=output_type,
+        )
+    else:
+        jlf_interface = ants.AntsJointFusion(
+            dimension=3,
+            alpha=0.1,
+            beta=2.0,
+            patch_radius=[2, 2, 2],
+            search_radius=[3, 3, 3],
+            out_label_fusion=with_output_type('out_label_fusion.nii.gz', output_type),
+        )
+
+    # only fuse where the warped segmentations disagree, grown by the search radius
+    consensus = pe.JoinNode(
+        ConsensusMask(dilation_radius=[3, 3, 3], output_type=output_type),
         joinsource='input_spec',
-        joinfield=['atlas_image', 'atlas_segmentation_image'],
-        name='joint_label_fusion'
+        joinfield=['atlas_segmentation_image'],
+        name='consensus_mask'
     )
 
-    wf = pe.Workflow(name='wf', base_dir=warped_dir)
-
-    wf.connect(input_spec, 'subject_image', reg, 'fixed_image')
-    wf.connect(input_spec, 'atlas_image', reg, 'moving_image')
-
-    wf.connect(reg, 'forward_transforms', applytransforms_atlas, 'transforms')
-    wf.connect(input_spec, 'atlas_image', applytransforms_atlas, 'input_image')
-    wf.connect(input_spec, 'subject_image', applytransforms_atlas, 'reference_image')
-
-    wf.connect(reg, 'forward_transforms', applytransforms_segs, 'transforms')
-    wf.connect(input_spec, 'atlas_segmentation', applytransforms_segs, 'input_image')
-    wf.connect(input_spec, 'subject_image', applytransforms_segs, 'reference_image')
-
-    wf.connect(input_spec, 'sub_image_list', jointlabelfusion, 'target_image')
-    wf.connect(applytransforms_atlas, 'output_image', jointlabelfusion, 'atlas_image')
-    wf.connect(applytransforms_segs, 'output_image', jointlabelfusion, 'atlas_segmentation_image')
-
-    wf.config['execution']['parameterize_dirs'] = False
+    jointlabelfusion = pe.JoinNode(
+        jlf_interface,
+        joinsource='input_spec',
+        joinfield=['atlas_image', 'atlas_segmentation_image'],
+        name='joint_label_fusion',
+        **fusion_resources(reference_voxels, len(atlas_images), n_jobs)
+    )
 
-    wf.write_graph()
-    output = wf.run(plugin='MultiProc', plugin_args={'n_procs': n_jobs})
+    fill = pe.Node(
+        FillConsensus(output_type=output_type),
+        name='fill_consensus')
+
+    uncrop = pe.Node(
+        Uncrop(output_type=output_type),
+        name='uncrop_labels')
+
+    compress = pe.Node(
+        Compress(out_file='out_label_fusion.nii.gz', num_threads=n_jobs),
+        name='compress_labels')
+
+    wf = pe.Workflow(name=name)
+
+    wf.connect(subject_spec, 'subject_image', crop_subject, 'box_image')
+    wf.connect(input_spec, 'atlas_image', crop_atlas, 'box_image')
+
+    wf.connect(crop_subject, 'out_file', reg, 'fixed_image')
+    wf.connect(crop_atlas, 'out_file', preprocess, 'moving_image')
+    wf.connect(crop_subject, 'out_file', preprocess, 'fixed_image')
+    wf.connect(preprocess, 'moving_image', reg, 'moving_image')
+    wf.connect(subject_spec, 'subject_image', moments, 'fixed_image')
+    wf.connect(input_spec, 'atlas_image', moments, 'moving_image')
+    wf.connect(moments, 'out_transform', reg, 'initial_moving_transform')
+
+    wf.connect(reg, 'forward_transforms', applytransforms, 'transforms')
+    wf.connect(input_spec, 'atlas_image', applytransforms, 'atlas_image')
+    wf.connect(input_spec, 'atlas_segmentation', applytransforms, 'atlas_segmentation')
+    wf.connect(crop_subject, 'out_file', applytransforms, 'reference_image')
+
+    wf.connect(crop_subject, 'out_file', target_list, 'in1')
+    wf.connect(target_list, 'out', jointlabelfusion, 'target_image')
+    wf.connect(applytransforms, 'warped_atlas', jointlabelfusion, 'atlas_image')
+    wf.connect(applytransforms, 'warped_segmentation', jointlabelfusion, 'atlas_segmentation_image')
+
+    wf.connect(applytransforms, 'warped_segmentation', consensus, 'atlas_segmentation_image')
+    wf.connect(consensus, 'mask_image', jointlabelfusion, 'mask_image')
+    wf.connect(jointlabelfusion, 'out_label_fusion', fill, 'label_fusion')
+    wf.connect(consensus, 'consensus_image', fill, 'consensus_image')
+    wf.connect(consensus, 'mask_image', fill, 'mask_image')
+    wf.connect(fill, 'out_label_fusion', uncrop, 'in_file')
+    wf.connect(crop_subject, 'sidecar', uncrop, 'sidecar')
+    wf.connect(uncrop, 'out_file', compress, 'in_file')
+
+    return wf
 
 
 if __name__ == '__main__':
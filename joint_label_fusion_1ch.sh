@@ -16,4 +16,4 @@ JLFFOLDER="$2"
 SUBJECTID="$3"
 NCPUS=$SLURM_CPUS_PER_TASK
 
-python /home/users/moorlu/PycharmProjects/jlf/joint_label_fusion_1ch.py "$T1WIMAGE" "$JLFFOLDER" "$SUBJECTID" --njobs "$NCPUS"
\ No newline at end of file
+python /home/users/moorlu/PycharmProjects/jlf/joint_label_fusion_1ch.py "$T1WIMAGE" "$JLFFOLDER" "$SUBJECTID" --njobs "$NCPUS" "${@:4}"
\ No newline at end of file
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# standard lib
+
+'''
+Per-subject completion ledger, so a restarted cohort run only builds the graph for what is left.
+
+nipype finds out what is done by expanding the iterables of every subject and checking every node's
+hash, which on a few hundred subjects takes longer than some stages. The ledger is a JSONL file with
+one line per finished (subject, stage):
+
+    {"subject": "sub-01", "stage": "nonlinear_reg", "fingerprint": "<sha1>", "outputs": [...], "time": ...}
+
+The fingerprint covers the inputs (path, size and mtime, no hashing of the contents) and the
+settings, so a subject whose images or settings changed is stale and runs again. A subject counts as
+done while its last record carries the current fingerprint and its outputs are still there. The main
+functions drop done subjects before register() sees them; a LedgerRecord node at the end of the
+per-subject branch appends the record when the subject's deliverable is written. Appends take an
+exclusive flock, so concurrent array jobs can share a ledger.
+'''
+
+import fcntl
+import hashlib
+import json
+import os
+import time
+
+# external libs
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec, TraitedSpec, File, InputMultiPath,
+                                    OutputMultiPath, traits)
+
+
+def fingerprint(files, **settings):
+    '''sha1 of the files' paths, sizes and mtimes plus the settings'''
+    stamps = []
+    for path in files:
+        stat = os.stat(path)
+        stamps.append([os.path.abspath(path), stat.st_size, stat.st_mtime])
+    return hashlib.sha1(json.dumps([stamps, settings], sort_keys=True).encode()).hexdigest()
+
+
+def load(ledger_file):
+    '''{(subject, stage): last record}'''
+    records = {}
+    if not os.path.exists(ledger_file):
+        return records
+    with open(ledger_file) as f:
+        fcntl.flock(f, fcntl.LOCK_SH)
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # a line cut short by a killed job
+                continue
+            records[(record['subject'], record['stage'])] = record
+    return records
+
+
+def completed(records, subject, stage, subject_fingerprint):
+    record = records.get((subject, stage))
+    return (record is not None and record['fingerprint'] == subject_fingerprint
+            and all(os.path.exists(p) for p in record['outputs']))
+
+
+def pending(ledger_file, stage, subjects, fingerprints):
+    '''indices of the subjects whose stage is missing or stale'''
+    records = load(ledger_file)
+    return [i for i, (s, f) in enumerate(zip(subjects, fingerprints)) if not completed(records, s, stage, f)]
+
+
+def append(ledger_file, subject, stage, subject_fingerprint, outputs):
+    record = {'subject': subject, 'stage': stage, 'fingerprint': subject_fingerprint,
+              'outputs': [os.path.abspath(p) for p in outputs], 'time': time.time()}
+    os.makedirs(os.path.dirname(os.path.abspath(ledger_file)), exist_ok=True)
+    with open(ledger_file, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        # start a new line after a record cut short by a killed job
+        if f.tell() > 0:
+            f.seek(f.tell() - 1)
+            if f.read(1) != '\n':
+                f.write('\n')
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    return record
+
+
+class LedgerRecordInputSpec(BaseInterfaceInputSpec):
+    ledger_file = traits.Str(mandatory=True, desc='JSONL ledger')
+    subject = traits.Str(mandatory=True)
+    stage = traits.Str(mandatory=True)
+    fingerprint = traits.Str(mandatory=True, desc='ledger.fingerprint of the subject inputs and settings')
+    in_files = InputMultiPath(File(exists=True), mandatory=True, desc='the finished outputs of the stage')
+
+
+class LedgerRecordOutputSpec(TraitedSpec):
+    out_files = OutputMultiPath(File(exists=True), desc='in_files, passed through')
+
+
+class LedgerRecord(BaseInterface):
+    '''mark a subject's stage as done once its outputs exist'''
+
+    input_spec = LedgerRecordInputSpec
+    output_spec = LedgerRecordOutputSpec
+
+    def _run_interface(self, runtime):
+        append(self.inputs.ledger_file, self.inputs.subject, self.inputs.stage, self.inputs.fingerprint,
+               self.inputs.in_files)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_files'] = [os.path.abspath(p) for p in self.inputs.in_files]
+        return outputs
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# standard lib
+
+'''
+Indexed subject manifest of an image tree, so pipelines stop crawling Lustre on every start.
+
+scan() lists the tree once, level by level on a thread pool, into an SQLite table of NIfTI files
+with subject, session, datatype, modality, size and mtime. Directory mtimes are stored too: a later
+scan only lists the directories whose mtime changed (files added, removed or renamed) and reuses the
+rows of the others, so rescanning an unchanged tree costs one stat per directory.
+
+Subject, session and modality are read from BIDS names when there are any and from the layout the
+processed trees use otherwise:
+    sub-01/ses-1/anat/sub-01_ses-1_T1w.nii.gz    -> sub-01, ses-1, anat, T1w
+    <subject>/T1w_acpc_dc_restore_brain.nii.gz   -> <subject>, '', '', T1w_acpc_dc_restore_brain
+
+pairs() returns the subjects that have every requested modality, sorted, so the T1w/T2w pairing no
+longer depends on glob order and shard() splits a cohort the same way on every node.
+
+usage: manifest.py /path/to/tree [--list T1w T2w] [--shard 0/4]
+'''
+
+import argparse
+import hashlib
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_MANIFEST_DIR = os.path.join(os.path.expanduser('~'), '.nlreg_cache', 'manifests')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime REAL);
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dir TEXT, subject TEXT, session TEXT, datatype TEXT,
+                                  modality TEXT, size INTEGER, mtime REAL);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE INDEX IF NOT EXISTS files_subject ON files (subject, session, modality);
+'''
+
+
+def main():
+    parser = generate_parser()
+    args = parser.parse_args()
+
+    manifest_file = scan(args.path, args.manifest, args.nthreads)
+    print('manifest of %s: %s' % (args.path, manifest_file))
+    if args.list:
+        subjects = pairs(manifest_file, args.list, args.datatype)
+        if args.shard:
+            subjects = shard(subjects, *parse_shard(args.shard))
+        for subject, session, paths in subjects:
+            print(' '.join([subject, session or '-'] + paths))
+
+
+def generate_parser():
+    parser = argparse.ArgumentParser(description='index the images of a subject tree')
+    parser.add_argument('path', help='root of the tree')
+    parser.add_argument('--manifest', help='SQLite manifest (default: one per root in %s)' % DEFAULT_MANIFEST_DIR)
+    parser.add_argument('--nthreads', default=16, type=int, help='directories listed concurrently')
+    parser.add_argument('--list', nargs='+', metavar='MODALITY', help='print the subjects that have all of these')
+    parser.add_argument('--datatype', help='only files in this datatype folder (e.g. anat)')
+    parser.add_argument('--shard', help='INDEX/COUNT: only the INDEX-th of COUNT deterministic shards')
+    return parser
+
+
+def default_manifest(root):
+    root = os.path.abspath(root)
+    name = '%s_%s.sqlite' % (os.path.basename(root.rstrip(os.sep)), hashlib.sha1(root.encode()).hexdigest()[:12])
+    return os.path.join(DEFAULT_MANIFEST_DIR, name)
+
+
+def parse_path(root, path):
+    '''(subject, session, datatype, modality) of an image below root'''
+    parts = os.path.relpath(path, root).split(os.sep)
+    directories, name = parts[:-1], parts[-1]
+    stem = name[:-len('.nii.gz')] if name.endswith('.nii.gz') else name[:-len('.nii')]
+
+    subject = next((p for p in directories if p.startswith('sub-')), directories[0] if directories else '')
+    session = next((p for p in directories if p.startswith('ses-')), '')
+    datatype = directories[-1] if directories and directories[-1] not in (subject, session) else ''
+    modality = stem.rsplit('_', 1)[-1] if stem.startswith('sub-') else stem
+    return subject, session, datatype, modality
+
+
+def _list_directory(path):
+    '''(mtime, subdirectories, [(image, size, mtime)]), None if the directory is gone'''
+    try:
+        mtime = os.stat(path).st_mtime
+        subdirs, images = [], []
+        for entry in os.scandir(path):
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.name.endswith(('.nii.gz', '.nii')):
+                stat = entry.stat()
+                images.append((entry.path, stat.st_size, stat.st_mtime))
+        return mtime, subdirs, images
+    except OSError:
+        return None
+
+
+def _directory_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def scan(root, manifest_file=None, n_threads=16):
+    '''bring the manifest of root up to date, returns its file name'''
+    root = os.path.abspath(root)
+    assert os.path.isdir(root), '%s is not a directory!' % root
+    manifest_file = manifest_file or default_manifest(root)
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_file)), exist_ok=True)
+
+    db = sqlite3.connect(manifest_file)
+    db.executescript(SCHEMA)
+    known = dict(db.execute('SELECT path, mtime FROM dirs'))
+    children = {}
+    for path, parent in db.execute('SELECT path, parent FROM dirs'):
+        children.setdefault(parent, []).append(path)
+
+    seen, listed = set(), 0
+    level = [(root, None)]
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        while level:
+            paths = [path for path, _ in level]
+            mtimes = list(pool.map(_directory_mtime, paths))
+            changed = [path for path, mtime in zip(paths, mtimes) if mtime is not None and mtime != known.get(path)]
+            listings = dict(zip(changed, pool.map(_list_directory, changed)))
+
+            next_level = []
+            for (path, parent), mtime in zip(level, mtimes):
+                if mtime is None or listings.get(path, True) is None:
+                    continue
+                seen.add(path)
+                if path not in listings:
+                    next_level.extend((child, path) for child in children.get(path, []))
+                    continue
+                mtime, subdirs, images = listings[path]
+                listed += 1
+                db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)', (path, parent, mtime))
+                db.execute('DELETE FROM files WHERE dir = ?', (path,))
+                db.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               [(image, path) + parse_path(root, image) + (size, image_mtime)
+                                for image, size, image_mtime in images])
+                next_level.extend((child, path) for child in subdirs)
+            level = next_level
+
+    # directories that disappeared take their images with them
+    gone = [path for path in known if path not in seen]
+    db.executemany('DELETE FROM files WHERE dir = ?', [(path,) for path in gone])
+    db.executemany('DELETE FROM dirs WHERE path = ?', [(path,) for path in gone])
+    db.commit()
+    db.close()
+    print('manifest: listed %d of %d directories' % (listed, len(seen)))
+    return manifest_file
+
+
+def pairs(manifest_file, modalities, datatype=None):
+    '''
+    [(subject, session, [image per modality])] for the subject sessions that have all modalities,
+    sorted; when a session has several images of a modality (runs) the first by name is taken
+    '''
+    db = sqlite3.connect(manifest_file)
+    query = 'SELECT subject, session, modality, path FROM files WHERE modality IN (%s)' % ','.join(
+        '?' * len(modalities))
+    params = list(modalities)
+    if datatype:
+        query += ' AND datatype = ?'
+        params.append(datatype)
+    images = {}
+    for subject, session, modality, path in db.execute(query + ' ORDER BY path', params):
+        images.setdefault((subject, session), {}).setdefault(modality, path)
+    db.close()
+
+    found = []
+    for (subject, session), paths in sorted(images.items()):
+        if all(m in paths for m in modalities):
+            found.append((subject, session, [paths[m] for m in modalities]))
+        else:
+            print('%s %s does not have all of %s' % (subject, session, ', '.join(modalities)))
+    return found
+
+
+def parse_shard(spec):
+    '''"INDEX/COUNT" -> (index, count)'''
+    index, count = (int(n) for n in spec.split('/'))
+    assert 0 <= index < count, 'shard %s: INDEX must be in [0, COUNT)' % spec
+    return index, count
+
+
+def shard(subjects, index, count):
+    '''every count-th subject starting at index, the subjects are sorted so every node agrees'''
+    return sorted(subjects)[index::count]
+
+
+if __name__ == '__main__':
+    main()
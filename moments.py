@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# standard lib
+
+'''
+Image-moments initial transform for ants.Registration (initial_moving_transform).
+
+The intensity-weighted centre of mass and principal axes of the (skull-stripped) fixed and moving
+images give a rigid transform that puts the moving brain on top of the fixed one, so the Affine stage
+no longer starts from identity and stops on its convergence criterion long before the 10000 iteration
+cap, also for infant heads positioned unusually in the scanner.
+
+Principal axes are only defined up to sign, each moving axis is flipped to point the same way as the
+corresponding fixed axis. When two moments are almost equal the axes can swap, so a rotation larger
+than max_angle is dropped and only the centres are aligned (what antsRegistration's
+initial_moving_transform_com does).
+
+The transform maps fixed (LPS) points into the moving image, written as an ITK
+AffineTransform_double_3_3 .mat centred on the fixed centre of mass.
+'''
+
+import os
+
+# external libs
+import numpy as np
+import nibabel as nib
+from scipy.io import savemat
+from nipype.interfaces.base import BaseInterface, BaseInterfaceInputSpec, TraitedSpec, File, traits
+
+from warp import LPS
+
+
+def image_moments(path):
+    '''(intensity-weighted centre, principal axes as columns, largest moment last) in LPS physical space'''
+    image = nib.load(path)
+    data = np.asarray(image.dataobj, dtype=np.float32)
+    if data.ndim > 3:
+        data = data.reshape(data.shape[:3] + (-1,))[..., 0]
+    ijk = np.nonzero(data > 0)
+    weights = data[ijk].astype(np.float64)
+    if weights.size == 0:
+        raise ValueError('%s has no voxels above 0' % path)
+
+    to_physical = LPS.dot(image.affine)
+    points = to_physical[:3, :3].dot(np.array(ijk, dtype=np.float64)) + to_physical[:3, 3:]
+    centre = points.dot(weights) / weights.sum()
+    offsets = points - centre[:, None]
+    covariance = (offsets * weights).dot(offsets.T) / weights.sum()
+    _, axes = np.linalg.eigh(covariance)
+    return centre, axes
+
+
+def moments_transform(fixed_image, moving_image, max_angle=30.0):
+    '''4x4 matrix mapping fixed LPS points onto moving LPS points, and the fixed centre'''
+    fixed_centre, fixed_axes = image_moments(fixed_image)
+    moving_centre, moving_axes = image_moments(moving_image)
+
+    moving_axes = moving_axes * np.where(np.sum(moving_axes * fixed_axes, axis=0) < 0, -1.0, 1.0)
+    rotation = moving_axes.dot(fixed_axes.T)
+    if np.linalg.det(rotation) < 0:
+        # a reflection: flip the least aligned axis
+        worst = np.argmin(np.abs(np.sum(moving_axes * fixed_axes, axis=0)))
+        moving_axes[:, worst] *= -1
+        rotation = moving_axes.dot(fixed_axes.T)
+
+    angle = np.degrees(np.arccos(np.clip((np.trace(rotation) - 1) / 2, -1.0, 1.0)))
+    if angle > max_angle:
+        rotation = np.eye(3)
+
+    matrix = np.eye(4)
+    matrix[:3, :3] = rotation
+    matrix[:3, 3] = moving_centre - rotation.dot(fixed_centre)
+    return matrix, fixed_centre
+
+
+def write_itk_affine(matrix, centre, out_file):
+    '''ITK MatrixOffsetTransform .mat (MATLAB v4, as antsRegistration writes them): T(p) = A(p - c) + c + t'''
+    translation = matrix[:3, 3] + matrix[:3, :3].dot(centre) - centre
+    params = np.concatenate([matrix[:3, :3].ravel(), translation])
+    savemat(out_file, {'AffineTransform_double_3_3': params.reshape(-1, 1),
+                       'fixed': np.asarray(centre, dtype=np.float64).reshape(-1, 1)}, format='4')
+    return os.path.abspath(out_file)
+
+
+class MomentsInitializerInputSpec(BaseInterfaceInputSpec):
+    fixed_image = File(exists=True, mandatory=True, desc='skull-stripped fixed image')
+    moving_image = File(exists=True, mandatory=True, desc='skull-stripped moving image')
+    max_angle = traits.Float(30.0, usedefault=True, desc='larger principal-axes rotations are not trusted (degrees)')
+    out_transform = traits.Str('initial_moving_transform.mat', usedefault=True)
+
+
+class MomentsInitializerOutputSpec(TraitedSpec):
+    out_transform = File(exists=True, desc='for ants.Registration initial_moving_transform')
+
+
+class MomentsInitializer(BaseInterface):
+    '''centre of mass + principal axes initial transform'''
+
+    input_spec = MomentsInitializerInputSpec
+    output_spec = MomentsInitializerOutputSpec
+
+    def _run_interface(self, runtime):
+        matrix, centre = moments_transform(self.inputs.fixed_image, self.inputs.moving_image, self.inputs.max_angle)
+        write_itk_affine(matrix, centre, self.inputs.out_transform)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_transform'] = os.path.abspath(self.inputs.out_transform)
+        return outputs
@@ -7,53 +7,133 @@ path = "/home/exacloud/lustre1/fnl_lab/projects/INFANT/GEN_INFANT/masking_test"
 '''
 
 import argparse
+from functools import partial
 import os
-from glob import glob
 import random
 
 # external libs
 import nipype.pipeline.engine as pe
-from nipype.interfaces import ants, utility
+from nipype import config
+from nipype.interfaces import utility
+
+from compress import Compress
+from crop import Crop, Uncrop
+from ledger import LedgerRecord, fingerprint, pending, load, completed, append
+from manifest import scan, pairs, shard, parse_shard
+from moments import MomentsInitializer
+from preflight import check, report_name, write_report
+from preprocess import PreprocessPair, first_image
+from resources import (image_voxels, max_voxels, threads_per_task, registration_resources, warp_resources,
+                       plugin_args)
+from staging import Stager, run_in_waves
+from template_store import uncompressed, DEFAULT_STORE_DIR
+from transform_cache import CachedRegistration, DEFAULT_CACHE_DIR
+from warp import ApplyTransformsNative
 
 
 def main():
     parser = generate_parser()
     args = parser.parse_args()
+    # duration and peak memory of every node, what costmodel.py is fitted on
+    config.enable_resource_monitor()
     path = args.path
     njobs = args.njobs
+    cache_dir = args.cachedir
+    store_dir = args.storedir
+    output_type = args.intermediate_type
 
     atlas_brain = '/home/exacloud/lustre1/fnl_lab/projects/INFANT/GEN_INFANT/masking_test/temp_nih_T2w_atl_brain_float.nii.gz'
+    # every registration reads the atlas, inflate it once
+    atlas_brain = uncompressed(atlas_brain, store_dir)
 
     randint = '_nlreg'
     warped_dir = os.path.join('./nlreg_dir', 'warped{}'.format(randint))
 
-    #create list of T1w and T2w images for each subject
-    pattern = os.path.join(path, '*/T1w_acpc_dc_restore_brain.nii.gz')
-    t1w_list = glob(pattern)
+    #T1w and T2w of each subject from the manifest of path, only directories changed since the last scan are listed
+    subjects = pairs(scan(path, args.manifest), ['T1w_acpc_dc_restore_brain', 'T2w_acpc_dc_restore_brain'])
+    if args.shard:
+        subjects = shard(subjects, *parse_shard(args.shard))
+
+    #drop subjects whose headers would only fail hours into SyN, voxel counts are kept for cost estimates
+    subjects, report = check(subjects)
+    write_report(report, os.path.join(warped_dir, report_name(args.shard)))
+    subject_ids = [subject for subject, _, _ in subjects]
+    t1w_t2w_list = [images for _, _, images in subjects]
+    t2w_list = [t2w for _, t2w in t1w_t2w_list]
 
-    pattern = os.path.join(path, '*/T2w_acpc_dc_restore_brain.nii.gz')
-    t2w_list = glob(pattern)
+    #subjects finished by an earlier run are dropped before the graph is built
+    ledger_file = args.ledger or os.path.join(warped_dir, 'ledger.jsonl')
+    fingerprints = [fingerprint(t1w_t2w + [atlas_brain], stage='nonlinear_reg') for t1w_t2w in t1w_t2w_list]
+    todo = pending(ledger_file, 'nonlinear_reg', subject_ids, fingerprints)
+    print('%d of %d subjects done, %d to run' % (len(subject_ids) - len(todo), len(subject_ids), len(todo)))
+    if not todo:
+        return
+    subject_ids = [subject_ids[i] for i in todo]
+    t1w_t2w_list = [t1w_t2w_list[i] for i in todo]
+    t2w_list = [t2w_list[i] for i in todo]
+    fingerprints = [fingerprints[i] for i in todo]
 
-    #t1w_t2w_list = zip(t1w_list, t2w_list)
-    #t1w_t2w_list = list(t1w_t2w_list)
+    if args.scratch is None:
+        register(warped_dir, atlas_brain, t1w_t2w_list, t2w_list, n_jobs=njobs, cache_dir=cache_dir,
+                 output_type=output_type, ledger_file=ledger_file, subject_ids=subject_ids, fingerprints=fingerprints)
+        return
 
-    t1w_t2w_tuple = zip(t1w_list, t2w_list)
-    t1w_t2w_tuple = list(t1w_t2w_tuple)
-    t1w_t2w_list = [list(i) for i in t1w_t2w_tuple]
+    #inputs are staged on node-local scratch ahead of each wave, nipype works there and the warped atlases
+    #are copied back to <warped dir>/<subject> while the next wave computes
+    stager = Stager(args.scratch)
+    work_dir = os.path.join(stager.scratch_dir, 'nlreg_work')
+    wave_ledger = os.path.join(work_dir, 'ledger.jsonl')
+    fingerprint_of = dict(zip(subject_ids, fingerprints))
 
-    register(warped_dir, atlas_brain, t1w_t2w_list, t2w_list, n_jobs=njobs)
+    def run_wave(wave, local_inputs):
+        wave_ids = [subject for subject, _ in wave]
+        try:
+            register(work_dir, atlas_brain, local_inputs, [t2w for _, t2w in local_inputs], n_jobs=njobs,
+                     cache_dir=cache_dir, output_type=output_type, ledger_file=wave_ledger, subject_ids=wave_ids,
+                     fingerprints=[fingerprint_of[s] for s in wave_ids])
+        except RuntimeError as e:
+            #the subjects that did finish are still written back
+            print('wave %s failed: %s' % (' '.join(wave_ids), e))
+        records = load(wave_ledger)
+        for subject in wave_ids:
+            if not completed(records, subject, 'nonlinear_reg', fingerprint_of[subject]):
+                continue
+            outputs = records[(subject, 'nonlinear_reg')]['outputs']
+            dests = [os.path.join(os.path.abspath(warped_dir), subject, os.path.basename(p)) for p in outputs]
+            record = partial(append, ledger_file, subject, 'nonlinear_reg', fingerprint_of[subject], dests)
+            stager.write_back(outputs, dests, then=record)
+
+    run_in_waves(list(zip(subject_ids, t1w_t2w_list)), run_wave, stager, args.wave or njobs, args.ahead)
 
 def generate_parser():
     parser = argparse.ArgumentParser(description='non-linear registration from Brown')
     parser.add_argument('path', help='path to images')
     parser.add_argument('--njobs', default=1, type=int, help='number of cpus to utilize')
+    parser.add_argument('--cachedir', default=DEFAULT_CACHE_DIR,
+                        help='transform store shared by all registration pipelines')
+    parser.add_argument('--storedir', default=DEFAULT_STORE_DIR,
+                        help='node-local directory atlases are decoded to once (default: /dev/shm)')
+    parser.add_argument('--intermediate_type', default='NIFTI', choices=['NIFTI', 'NIFTI_GZ'],
+                        help='format of the files passed between nodes, final outputs are always .nii.gz')
+    parser.add_argument('--ledger', help='per-subject completion ledger (default: <warped dir>/ledger.jsonl)')
+    parser.add_argument('--manifest', help='subject manifest of path (default: one per path in ~/.nlreg_cache)')
+    parser.add_argument('--shard', help='INDEX/COUNT: run only the INDEX-th of COUNT deterministic subject shards')
+    parser.add_argument('--scratch', help='node-local directory: stage inputs and work there, copy outputs back')
+    parser.add_argument('--wave', type=int, help='with --scratch: subjects run together (default: --njobs)')
+    parser.add_argument('--ahead', type=int, help='with --scratch: subjects staged ahead (default: one wave)')
     return parser
 
-def register(warped_dir, atlas_image_brain, subject_T1ws_T2ws, subject_T2ws, n_jobs):
+def register(warped_dir, atlas_image_brain, subject_T1ws_T2ws, subject_T2ws, n_jobs, cache_dir=DEFAULT_CACHE_DIR,
+             output_type='NIFTI', ledger_file=None, subject_ids=None, fingerprints=None):
+
+    iterables = [('subject_image_list', subject_T1ws_T2ws), ('subject_image', subject_T2ws)]
+    if ledger_file:
+        iterables += [('subjectid', subject_ids), ('fingerprint', fingerprints)]
 
     input_spec = pe.Node(
-        utility.IdentityInterface(fields=['subject_image_list', 'subject_image', 'atlas_image_brain']),
-        iterables=[('subject_image_list', subject_T1ws_T2ws), ('subject_image', subject_T2ws)],
+        utility.IdentityInterface(fields=['subject_image_list', 'subject_image', 'atlas_image_brain', 'subjectid',
+                                          'fingerprint']),
+        iterables=iterables,
         synchronize=True,
         name='input_spec'
     )
@@ -72,8 +152,23 @@ def register(warped_dir, atlas_image_brain, subject_T1ws_T2ws, subject_T2ws, n_j
     MI - option 32x16000: 32 bins, 16000 samples
     '''
 
+    # scheduling estimates: one registration per subject shares the cpus
+    subject_voxels = max_voxels(subject_T2ws)
+    atlas_voxels = image_voxels(atlas_image_brain)
+    pair_threads = threads_per_task(n_jobs, len(subject_T2ws))
+
+    # start the affine from aligned centres of mass and principal axes instead of identity
+    moments = pe.Node(
+        MomentsInitializer(),
+        name='init_moments')
+
+    # the atlas is matched to the channel the metrics read once per subject, not in every ANTs stage
+    preprocess = pe.Node(
+        PreprocessPair(histogram_matching=True, cache_dir=cache_dir),
+        name='preprocess')
+
     reg = pe.Node(
-        ants.Registration(
+        CachedRegistration(
             dimension=3,
             output_transform_prefix="output_",
             #interpolation='BSpline',
@@ -91,31 +186,71 @@ def register(warped_dir, atlas_image_brain, subject_T1ws_T2ws, subject_T2ws, n_j
             #winsorize_lower_quantile=0.05,
             #winsorize_upper_quantile=0.95,
             verbose=True,
-            use_histogram_matching=[True, True]
+            use_histogram_matching=[False, False],
+            cache_dir=cache_dir
         ),
-        name='calc_registration')
+        name='calc_registration',
+        **registration_resources(subject_voxels, atlas_voxels, ['Affine', 'SyN'], pair_threads))
+
+    #register on the brain bounding boxes, T1w and T2w are cut to the box of the T2w
+    crop_subject = pe.Node(
+        Crop(output_type=output_type),
+        name='crop_subject')
+
+    crop_atlas = pe.Node(
+        Crop(output_type=output_type),
+        name='crop_atlas')
 
     applytransforms = pe.Node(
-        ants.ApplyTransforms(
-            dimension=3,
-            interpolation='NearestNeighbor'),
-        name='apply_warpfield')
+        ApplyTransformsNative(
+            interpolation='NearestNeighbor',
+            output_type=output_type),
+        name='apply_warpfield',
+        **warp_resources(subject_voxels, atlas_voxels, 1, pair_threads))
+
+    uncrop = pe.Node(
+        Uncrop(output_type=output_type),
+        name='uncrop_warped')
+
+    compress = pe.Node(
+        Compress(),
+        name='compress_warped')
 
     wf = pe.Workflow(name='wf', base_dir=warped_dir)
 
     wf.connect(
-        [(input_spec, reg, [('atlas_image_brain', 'moving_image'),
-                            ('subject_image_list', 'fixed_image')]), #create warp field to register atlas to subject
-         (input_spec, applytransforms, [('atlas_image_brain', 'input_image'),
-                                        ('subject_image', 'reference_image')]),
-         (reg, applytransforms, [('forward_transforms', 'transforms')]) #apply warpfield to register atlas brain to subject
+        [(input_spec, crop_subject, [('subject_image', 'box_image'),
+                                     ('subject_image_list', 'in_files')]),
+         (input_spec, crop_atlas, [('atlas_image_brain', 'box_image')]),
+         (crop_atlas, preprocess, [('out_file', 'moving_image')]),
+         (crop_subject, preprocess, [(('out_files', first_image), 'fixed_image')]),
+         (preprocess, reg, [('moving_image', 'moving_image')]),
+         (crop_subject, reg, [('out_files', 'fixed_image')]), #create warp field to register atlas to subject
+         (input_spec, applytransforms, [('atlas_image_brain', 'input_image')]),
+         (crop_subject, applytransforms, [('out_file', 'reference_image')]),
+         (reg, applytransforms, [('forward_transforms', 'transforms')]), #apply warpfield to register atlas brain to subject
+         (input_spec, moments, [('subject_image', 'fixed_image'),
+                                ('atlas_image_brain', 'moving_image')]),
+         (moments, reg, [('out_transform', 'initial_moving_transform')])
          ]
     )
+    wf.connect(applytransforms, 'output_image', uncrop, 'in_file')
+    wf.connect(crop_subject, 'sidecar', uncrop, 'sidecar')
+    wf.connect(uncrop, 'out_file', compress, 'in_file')
+
+    #mark the subject done once its warped atlas is written
+    if ledger_file:
+        record = pe.Node(
+            LedgerRecord(ledger_file=os.path.abspath(ledger_file), stage='nonlinear_reg'),
+            name='ledger_record')
+        wf.connect(input_spec, 'subjectid', record, 'subject')
+        wf.connect(input_spec, 'fingerprint', record, 'fingerprint')
+        wf.connect(compress, 'out_file', record, 'in_files')
 
     wf.config['execution']['parameterize_dirs'] = False
 
     wf.write_graph()
-    output = wf.run(plugin='MultiProc', plugin_args={'n_procs' : n_jobs})
+    output = wf.run(plugin='MultiProc', plugin_args=plugin_args(n_jobs))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# standard lib
+
+'''
+Header-only checks of every subject's inputs before any registration is queued.
+
+A subject whose T1w and T2w differ in grid, whose image is missing or unreadable, or whose images are
+not float only fails inside SyN, hours into the run, and under MultiProc often takes the workflow down
+with it. check() reads the NIfTI headers (no voxel data) of all images on a thread pool and drops the
+subjects with problems:
+
+    missing or unreadable file
+    not 3D (4D with a single volume is fine)
+    zero, negative or non-finite voxel sizes, singular or non-finite affine
+    neither qform nor sform set, so the orientation is unknown
+    non-float datatype (require_float)
+    images of one subject on different grids (shape, voxel size or affine)
+
+The report, with each subject's voxel count for cost estimation, is written as JSON, one file per
+--shard (report_name) and through a rename, so concurrent shards never overwrite each other:
+    {"sub-01": {"voxels": 4194304, "shape": [256, 256, 64], "zooms": [1.0, 1.0, 1.0], "problems": []}, ...}
+
+usage: preflight.py /path/to/tree --list T1w_acpc_dc_restore_brain T2w_acpc_dc_restore_brain
+'''
+
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# external libs
+import numpy as np
+import nibabel as nib
+
+from manifest import scan, pairs, parse_shard
+
+
+def main():
+    parser = generate_parser()
+    args = parser.parse_args()
+
+    subjects = pairs(scan(args.path, args.manifest), args.list, args.datatype)
+    kept, report = check(subjects, args.nthreads, not args.allow_int)
+    write_report(report, args.report)
+    print('%d of %d subjects passed, report in %s' % (len(kept), len(subjects), args.report))
+
+
+def generate_parser():
+    parser = argparse.ArgumentParser(description='check the image headers of every subject')
+    parser.add_argument('path', help='root of the tree')
+    parser.add_argument('--list', nargs='+', required=True, metavar='MODALITY', help='images every subject needs')
+    parser.add_argument('--datatype', help='only files in this datatype folder (e.g. anat)')
+    parser.add_argument('--manifest', help='subject manifest of path (default: one per path in ~/.nlreg_cache)')
+    parser.add_argument('--nthreads', default=16, type=int, help='headers read concurrently')
+    parser.add_argument('--allow_int', action='store_true', help='do not require float images')
+    parser.add_argument('--report', default='preflight.json', help='JSON report')
+    return parser
+
+
+def read_header(path):
+    '''(shape, zooms, affine, dtype, orientation set), or the error message'''
+    if not os.path.exists(path):
+        return 'missing %s' % path
+    try:
+        header = nib.load(path).header
+        return (tuple(int(n) for n in header.get_data_shape()), tuple(float(z) for z in header.get_zooms()[:3]),
+                header.get_best_affine(), header.get_data_dtype(),
+                int(header['qform_code']) > 0 or int(header['sform_code']) > 0)
+    except Exception as e:
+        return 'unreadable %s: %s' % (path, e)
+
+
+def image_problems(path, header, require_float=True):
+    if isinstance(header, str):
+        return [header]
+    shape, zooms, affine, dtype, oriented = header
+    name = os.path.basename(path)
+    problems = []
+    if not (len(shape) == 3 or (len(shape) == 4 and shape[3] == 1)):
+        problems.append('%s is not 3D: %s' % (name, list(shape)))
+    if not all(np.isfinite(zooms)) or min(zooms) <= 0:
+        problems.append('%s has voxel size %s' % (name, list(zooms)))
+    if not np.all(np.isfinite(affine)) or abs(np.linalg.det(affine[:3, :3])) < 1e-6:
+        problems.append('%s has a singular affine' % name)
+    if not oriented:
+        problems.append('%s has neither qform nor sform' % name)
+    if require_float and not np.issubdtype(dtype, np.floating):
+        problems.append('%s is %s, not float' % (name, dtype))
+    return problems
+
+
+def grid_problems(paths, headers):
+    '''images of one subject have to share the grid of the first'''
+    problems = []
+    shape, zooms, affine = headers[0][:3]
+    for path, (other_shape, other_zooms, other_affine, _, _) in zip(paths[1:], headers[1:]):
+        name = os.path.basename(path)
+        if other_shape[:3] != shape[:3]:
+            problems.append('%s is %s, %s is %s' % (os.path.basename(paths[0]), list(shape[:3]), name,
+                                                    list(other_shape[:3])))
+        elif not np.allclose(other_zooms, zooms, atol=1e-3) or not np.allclose(other_affine, affine, atol=1e-3):
+            problems.append('%s and %s are not on the same grid' % (os.path.basename(paths[0]), name))
+    return problems
+
+
+def check(subjects, n_threads=16, require_float=True):
+    '''
+    subjects as manifest.pairs returns them, [(subject, session, [images])]; returns the subjects without
+    problems and the report {subject or subject/session: {voxels, shape, zooms, problems}}
+    '''
+    paths = sorted({path for _, _, images in subjects for path in images})
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        headers = dict(zip(paths, pool.map(read_header, paths)))
+
+    kept, report = [], {}
+    for subject, session, images in subjects:
+        problems = []
+        for path in images:
+            problems += image_problems(path, headers[path], require_float)
+        entry = {'voxels': None, 'shape': None, 'zooms': None, 'problems': problems}
+        if not any(isinstance(headers[path], str) for path in images):
+            problems += grid_problems(images, [headers[path] for path in images])
+            shape, zooms = headers[images[0]][:2]
+            entry.update(voxels=int(np.prod(shape[:3])), shape=list(shape[:3]), zooms=list(zooms))
+        report['/'.join(filter(None, [subject, session]))] = entry
+
+        if problems:
+            print('dropping %s: %s' % (' '.join(filter(None, [subject, session])), '; '.join(problems)))
+        else:
+            kept.append((subject, session, images))
+    return kept, report
+
+
+def report_name(shard_spec=None):
+    '''preflight.json, preflight_<index>of<count>.json for a shard, so concurrent shards keep their own'''
+    if not shard_spec:
+        return 'preflight.json'
+    return 'preflight_%dof%d.json' % parse_shard(shard_spec)
+
+
+def write_report(report, report_file):
+    os.makedirs(os.path.dirname(os.path.abspath(report_file)), exist_ok=True)
+    tmp = '%s.tmp%d' % (report_file, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    os.rename(tmp, report_file)
+    return report_file
+
+
+if __name__ == '__main__':
+    main()
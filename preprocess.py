@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# standard lib
+
+'''
+Intensity preprocessing done once per (moving, fixed) pair instead of inside every antsRegistration.
+
+antsRegistration winsorises both images (winsorize_lower/upper_quantile) and matches the moving
+histogram to the fixed one (use_histogram_matching) at the start of every run and every stage. The
+same atlas/subject pair is registered by atlas selection, by the JLF registration and, in hyperopt,
+by every trial, so the images are prepared here once, stored keyed on the image contents and settings
+in a directory next to the transform store (preprocessed_dir: ~/.nlreg_cache/preprocessed for
+~/.nlreg_cache/transforms, whose entries stay transforms only), and the registrations run with
+matching and winsorising switched off.
+
+    winsorize: clip to the lower/upper intensity quantiles of the whole image
+    match_histogram: ITK HistogramMatchingImageFilter with ThresholdAtMeanIntensity, the quantiles of
+        the voxels above the mean intensity are mapped piecewise linearly onto the reference's,
+        voxels below the mean linearly from [min, mean] onto the reference's [min, mean]
+'''
+
+import hashlib
+import json
+import os
+import tempfile
+
+# external libs
+import numpy as np
+import nibabel as nib
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec, TraitedSpec, File, Directory, traits,
+                                    isdefined)
+from nipype.utils.filemanip import split_filename
+
+from compress import OUTPUT_TYPES
+from transform_cache import file_digest
+
+
+def winsorize(data, lower=0.0, upper=1.0):
+    if lower <= 0.0 and upper >= 1.0:
+        return data
+    low, high = np.percentile(data, [100.0 * lower, 100.0 * upper])
+    return np.clip(data, low, high)
+
+
+def _quantile_table(data, match_points):
+    above = data[data > data.mean()]
+    if above.size == 0:
+        above = data.ravel()
+    quantiles = np.percentile(above, np.linspace(0.0, 100.0, match_points + 2))
+    return np.concatenate([[data.min()], quantiles])
+
+
+def match_histogram(source, reference, match_points=12):
+    '''source intensities mapped onto the histogram of reference'''
+    source_table = _quantile_table(source, match_points)
+    reference_table = _quantile_table(reference, match_points)
+    # np.interp needs increasing knots, flat stretches of the source histogram get one knot
+    knots, index = np.unique(source_table, return_index=True)
+    matched = np.interp(source.ravel(), knots, reference_table[index])
+    return matched.reshape(source.shape).astype(np.float32)
+
+
+def _save(data, reference, out_file):
+    out = nib.Nifti1Image(data.astype(np.float32), reference.affine, reference.header)
+    out.set_data_dtype(np.float32)
+    out.header.set_slope_inter(1, 0)
+    fd, tmp = tempfile.mkstemp(prefix='.tmp_', suffix=os.path.basename(out_file), dir=os.path.dirname(out_file))
+    os.close(fd)
+    nib.save(out, tmp)
+    os.rename(tmp, out_file)
+    return out_file
+
+
+def first_image(images):
+    '''connection function: the channel antsRegistration's metrics read (fixed_image[0]) of a multi-channel list'''
+    return images[0]
+
+
+def preprocessed_dir(cache_dir):
+    '''the store of preprocessed images next to the transform store cache_dir, never inside it'''
+    return os.path.join(os.path.dirname(os.path.abspath(cache_dir)), 'preprocessed')
+
+
+def _cache_path(store_dir, name, params, output_type):
+    # named after the inputs' digests and settings
+    key = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+    return os.path.join(os.path.abspath(store_dir), '%s_%s%s' % (name, key[:16], OUTPUT_TYPES[output_type]))
+
+
+def _cached(out_file, compute):
+    # computed unless another run already did
+    if not os.path.exists(out_file):
+        os.makedirs(os.path.dirname(out_file), exist_ok=True)
+        compute(out_file)
+    return out_file
+
+
+def preprocessed_paths(moving_image, fixed_image, store_dir, winsorize_lower_quantile=0.0,
+                       winsorize_upper_quantile=1.0, histogram_matching=True, match_points=12, output_type='NIFTI'):
+    '''(fixed, moving) file names preprocess_pair returns for these settings, without computing anything'''
+    winsorizing = winsorize_lower_quantile > 0.0 or winsorize_upper_quantile < 1.0
+    quantiles = [winsorize_lower_quantile, winsorize_upper_quantile]
+
+    fixed_out = fixed_image
+    if winsorizing:
+        fixed_out = _cache_path(store_dir, split_filename(fixed_image)[1],
+                                {'fixed': file_digest(fixed_image), 'winsorize': quantiles}, output_type)
+
+    moving_out = moving_image
+    if winsorizing or histogram_matching:
+        params = {'moving': file_digest(moving_image), 'winsorize': quantiles}
+        if histogram_matching:
+            params.update(fixed=file_digest(fixed_image), match_points=match_points)
+        moving_out = _cache_path(store_dir, split_filename(moving_image)[1], params, output_type)
+    return fixed_out, moving_out
+
+
+def preprocess_pair(moving_image, fixed_image, store_dir, winsorize_lower_quantile=0.0, winsorize_upper_quantile=1.0,
+                    histogram_matching=True, match_points=12, output_type='NIFTI'):
+    '''
+    returns (fixed, moving) as antsRegistration would see them after winsorising and histogram matching,
+    stored in store_dir; an image that needs neither is returned as it is
+    '''
+    quantiles = [winsorize_lower_quantile, winsorize_upper_quantile]
+    load = lambda path: np.asarray(nib.load(path).dataobj, dtype=np.float32)
+    fixed_out, moving_out = preprocessed_paths(moving_image, fixed_image, store_dir, winsorize_lower_quantile,
+                                               winsorize_upper_quantile, histogram_matching, match_points,
+                                               output_type)
+
+    if fixed_out != fixed_image:
+        _cached(fixed_out,
+                lambda out_file: _save(winsorize(load(fixed_image), *quantiles), nib.load(fixed_image), out_file))
+
+    if moving_out != moving_image:
+        def compute(out_file):
+            moving = winsorize(load(moving_image), *quantiles)
+            if histogram_matching:
+                moving = match_histogram(moving, winsorize(load(fixed_image), *quantiles), match_points)
+            _save(moving, nib.load(moving_image), out_file)
+
+        _cached(moving_out, compute)
+
+    return fixed_out, moving_out
+
+
+class PreprocessPairInputSpec(BaseInterfaceInputSpec):
+    moving_image = File(exists=True, mandatory=True, desc='image matched to fixed_image')
+    fixed_image = File(exists=True, mandatory=True, desc='reference of the histogram matching')
+    winsorize_lower_quantile = traits.Range(0.0, 1.0, 0.0, usedefault=True)
+    winsorize_upper_quantile = traits.Range(0.0, 1.0, 1.0, usedefault=True)
+    histogram_matching = traits.Bool(True, usedefault=True)
+    match_points = traits.Int(12, usedefault=True, desc='number of quantiles matched')
+    cache_dir = Directory(desc='transform store, results are written to preprocessed_dir(cache_dir)')
+    store_dir = Directory(desc='directory of the results instead of preprocessed_dir(cache_dir); results are '
+                               'written to the node directory if neither is defined')
+    output_type = traits.Enum('NIFTI', 'NIFTI_GZ', usedefault=True)
+
+
+class PreprocessPairOutputSpec(TraitedSpec):
+    fixed_image = File(exists=True, desc='winsorised fixed image')
+    moving_image = File(exists=True, desc='winsorised, histogram matched moving image')
+
+
+class PreprocessPair(BaseInterface):
+    '''winsorising and histogram matching of a registration pair, for registrations that have both switched off'''
+
+    input_spec = PreprocessPairInputSpec
+    output_spec = PreprocessPairOutputSpec
+
+    def _store_dir(self):
+        if isdefined(self.inputs.store_dir):
+            return os.path.abspath(self.inputs.store_dir)
+        if isdefined(self.inputs.cache_dir):
+            return preprocessed_dir(self.inputs.cache_dir)
+        return os.getcwd()
+
+    def _settings(self):
+        return (self.inputs.moving_image, self.inputs.fixed_image, self._store_dir(),
+                self.inputs.winsorize_lower_quantile, self.inputs.winsorize_upper_quantile,
+                self.inputs.histogram_matching, self.inputs.match_points, self.inputs.output_type)
+
+    def _run_interface(self, runtime):
+        preprocess_pair(*self._settings())
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['fixed_image'], outputs['moving_image'] = preprocessed_paths(*self._settings())
+        return outputs
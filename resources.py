@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# standard lib
+
+'''
+Per-node thread and memory estimates for the MultiProc scheduler.
+
+MultiProc only packs nodes sensibly if they say what they need: pe.Node(..., n_procs=, mem_gb=). The
+node's n_procs also sets the interface's num_threads (ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS for ANTs,
+the thread/process pools of the native interfaces), so a registration never runs more threads than
+it was scheduled for. The helpers below return those keyword arguments:
+
+    pe.Node(CachedRegistration(...), name='calc_registration', **registration_resources(...))
+
+Memory is modelled from voxel counts (headers only, nothing is decoded) and is deliberately on the
+generous side; the coefficients are bytes per voxel of the grid the work is done on.
+
+    registration: fixed + moving images and their pyramid, and for SyN the forward/inverse
+        displacement fields, their smoothed updates and the CC metric's local sums (~400 B/voxel)
+    warp: the input volumes as float32 plus B-spline coefficients and the output volumes
+    fusion: every warped atlas and segmentation held at once, plus per-voxel weights
+'''
+
+import os
+
+# external libs
+import numpy as np
+import nibabel as nib
+
+from autotune import load_curve, best_split
+
+GB = float(1 << 30)
+
+BYTES_PER_VOXEL = {
+    'Rigid': 40,
+    'Affine': 40,
+    'SyN': 400,
+}
+
+
+def image_voxels(path):
+    '''number of voxels of one volume, from the header'''
+    return int(np.prod(nib.load(path).shape[:3]))
+
+
+def max_voxels(paths):
+    return max(image_voxels(p) for p in paths)
+
+
+def available_memory_gb():
+    '''memory granted by SLURM, otherwise 90% of what the node has'''
+    if os.environ.get('SLURM_MEM_PER_NODE'):
+        return int(os.environ['SLURM_MEM_PER_NODE']) / 1024.0
+    if os.environ.get('SLURM_MEM_PER_CPU') and os.environ.get('SLURM_CPUS_PER_TASK'):
+        return int(os.environ['SLURM_MEM_PER_CPU']) * int(os.environ['SLURM_CPUS_PER_TASK']) / 1024.0
+    pages = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    return 0.9 * pages / GB
+
+
+def threads_per_task(n_cpus, n_tasks, max_threads=8):
+    '''
+    threads per task when n_tasks independent tasks share n_cpus: the split measured by autotune.py on
+    this cpu model when there is one; otherwise tasks running side by side are assumed to scale better
+    than threads inside one ANTs process, so threads only go up once every task has a cpu
+    '''
+    curve = load_curve()
+    if curve is not None:
+        return best_split(curve, n_cpus, n_tasks)['threads']
+    return int(max(1, min(max_threads, n_cpus // max(1, n_tasks))))
+
+
+def registration_resources(fixed_voxels, moving_voxels, transforms, n_threads=1):
+    per_voxel = max(BYTES_PER_VOXEL.get(t, 400) for t in transforms)
+    # the pyramid adds about a seventh to each image
+    mem = (fixed_voxels * per_voxel + moving_voxels * 8) * 8 / 7.0
+    return {'n_procs': n_threads, 'mem_gb': round(0.5 + mem / GB, 2)}
+
+
+def warp_resources(reference_voxels, moving_voxels, n_images=1, n_threads=1):
+    mem = n_images * (moving_voxels * 8 + reference_voxels * 4)
+    return {'n_procs': n_threads, 'mem_gb': round(0.3 + mem / GB, 2)}
+
+
+def fusion_resources(reference_voxels, n_atlases, n_threads=1):
+    mem = reference_voxels * (n_atlases * 12 + n_atlases ** 2 * 4)
+    return {'n_procs': n_threads, 'mem_gb': round(0.5 + mem / GB, 2)}
+
+
+def plugin_args(n_procs, memory_gb=None):
+    '''MultiProc plugin_args; nodes larger than the node are run alone instead of failing the workflow'''
+    if memory_gb is None:
+        memory_gb = available_memory_gb()
+    return {'n_procs': n_procs, 'memory_gb': memory_gb, 'raise_insufficient': False}
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# standard lib
+
+'''
+In-process image similarity on numpy arrays, a drop-in for the MeasureImageSimilarity node.
+
+Higher is more similar for both metrics (unlike ANTs, which reports them as negative costs).
+
+    mutual_information: joint histogram built with np.bincount, sampling every voxel
+    correlation: global normalised cross correlation
+'''
+
+# external libs
+import numpy as np
+import nibabel as nib
+
+
+def load_image(path, dtype=np.float32):
+    '''voxel array of a NIfTI image, scaled by scl_slope/scl_inter'''
+    return np.asarray(nib.load(path).dataobj, dtype=dtype)
+
+
+def _masked(fixed, moving, mask):
+    fixed = np.asarray(fixed, dtype=np.float64)
+    moving = np.asarray(moving, dtype=np.float64)
+    if fixed.shape != moving.shape:
+        raise ValueError('fixed %s and moving %s images must be on the same grid' % (fixed.shape, moving.shape))
+    if mask is None:
+        return fixed.ravel(), moving.ravel()
+    mask = np.asarray(mask, dtype=bool)
+    return fixed[mask], moving[mask]
+
+
+def _bin_indices(values, bins):
+    low, high = values.min(), values.max()
+    if high == low:
+        return np.zeros(values.shape, dtype=np.intp)
+    indices = ((values - low) * (bins / (high - low))).astype(np.intp)
+    return np.minimum(indices, bins - 1)
+
+
+def mutual_information(fixed, moving, bins=32, mask=None):
+    fixed, moving = _masked(fixed, moving, mask)
+    joint = np.bincount(_bin_indices(fixed, bins) * bins + _bin_indices(moving, bins),
+                        minlength=bins * bins).reshape(bins, bins)
+    joint = joint / float(joint.sum())
+    p_fixed = joint.sum(axis=1)
+    p_moving = joint.sum(axis=0)
+
+    nonzero = joint > 0
+    outer = np.outer(p_fixed, p_moving)
+    return float(np.sum(joint[nonzero] * np.log(joint[nonzero] / outer[nonzero])))
+
+
+def correlation(fixed, moving, mask=None):
+    fixed, moving = _masked(fixed, moving, mask)
+    fixed = fixed - fixed.mean()
+    moving = moving - moving.mean()
+    denominator = np.sqrt(np.dot(fixed, fixed) * np.dot(moving, moving))
+    if denominator == 0:
+        return 0.0
+    return float(np.dot(fixed, moving) / denominator)
+
+
+def similarity(fixed, moving, metric='MI', radius_or_number_of_bins=32, mask=None):
+    '''same metric names as ants.MeasureImageSimilarity: MI, GC (global correlation)'''
+    if metric in ('MI', 'Mattes'):
+        return mutual_information(fixed, moving, bins=radius_or_number_of_bins, mask=mask)
+    elif metric == 'GC':
+        return correlation(fixed, moving, mask=mask)
+    raise ValueError('unknown similarity metric %s' % metric)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# standard lib
+
+'''
+nipype execution plugin that submits SLURM job arrays instead of one sbatch per node.
+
+nipype's SLURM plugin submits every node as its own job with the same sbatch_args, so an
+IdentityInterface or an ApplyTransforms waits in the queue as long as a registration and asks for the
+same 10 cpus and 36 hours. SLURMArrayPlugin collects the nodes that become ready in one scheduler
+pass and
+    - runs small interfaces (IdentityInterface, Merge, ...) inline on the submitting host,
+    - packs cheap interfaces (ApplyTransforms, WarpAtlas, Compress, ...) pack_size at a time into one
+      array task with pack_time, run one after the other,
+    - submits the rest as one job array per (n_procs, mem_gb, time) request, taken from the node
+      (pe.Node(..., n_procs=, mem_gb=), see resources.py), with time.
+
+With the cost model of the pipeline (plugin_args cost_model, a costmodel.py model file) --time and,
+where the model recorded it, --mem come from the predicted cost of each node instead: time rounded
+up to 10 minutes or whole hours so similar nodes still share an array, packed tasks get the sum of
+their nodes.
+
+Every array task runs this file on a JSON list of bins: `slurm_batch.py tasks.json $SLURM_ARRAY_TASK_ID`
+runs the nipype pyscripts of its bin and leaves a <pyscript>.done marker after each, which is what
+the plugin polls for; squeue is only asked (at most every status_interval seconds) whether jobs whose
+markers are missing are still alive.
+
+backend='local' replaces sbatch/squeue by processes on this machine with SLURM_ARRAY_TASK_ID set, so
+the grouping and packing can be tried without a cluster:
+
+    wf.run(plugin=SLURMArrayPlugin(plugin_args={'sbatch_args': '-A fnl_lab', 'backend': 'local'}))
+'''
+
+import argparse
+import itertools
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+from traceback import format_exception
+
+# external libs
+from nipype import logging
+from nipype.pipeline.plugins.base import SGELikeBatchManagerBase
+from nipype.pipeline.plugins.tools import create_pyscript
+
+from costmodel import load_model, predict_node, request_seconds, format_time
+
+logger = logging.getLogger('nipype.workflow')
+
+INLINE_INTERFACES = ('IdentityInterface', 'Merge', 'Select', 'Split', 'Rename', 'LedgerRecord')
+PACKED_INTERFACES = ('ApplyTransforms', 'ApplyTransformsNative', 'WarpAtlas', 'Compress', 'Crop', 'Uncrop',
+                     'FillConsensus', 'ConsensusMask', 'MomentsInitializer', 'PreprocessPair', 'UnaryMaths',
+                     'ApplyMask')
+
+
+def main():
+    parser = generate_parser()
+    args = parser.parse_args()
+    index = args.index if args.index is not None else int(os.environ['SLURM_ARRAY_TASK_ID'])
+    with open(args.tasks_file) as f:
+        bins = json.load(f)
+    run_bin(bins[index])
+
+
+def generate_parser():
+    parser = argparse.ArgumentParser(description='run one array task of a SLURMArrayPlugin submission')
+    parser.add_argument('tasks_file', help='json list of bins of nipype pyscripts')
+    parser.add_argument('index', nargs='?', type=int, help='bin to run (default: $SLURM_ARRAY_TASK_ID)')
+    return parser
+
+
+def run_bin(pyscripts):
+    '''run nipype pyscripts one after the other; they store their own results and crashes'''
+    # the pickled nodes refer to the interfaces of this repository
+    path = [os.path.dirname(os.path.abspath(__file__))] + [p for p in [os.environ.get('PYTHONPATH')] if p]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(path))
+    for pyscript in pyscripts:
+        subprocess.call([sys.executable, pyscript], env=env)
+        open(pyscript + '.done', 'w').close()
+
+
+class SlurmBackend(object):
+    '''sbatch/squeue'''
+
+    def submit(self, script, n_tasks, sbatch_args):
+        out = subprocess.check_output(
+            ['sbatch', '--parsable', '--array=0-%d' % (n_tasks - 1)] + sbatch_args + [script],
+            universal_newlines=True)
+        return int(out.strip().split(';')[0])
+
+    def active(self, jobids):
+        '''the job ids of jobids that still have tasks pending or running'''
+        proc = subprocess.run(['squeue', '-h', '-o', '%F', '-j', ','.join(str(j) for j in jobids)],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if proc.returncode != 0:
+            if 'Invalid job id' in proc.stderr:
+                return set()
+            # slurmctld busy: keep waiting rather than declaring the jobs lost
+            logger.warning('squeue failed, treating jobs as running: %s', proc.stderr.strip())
+            return set(jobids)
+        return {int(line) for line in proc.stdout.split()}
+
+
+class LocalBackend(object):
+    '''stand-in for sbatch/squeue: every array task is a process on this machine'''
+
+    def __init__(self):
+        self._jobids = itertools.count(1)
+        self._procs = {}
+
+    def submit(self, script, n_tasks, sbatch_args):
+        jobid = next(self._jobids)
+        procs = []
+        for index in range(n_tasks):
+            env = dict(os.environ, SLURM_ARRAY_JOB_ID=str(jobid), SLURM_ARRAY_TASK_ID=str(index),
+                       SLURM_JOB_ID=str(jobid))
+            log = open('%s.%d_%d.out' % (script, jobid, index), 'w')
+            procs.append(subprocess.Popen(['bash', script], env=env, stdout=log, stderr=subprocess.STDOUT))
+            log.close()
+        self._procs[jobid] = procs
+        logger.info('local job %d: %d tasks, sbatch %s', jobid, n_tasks, ' '.join(sbatch_args))
+        return jobid
+
+    def active(self, jobids):
+        return {j for j in jobids if any(p.poll() is None for p in self._procs.get(j, []))}
+
+
+class SLURMArrayPlugin(SGELikeBatchManagerBase):
+    '''
+    plugin_args:
+        sbatch_args: arguments every submission gets (account, partition, ...)
+        time / pack_time: --time of node arrays / of packed cheap nodes ('36:00:00' / '1:00:00')
+        pack_size: cheap nodes per array task (16)
+        max_array_size: tasks per job array (1000)
+        inline / packed: interface class names run inline / packed (INLINE_INTERFACES / PACKED_INTERFACES)
+        min_mem_gb: smallest memory request (1)
+        status_interval: seconds between squeue calls (10)
+        backend: 'slurm' or 'local'
+        cost_model: costmodel.py model file of the pipeline, None for time / pack_time and the nodes'
+            mem_gb (None)
+        safety: requested time and memory over the predicted (1.5)
+    '''
+
+    def __init__(self, plugin_args=None):
+        plugin_args = plugin_args or {}
+        super(SLURMArrayPlugin, self).__init__('#!/bin/bash', plugin_args=plugin_args)
+        self._sbatch_args = plugin_args.get('sbatch_args', '').split()
+        self._time = plugin_args.get('time', '36:00:00')
+        self._pack_time = plugin_args.get('pack_time', '1:00:00')
+        self._pack_size = plugin_args.get('pack_size', 16)
+        self._max_array_size = plugin_args.get('max_array_size', 1000)
+        self._inline = plugin_args.get('inline', INLINE_INTERFACES)
+        self._packed = plugin_args.get('packed', PACKED_INTERFACES)
+        self._min_mem_gb = plugin_args.get('min_mem_gb', 1)
+        self._status_interval = plugin_args.get('status_interval', 10)
+        self._backend = LocalBackend() if plugin_args.get('backend') == 'local' else SlurmBackend()
+        model_file = plugin_args.get('cost_model')
+        self._cost_model = load_model(model_file) if model_file else {}
+        self._safety = plugin_args.get('safety', 1.5)
+
+        self._taskids = itertools.count(1)
+        self._queued = []
+        self._markers = {}
+        self._jobs = {}
+        self._inline_results = {}
+        self._active = set()
+        self._active_time = 0
+
+    def _submit_job(self, node, updatehash=False):
+        taskid = next(self._taskids)
+        self._pending[taskid] = node.output_dir()
+        if type(node.interface).__name__ in self._inline:
+            self._run_inline(taskid, node, updatehash)
+            return taskid
+        pyscript = create_pyscript(node, updatehash=updatehash)
+        self._markers[taskid] = pyscript + '.done'
+        self._queued.append((taskid, node, pyscript))
+        return taskid
+
+    def _run_inline(self, taskid, node, updatehash):
+        try:
+            result, traceback = node.run(updatehash=updatehash), None
+        except Exception:
+            result, traceback = None, ''.join(format_exception(*sys.exc_info()))
+        self._inline_results[taskid] = {'result': result, 'traceback': traceback, 'hostname': os.uname()[1]}
+
+    def _send_procs_to_workers(self, updatehash=False, graph=None):
+        super(SLURMArrayPlugin, self)._send_procs_to_workers(updatehash=updatehash, graph=graph)
+        if self._queued:
+            self._submit_queued()
+
+    def _node_cost(self, node):
+        '''(predicted seconds or None, mem_gb), the node's own mem_gb unless the model recorded memory'''
+        prediction = None
+        if self._cost_model:
+            try:
+                # connected inputs are only set on the worker otherwise
+                node._get_inputs()
+                prediction = predict_node(self._cost_model, node)
+            except Exception:
+                pass
+        if prediction is None:
+            return None, node.mem_gb
+        seconds, mem_gb = prediction
+        return seconds, node.mem_gb if mem_gb is None else mem_gb * self._safety
+
+    def _submit_queued(self):
+        '''one array per resource request; cheap nodes pack_size to an array task, others one each'''
+        groups, seconds = {}, {}
+        for taskid, node, pyscript in self._queued:
+            packed = type(node.interface).__name__ in self._packed
+            seconds[taskid], mem_gb = self._node_cost(node)
+            mem_gb = max(self._min_mem_gb, math.ceil(mem_gb * 2) / 2.0)
+            # 0: no prediction, time / pack_time
+            limit = 0 if packed or seconds[taskid] is None else request_seconds(seconds[taskid], self._safety)
+            groups.setdefault((packed, node.n_procs, mem_gb, limit), []).append((taskid, node, pyscript))
+        self._queued = []
+
+        for (packed, n_procs, mem_gb, limit), tasks in sorted(groups.items()):
+            size = self._pack_size if packed else 1
+            bins = [tasks[i:i + size] for i in range(0, len(tasks), size)]
+            for start in range(0, len(bins), self._max_array_size):
+                chunk = bins[start:start + self._max_array_size]
+                chunk_limit = limit
+                if packed and all(seconds[taskid] is not None for b in chunk for taskid, _, _ in b):
+                    chunk_limit = request_seconds(max(sum(seconds[taskid] for taskid, _, _ in b) for b in chunk),
+                                                  self._safety)
+                time_limit = format_time(chunk_limit) if chunk_limit else self._pack_time if packed else self._time
+                self._submit_array(chunk, packed, n_procs, mem_gb, time_limit)
+        # jobs submitted after the last squeue must not look finished
+        self._active_time = 0
+
+    def _submit_array(self, bins, packed, n_procs, mem_gb, time_limit):
+        batch_dir = os.path.dirname(bins[0][0][2])
+        name = 'array_%s_%d' % (time.strftime('%Y%m%d_%H%M%S'), bins[0][0][0])
+        tasks_file = os.path.join(batch_dir, name + '.json')
+        with open(tasks_file, 'w') as f:
+            json.dump([[pyscript for _, _, pyscript in b] for b in bins], f)
+        script = os.path.join(batch_dir, name + '.sh')
+        with open(script, 'w') as f:
+            f.write('%s\n%s %s %s\n' % (self._template, sys.executable, os.path.abspath(__file__), tasks_file))
+
+        sbatch_args = self._sbatch_args + [
+            '--cpus-per-task=%d' % n_procs,
+            '--mem=%dM' % (mem_gb * 1024),
+            '--time=%s' % time_limit,
+            '--job-name=%s' % (bins[0][0][1].name if len(bins) == 1 and len(bins[0]) == 1 else name),
+            '--output=%s' % os.path.join(batch_dir, 'slurm-%A_%a.out')]
+        jobid = self._backend.submit(script, len(bins), sbatch_args)
+        for b in bins:
+            for taskid, _, _ in b:
+                self._jobs[taskid] = jobid
+        logger.info('submitted %d nodes as job %d (%d tasks, %d cpus, %sG, %s)',
+                    sum(len(b) for b in bins), jobid, len(bins), n_procs, mem_gb, time_limit)
+
+    def _is_pending(self, taskid):
+        if taskid in self._inline_results or os.path.exists(self._markers[taskid]):
+            return False
+        if time.time() - self._active_time > self._status_interval:
+            self._active = self._backend.active(sorted(set(self._jobs.values())))
+            self._active_time = time.time()
+        # a job that is gone without leaving the marker was killed (time limit, memory, scancel)
+        return self._jobs[taskid] in self._active
+
+    def _get_result(self, taskid):
+        if taskid in self._inline_results:
+            return self._inline_results[taskid]
+        return super(SLURMArrayPlugin, self)._get_result(taskid)
+
+    def _clear_task(self, taskid):
+        super(SLURMArrayPlugin, self)._clear_task(taskid)
+        self._inline_results.pop(taskid, None)
+        self._markers.pop(taskid, None)
+        self._jobs.pop(taskid, None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# standard lib
+
+'''
+Subject inputs staged on node-local scratch ahead of the scheduler, outputs written back behind it.
+
+With ten registrations reading from and writing their node directories to Lustre, the metadata
+server rather than the cpus sets the pace. run_in_waves() runs a cohort in waves of subjects:
+while one wave is computing, the Stager copies the inputs of the next `ahead` subjects to scratch
+on a thread pool, and the finished outputs of the previous waves are copied back to the shared
+filesystem on the same pool. The nipype base_dir lives on scratch, so only the inputs (read once)
+and the deliverables (written once) touch the shared filesystem. The atlases are already on
+node-local storage (template_store).
+
+Copies go through a temporary name and keep the mtime, so a staged file that is already there and
+matches its source in size and mtime is reused, and a half-written file is never taken for a
+finished one.
+'''
+
+import hashlib
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_SCRATCH_DIR = os.path.join(os.environ.get('SLURM_TMPDIR') or os.environ.get('TMPDIR') or tempfile.gettempdir(),
+                                   'nlreg_scratch_%d' % os.getuid())
+
+
+def copy_file(src, dest):
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp = '%s.tmp%d' % (dest, os.getpid())
+    shutil.copy2(src, tmp)
+    os.rename(tmp, dest)
+    return dest
+
+
+def stage_file(path, scratch_dir):
+    '''local copy of path under scratch_dir, copied unless an identical copy is there'''
+    path = os.path.abspath(path)
+    dest = os.path.join(scratch_dir, 'inputs', hashlib.sha1(path.encode()).hexdigest()[:12], os.path.basename(path))
+    stat = os.stat(path)
+    if os.path.exists(dest):
+        local = os.stat(dest)
+        if local.st_size == stat.st_size and local.st_mtime == stat.st_mtime:
+            return dest
+    return copy_file(path, dest)
+
+
+class Stager(object):
+    '''thread pool copying inputs to scratch and outputs back'''
+
+    def __init__(self, scratch_dir=DEFAULT_SCRATCH_DIR, n_threads=4):
+        self.scratch_dir = os.path.abspath(scratch_dir)
+        self._pool = ThreadPoolExecutor(max_workers=n_threads)
+        self._writes = []
+
+    def prefetch(self, paths):
+        '''future of the local copies of paths, in order'''
+        return self._pool.submit(lambda: [stage_file(p, self.scratch_dir) for p in paths])
+
+    def release(self, local_paths):
+        '''staged inputs that are no longer needed'''
+        for path in local_paths:
+            if os.path.exists(path):
+                os.remove(path)
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+
+    def write_back(self, local_paths, dests, then=None):
+        '''copy local_paths to dests in the background, then call then() (e.g. to record completion)'''
+        def copy():
+            for local, dest in zip(local_paths, dests):
+                copy_file(local, dest)
+            if then is not None:
+                then()
+        self._writes.append(self._pool.submit(copy))
+
+    def wait(self):
+        '''block until every write-back is done, raising the first error'''
+        for future in self._writes:
+            future.result()
+        self._writes = []
+        self._pool.shutdown()
+
+
+def run_in_waves(subjects, run_wave, stager, wave_size, ahead=None):
+    '''
+    subjects: [(subjectid, [input files])], run_wave(wave, local_inputs) runs a wave of them on their
+    local copies (and queues the write-backs); the next `ahead` subjects (default one wave) are
+    staged while a wave runs
+    '''
+    ahead = wave_size if ahead is None else ahead
+    staged = []
+    for start in range(0, len(subjects), wave_size):
+        wave = subjects[start:start + wave_size]
+        while len(staged) < min(len(subjects), start + len(wave) + ahead):
+            staged.append(stager.prefetch(subjects[len(staged)][1]))
+        local_inputs = [future.result() for future in staged[start:start + len(wave)]]
+        print('wave of %d subjects, %d staged ahead' % (len(wave), len(staged) - start - len(wave)))
+        run_wave(wave, local_inputs)
+        for paths in local_inputs:
+            stager.release(paths)
+    stager.wait()
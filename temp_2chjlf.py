@@ -14,6 +14,9 @@ import random
 import nipype.pipeline.engine as pe
 from nipype.interfaces import ants, utility
 
+from warp import WarpAtlas
+from joint_fusion import ConsensusMask, FillConsensus
+
 
 def main():
     parser = generate_parser()
@@ -112,19 +115,18 @@ def register(warped_dir, subject_Tws, atlas_images, atlas_segmentations, n_jobs)
         ),
         name='calc_registration')
 
-    applytransforms_atlas = pe.Node(
-        ants.ApplyTransforms(
-            interpolation='BSpline',
-            dimension=3,
-        ),
-        name='apply_warpfield_atlas')
+    # compose the affine + SyN chain once, then resample atlas (BSpline) and labels (NearestNeighbor) together
+    applytransforms = pe.Node(
+        WarpAtlas(),
+        name='apply_warpfield')
 
-    applytransforms_segs = pe.Node(
-        ants.ApplyTransforms(
-            interpolation='NearestNeighbor',
-            dimension=3
-        ),
-        name='apply_warpfield_segs')
+    # only fuse where the warped segmentations disagree, grown by the search radius
+    consensus = pe.JoinNode(
+        ConsensusMask(dilation_radius=[3, 3, 3]),
+        joinsource='input_spec',
+        joinfield=['atlas_segmentation_image'],
+        name='consensus_mask'
+    )
 
     jointlabelfusion = pe.JoinNode(
         ants.AntsJointFusion(
@@ -140,22 +142,29 @@ def register(warped_dir, subject_Tws, atlas_images, atlas_segmentations, n_jobs)
         name='joint_label_fusion'
     )
 
+    fill = pe.Node(
+        FillConsensus(),
+        name='fill_consensus')
+
     wf = pe.Workflow(name='wf', base_dir=warped_dir)
 
     wf.connect(input_spec, 'subject_Txw', reg, 'fixed_image')
     wf.connect(input_spec, 'atlas_image', reg, 'moving_image')
 
-    wf.connect(reg, 'forward_transforms', applytransforms_atlas, 'transforms')
-    wf.connect(input_spec, 'atlas_image', applytransforms_atlas, 'input_image')
-    wf.connect(input_spec, 'subject_Txw', applytransforms_atlas, 'reference_image')
-
-    wf.connect(reg, 'forward_transforms', applytransforms_segs, 'transforms')
-    wf.connect(input_spec, 'atlas_segmentation', applytransforms_segs, 'input_image')
-    wf.connect(input_spec, 'subject_Txw', applytransforms_segs, 'reference_image')
+    wf.connect(reg, 'forward_transforms', applytransforms, 'transforms')
+    wf.connect(input_spec, 'atlas_image', applytransforms, 'atlas_image')
+    wf.connect(input_spec, 'atlas_segmentation', applytransforms, 'atlas_segmentation')
+    wf.connect(input_spec, 'subject_Txw', applytransforms, 'reference_image')
 
     wf.connect(input_spec, 'subject_dual_Tws', jointlabelfusion, 'target_image')
-    wf.connect(applytransforms_atlas, 'output_image', jointlabelfusion, 'atlas_image')
-    wf.connect(applytransforms_segs, 'output_image', jointlabelfusion, 'atlas_segmentation_image')
+    wf.connect(applytransforms, 'warped_atlas', jointlabelfusion, 'atlas_image')
+    wf.connect(applytransforms, 'warped_segmentation', jointlabelfusion, 'atlas_segmentation_image')
+
+    wf.connect(applytransforms, 'warped_segmentation', consensus, 'atlas_segmentation_image')
+    wf.connect(consensus, 'mask_image', jointlabelfusion, 'mask_image')
+    wf.connect(jointlabelfusion, 'out_label_fusion', fill, 'label_fusion')
+    wf.connect(consensus, 'consensus_image', fill, 'consensus_image')
+    wf.connect(consensus, 'mask_image', fill, 'mask_image')
 
     wf.config['execution']['parameterize_dirs'] = False
 
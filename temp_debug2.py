@@ -23,6 +23,10 @@ import random
 import nipype.pipeline.engine as pe
 from nipype.interfaces import ants, utility
 
+from costmodel import pipeline_model_file
+from resources import image_voxels, max_voxels, registration_resources, fusion_resources
+from slurm_batch import SLURMArrayPlugin
+
 
 def main():
     parser = generate_parser()
@@ -114,7 +118,8 @@ def register(warped_dir, subject_T1w, atlas_images, atlas_segmentations):
             verbose=True,
             use_histogram_matching=[True, True]
         ),
-        name='calc_registration')
+        name='calc_registration',
+        **registration_resources(image_voxels(subject_T1w), max_voxels(atlas_images), ['Affine', 'SyN'], 10))
 
     applytransforms_atlas = pe.Node(
         ants.ApplyTransforms(
@@ -141,7 +146,8 @@ def register(warped_dir, subject_T1w, atlas_images, atlas_segmentations):
         ),
         joinsource='input_spec',
         joinfield=['atlas_image', 'atlas_segmentation_image'],
-        name='joint_label_fusion'
+        name='joint_label_fusion',
+        **fusion_resources(image_voxels(subject_T1w), len(atlas_images), 10)
     )
 
 
@@ -166,7 +172,9 @@ def register(warped_dir, subject_T1w, atlas_images, atlas_segmentations):
     #wf.config['execution']['remove_unnecessary_outputs'] = False
 
     wf.write_graph()
-    output = wf.run(plugin='SLURM', plugin_args={'sbatch_args': '-A fnl_lab --mem-per-cpu 8G --time 36:00:00 --cpus-per-task 10 --output %j_debug_output.txt --error %j_debug_error.txt'})
+    # registrations as one job array, the warps packed into short jobs, identity nodes run here
+    output = wf.run(plugin=SLURMArrayPlugin(plugin_args={'sbatch_args': '-A fnl_lab', 'time': '36:00:00',
+                                                         'cost_model': pipeline_model_file('temp_debug')}))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# standard lib
+
+'''
+Node-local store of decoded atlases/templates.
+
+Every MultiProc worker that reads an atlas .nii.gz inflates it again, ANTs subprocesses and in-process
+stages (warp, joint_fusion, similarity) alike. uncompressed() decodes an atlas once per node into an
+uncompressed .nii under store_dir (/dev/shm by default, a tmpfs) and returns that path instead: ANTs
+reads it without gzip, and nibabel.load memory-maps it, so in-process readers share the same page-cache
+pages instead of each holding an inflated copy. Resident memory grows with the number of distinct atlases, not atlases x workers.
+
+Entries are named after the source's path, size and mtime, a changed source is decoded again. The gzip
+stream is inflated byte for byte, so the entry is the same image (data type, scaling) as its source.
+
+/dev/shm outlives the job, so every use of an entry touches a sidecar file next to it (.used_<entry>)
+and prune() removes the entries unused for max_age_hours and then the least recently used ones until
+the store fits in max_gb. The entries themselves keep the mtime of their source: nipype hashes File
+inputs by timestamp, and a changing mtime would rerun every node that reads an atlas.
+
+usage: template_store.py [--storedir DIR] [--max_gb 20] [--max_age_hours 168] [--clear]
+'''
+
+import argparse
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+DEFAULT_STORE_DIR = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+                                 'nlreg_templates_%d' % os.getuid())
+
+# entries no job has used for a week
+DEFAULT_MAX_AGE_HOURS = 24 * 7
+
+
+def main():
+    parser = generate_parser()
+    args = parser.parse_args()
+
+    freed = prune(args.storedir, 0 if args.clear else args.max_gb, args.max_age_hours)
+    print('freed %.2f GB in %s' % (freed / float(1 << 30), args.storedir))
+
+
+def generate_parser():
+    parser = argparse.ArgumentParser(description='evict decoded templates from the node-local store')
+    parser.add_argument('--storedir', default=DEFAULT_STORE_DIR, help='template store')
+    parser.add_argument('--max_gb', type=float, help='evict the least recently used entries down to this size')
+    parser.add_argument('--max_age_hours', default=DEFAULT_MAX_AGE_HOURS, type=float,
+                        help='evict entries unused for this long')
+    parser.add_argument('--clear', action='store_true', help='evict everything')
+    return parser
+
+
+def _entry_name(path):
+    stat = os.stat(path)
+    stamp = '%s:%d:%s' % (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    stem = os.path.basename(path)
+    for ext in ('.nii.gz', '.nii'):
+        if stem.endswith(ext):
+            stem = stem[:-len(ext)]
+    return '%s_%s.nii' % (stem, hashlib.sha1(stamp.encode()).hexdigest()[:12])
+
+
+def _touch(path):
+    with open(path, 'a'):
+        os.utime(path)
+
+
+def _used_name(entry):
+    return os.path.join(os.path.dirname(entry), '.used_' + os.path.basename(entry))
+
+
+def uncompressed(path, store_dir=DEFAULT_STORE_DIR):
+    '''path of an uncompressed copy of the NIfTI image at path, decoded on first use'''
+    if not path.endswith('.nii.gz'):
+        return path
+    entry = os.path.join(store_dir, _entry_name(path))
+    if os.path.exists(entry):
+        _touch(_used_name(entry))
+        return entry
+
+    os.makedirs(store_dir, exist_ok=True)
+    # write next to the entry and rename, concurrent workers decoding the same atlas are harmless
+    fd, tmp = tempfile.mkstemp(prefix='.tmp_', suffix='.nii', dir=store_dir)
+    with os.fdopen(fd, 'wb') as out, gzip.open(path, 'rb') as source:
+        shutil.copyfileobj(source, out, 1 << 22)
+    # an entry decoded again after a prune looks the same to nipype's timestamp hashes
+    stat = os.stat(path)
+    os.utime(tmp, (stat.st_atime, stat.st_mtime))
+    os.rename(tmp, entry)
+    _touch(_used_name(entry))
+    return entry
+
+
+def uncompressed_all(paths, store_dir=DEFAULT_STORE_DIR):
+    return [uncompressed(p, store_dir) for p in paths]
+
+
+def _last_use(path, stat):
+    # leftovers of killed decodes have no sidecar, their own mtime is when they were last written
+    try:
+        return os.stat(_used_name(path)).st_mtime
+    except OSError:
+        return stat.st_mtime
+
+
+def prune(store_dir=DEFAULT_STORE_DIR, max_gb=None, max_age_hours=DEFAULT_MAX_AGE_HOURS):
+    '''
+    remove the entries unused for max_age_hours, then the least recently used until the store holds at
+    most max_gb; returns the bytes freed. Leftovers of killed decodes go with the old entries.
+    '''
+    if not os.path.isdir(store_dir):
+        return 0
+    entries = []
+    for entry in os.scandir(store_dir):
+        if entry.name.startswith('.used_'):
+            continue
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        entries.append((_last_use(entry.path, stat), stat.st_size, entry.path))
+    entries.sort()
+
+    now, freed = time.time(), 0
+    size = sum(s for _, s, _ in entries)
+    for used, entry_size, path in entries:
+        too_old = max_age_hours is not None and now - used > max_age_hours * 3600
+        too_big = max_gb is not None and size > max_gb * (1 << 30)
+        if not too_old and not too_big:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        if os.path.exists(_used_name(path)):
+            os.remove(_used_name(path))
+        size -= entry_size
+        freed += entry_size
+    return freed
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# standard lib
+
+'''
+Content-addressed store for ants.Registration transforms.
+
+Entries are keyed on a hash of the fixed/moving image contents plus every registration
+parameter, so an atlas/subject pair is only registered once no matter which pipeline
+(nonlinear_reg, Brown_nl_masking, joint_label_fusion_1ch, jlf_2chreg) asks for it or
+which base_dir that pipeline writes into.
+
+layout: <cache_dir>/<key[:2]>/<key>/{output_0GenericAffine.mat, output_1Warp.nii.gz, ..., manifest.json}
+'''
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+# external libs
+from nipype.interfaces import ants
+from nipype.interfaces.ants.registration import RegistrationInputSpec
+from nipype.interfaces.base import Directory, isdefined
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.nlreg_cache', 'transforms')
+
+# inputs that change how ANTs runs but not what it computes
+IGNORED_INPUTS = ('cache_dir', 'num_threads', 'environ', 'terminal_output', 'verbose')
+
+_digests = {}
+
+
+def file_digest(path, blocksize=1 << 20):
+    '''sha1 of a file's contents, memoised on (path, size, mtime)'''
+    stat = os.stat(path)
+    stamp = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if stamp not in _digests:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(blocksize), b''):
+                sha.update(block)
+        _digests[stamp] = sha.hexdigest()
+    return _digests[stamp]
+
+
+def _content_values(value):
+    # replace file paths (also inside lists, e.g. multi-channel fixed images) by their digests
+    if isinstance(value, (list, tuple)):
+        return [_content_values(v) for v in value]
+    if isinstance(value, str) and os.path.isfile(value):
+        return file_digest(value)
+    return value
+
+
+def registration_key(inputs):
+    '''hash of a dict of registration inputs with file paths replaced by content digests'''
+    params = {name: _content_values(value) for name, value in inputs.items()
+              if name not in IGNORED_INPUTS}
+    blob = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(blob.encode()).hexdigest()
+
+
+def _entry_dir(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], key)
+
+
+def _link_or_copy(src, dst):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        # cache on another filesystem
+        shutil.copy2(src, dst)
+
+
+def lookup(cache_dir, key, out_dir):
+    '''link a stored entry into out_dir; returns False if the key has not been registered yet'''
+    manifest = os.path.join(_entry_dir(cache_dir, key), 'manifest.json')
+    if not os.path.exists(manifest):
+        return False
+    with open(manifest) as f:
+        files = json.load(f)['files']
+    for name in files:
+        _link_or_copy(os.path.join(_entry_dir(cache_dir, key), name), os.path.join(out_dir, name))
+    return True
+
+
+def store(cache_dir, key, files):
+    '''copy files into the store under key; concurrent writers of the same key are harmless'''
+    entry = _entry_dir(cache_dir, key)
+    if os.path.exists(entry):
+        return entry
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+
+    # stage next to the entry and rename, so readers never see a half-written entry
+    tmp = tempfile.mkdtemp(prefix='.tmp_', dir=os.path.dirname(entry))
+    for f in files:
+        shutil.copy2(f, tmp)
+    with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+        json.dump({'files': [os.path.basename(i) for i in files]}, f)
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        # another pipeline stored the same registration first
+        shutil.rmtree(tmp, ignore_errors=True)
+    return entry
+
+
+class CachedRegistrationInputSpec(RegistrationInputSpec):
+    cache_dir = Directory(desc='shared transform store, registration runs uncached if undefined')
+
+
+class CachedRegistration(ants.Registration):
+    '''
+    ants.Registration that looks up forward_transforms/reverse_transforms in the shared
+    transform store before launching antsRegistration, and adds its results afterwards
+    '''
+
+    input_spec = CachedRegistrationInputSpec
+
+    def _run_interface(self, runtime, correct_return_codes=(0,)):
+        if not isdefined(self.inputs.cache_dir):
+            return super(CachedRegistration, self)._run_interface(runtime, correct_return_codes)
+
+        key = registration_key(self.inputs.get_traitsfree())
+        if lookup(self.inputs.cache_dir, key, runtime.cwd):
+            runtime.returncode = 0
+            return runtime
+
+        runtime = super(CachedRegistration, self)._run_interface(runtime, correct_return_codes)
+        store(self.inputs.cache_dir, key, self._produced_files(runtime.cwd))
+        return runtime
+
+    def _produced_files(self, cwd):
+        # every output file written by this run (initial_moving_transform inputs live elsewhere)
+        produced = []
+        for value in self._list_outputs().values():
+            for f in value if isinstance(value, list) else [value]:
+                if (isinstance(f, str) and os.path.dirname(f) == cwd and os.path.isfile(f)
+                        and f not in produced):
+                    produced.append(f)
+        return produced
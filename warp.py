@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# standard lib
+
+'''
+In-process replacement for antsApplyTransforms.
+
+Transform lists are given exactly as to ants.ApplyTransforms: ANTs affines (.mat) and displacement
+fields (.nii/.nii.gz), the first listed transform is applied first to the reference point. The output
+volume is processed in z-slabs spread over a thread pool. For each slab only the reference points of
+that slab and the z-range of every displacement field they fall into are read, so the deformation
+costs memory in proportion to slab_size rather than to the size of the warp. Fields are memory-mapped:
+antsRegistration can only write .nii.gz fields, so those are inflated once, into a temporary .nii
+under scratch_dir (TMPDIR by default) that is removed when the call returns, instead of slicing the
+gzip stream, which would inflate everything in front of every slab again.
+
+The images being resampled are not chunked: each input volume is read whole, as float32, plus its
+B-spline coefficients for BSpline (another float32 copy), and every output volume is held until it
+is written. Per input that is about 4-8 bytes per input voxel and one output volume, on top of the
+slabs.
+
+WarpAtlas resamples an atlas image (cubic B-spline, as ApplyTransforms BSpline) and its segmentation
+(nearest neighbour) in the same pass over the deformation. apply_warpfield_atlas and apply_warpfield_segs
+used to be two ApplyTransforms processes, each re-reading and re-composing the same affine + SyN chain.
+
+ITK physical space is LPS and so are the vectors of ANTs displacement fields, NIfTI affines are RAS.
+Image grids are taken from nibabel's affine (sform, or qform if there is no sform).
+'''
+
+import gzip
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# external libs
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+from scipy.io import loadmat
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec, TraitedSpec, File, InputMultiPath,
+                                    traits, isdefined)
+from nipype.utils.filemanip import split_filename
+
+from compress import OUTPUT_TYPES, with_output_type
+
+# RAS <-> LPS, its own inverse
+LPS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+INTERPOLATION_ORDER = {'NearestNeighbor': 0, 'Linear': 1, 'BSpline': 3}
+
+
+def _inside(coords, shape):
+    # ITK treats a continuous index as inside the buffer up to half a voxel beyond the edge voxels
+    inside = np.ones(coords.shape[1], dtype=bool)
+    for axis, size in enumerate(shape[:3]):
+        inside &= (coords[axis] >= -0.5) & (coords[axis] <= size - 0.5)
+    return inside
+
+
+class AffineTransform(object):
+    '''ANTs/ITK MatrixOffsetTransform .mat, maps LPS points'''
+
+    def __init__(self, path, invert=False):
+        params = loadmat(path)
+        key = [k for k in params if k.startswith(('AffineTransform', 'MatrixOffsetTransformBase'))][0]
+        values = params[key].ravel()
+        center = params['fixed'].ravel()
+
+        matrix = values[:9].reshape(3, 3)
+        self.matrix = np.eye(4)
+        self.matrix[:3, :3] = matrix
+        self.matrix[:3, 3] = values[9:12] + center - matrix.dot(center)
+        if invert:
+            self.matrix = np.linalg.inv(self.matrix)
+
+    def __call__(self, points):
+        return self.matrix[:3, :3].dot(points) + self.matrix[:3, 3:]
+
+
+class DisplacementField(object):
+    '''ANTs displacement field, maps LPS points; only the z-range the points fall into is sampled'''
+
+    def __init__(self, path, scratch_dir=None):
+        self._inflated = None
+        if path.endswith('.gz'):
+            fd, self._inflated = tempfile.mkstemp(prefix='field_', suffix='.nii', dir=scratch_dir)
+            with os.fdopen(fd, 'wb') as out, gzip.open(path, 'rb') as source:
+                shutil.copyfileobj(source, out, 1 << 22)
+            path = self._inflated
+        image = nib.load(path, mmap=True)
+        self.shape = image.shape[:3]
+        self.to_voxel = np.linalg.inv(LPS.dot(image.affine))
+        self.field = image.dataobj
+
+    def close(self):
+        '''remove the inflated copy of a .nii.gz field'''
+        if self._inflated and os.path.exists(self._inflated):
+            os.remove(self._inflated)
+        self._inflated = None
+
+    def __call__(self, points):
+        coords = self.to_voxel[:3, :3].dot(points) + self.to_voxel[:3, 3:]
+        inside = _inside(coords, self.shape)
+        if not inside.any():
+            return points
+
+        z_low = int(max(0, np.floor(coords[2, inside].min())))
+        z_high = int(min(self.shape[2], np.ceil(coords[2, inside].max()) + 1))
+        field = np.asarray(self.field[:, :, z_low:z_high], dtype=np.float32)
+        field = field.reshape(field.shape[:3] + (3,))
+
+        coords = coords[:, inside]
+        coords[2] -= z_low
+        displacement = np.zeros_like(points)
+        for component in range(3):
+            displacement[component, inside] = ndimage.map_coordinates(field[..., component], coords, order=1,
+                                                                      mode='nearest')
+        # outside the field ITK leaves the point where it is
+        return points + displacement
+
+
+def load_transform(path, invert=False, scratch_dir=None):
+    if path.endswith('.mat'):
+        return AffineTransform(path, invert)
+    if invert:
+        raise ValueError('displacement fields can not be inverted, use the InverseWarp instead: %s' % path)
+    return DisplacementField(path, scratch_dir)
+
+
+def apply_transforms(inputs, reference_image, transforms, invert_flags=None, slab_size=8, n_threads=1,
+                     scratch_dir=None):
+    '''
+    inputs: list of (in_file, interpolation, out_file), all resampled onto reference_image in one pass
+    returns the absolute paths of the out_files
+    '''
+    if invert_flags is None:
+        invert_flags = [False] * len(transforms)
+    chain = []
+    try:
+        for transform, invert in zip(transforms, invert_flags):
+            chain.append(load_transform(transform, invert, scratch_dir))
+        return _apply_chain(inputs, reference_image, chain, slab_size, n_threads)
+    finally:
+        for transform in chain:
+            if isinstance(transform, DisplacementField):
+                transform.close()
+
+
+def _apply_chain(inputs, reference_image, chain, slab_size, n_threads):
+    reference = nib.load(reference_image)
+    shape = reference.shape[:3]
+    to_physical = LPS.dot(reference.affine)
+
+    volumes = []
+    for in_file, interpolation, out_file in inputs:
+        image = nib.load(in_file)
+        order = INTERPOLATION_ORDER[interpolation]
+        data = np.asarray(image.dataobj)
+        if order:
+            data = data.astype(np.float32)
+        if order > 1:
+            # B-spline coefficients of the whole input, so slabs can be sampled independently
+            data = ndimage.spline_filter(data, order, output=np.float32, mode='mirror')
+        volumes.append((data, order, np.linalg.inv(LPS.dot(image.affine)), np.zeros(shape, dtype=data.dtype)))
+
+    def warp_slab(z_low):
+        z_high = min(z_low + slab_size, shape[2])
+        ijk = np.mgrid[0:shape[0], 0:shape[1], z_low:z_high].reshape(3, -1).astype(np.float64)
+        points = to_physical[:3, :3].dot(ijk) + to_physical[:3, 3:]
+        for transform in chain:
+            points = transform(points)
+
+        for data, order, to_voxel, out in volumes:
+            coords = to_voxel[:3, :3].dot(points) + to_voxel[:3, 3:]
+            values = ndimage.map_coordinates(data, coords, order=order, mode='mirror', prefilter=False)
+            values[~_inside(coords, data.shape)] = 0
+            out[:, :, z_low:z_high] = values.reshape(shape[0], shape[1], z_high - z_low)
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(warp_slab, range(0, shape[2], slab_size)))
+
+    return [save_like(out, reference_image, out_file)
+            for (in_file, interpolation, out_file), (data, order, to_voxel, out) in zip(inputs, volumes)]
+
+
+def save_like(data, reference_image, out_file):
+    reference = nib.load(reference_image)
+    out = nib.Nifti1Image(data, reference.affine, reference.header)
+    out.set_data_dtype(data.dtype)
+    nib.save(out, out_file)
+    return os.path.abspath(out_file)
+
+
+class ApplyTransformsNativeInputSpec(BaseInterfaceInputSpec):
+    input_image = File(exists=True, mandatory=True, desc='image to apply transformation to')
+    reference_image = File(exists=True, mandatory=True, desc='grid of the output image')
+    transforms = InputMultiPath(File(exists=True), mandatory=True, desc='transform list as given to ApplyTransforms')
+    invert_transform_flags = traits.List(traits.Bool(), desc='invert the corresponding (affine) transform')
+    interpolation = traits.Enum('Linear', 'NearestNeighbor', 'BSpline', usedefault=True)
+    output_image = traits.Str(desc='output file name, default <input>_trans.nii(.gz) as set by output_type')
+    output_type = traits.Enum('NIFTI_GZ', 'NIFTI', usedefault=True, desc='format of the default output_image')
+    slab_size = traits.Int(8, usedefault=True, desc='number of output z-slices warped at a time')
+    num_threads = traits.Int(1, usedefault=True, desc='number of slabs warped concurrently')
+
+
+class ApplyTransformsNativeOutputSpec(TraitedSpec):
+    output_image = File(exists=True)
+
+
+class ApplyTransformsNative(BaseInterface):
+    '''drop-in for ants.ApplyTransforms (3D, NearestNeighbor/Linear/BSpline) that runs in process'''
+
+    input_spec = ApplyTransformsNativeInputSpec
+    output_spec = ApplyTransformsNativeOutputSpec
+
+    def _output_filename(self):
+        if isdefined(self.inputs.output_image):
+            return os.path.abspath(self.inputs.output_image)
+        _, base, _ = split_filename(self.inputs.input_image)
+        return os.path.abspath(base + '_trans' + OUTPUT_TYPES[self.inputs.output_type])
+
+    def _run_interface(self, runtime):
+        invert_flags = self.inputs.invert_transform_flags if isdefined(self.inputs.invert_transform_flags) else None
+        apply_transforms([(self.inputs.input_image, self.inputs.interpolation, self._output_filename())],
+                         self.inputs.reference_image, self.inputs.transforms, invert_flags,
+                         self.inputs.slab_size, self.inputs.num_threads)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['output_image'] = self._output_filename()
+        return outputs
+
+
+class WarpAtlasInputSpec(BaseInterfaceInputSpec):
+    atlas_image = File(exists=True, mandatory=True, desc='atlas intensity image, resampled with BSpline')
+    atlas_segmentation = File(exists=True, mandatory=True, desc='atlas label map, resampled with NearestNeighbor')
+    reference_image = File(exists=True, mandatory=True, desc='grid of the warped outputs')
+    transforms = InputMultiPath(File(exists=True), mandatory=True, desc='transform list as given to ApplyTransforms')
+    slab_size = traits.Int(8, usedefault=True, desc='number of output z-slices warped at a time')
+    num_threads = traits.Int(1, usedefault=True, desc='number of slabs warped concurrently')
+    output_type = traits.Enum('NIFTI_GZ', 'NIFTI', usedefault=True, desc='format of the warped images')
+
+
+class WarpAtlasOutputSpec(TraitedSpec):
+    warped_atlas = File(exists=True)
+    warped_segmentation = File(exists=True)
+
+
+class WarpAtlas(BaseInterface):
+    '''ApplyTransforms for an atlas image and its segmentation in one pass over the deformation'''
+
+    input_spec = WarpAtlasInputSpec
+    output_spec = WarpAtlasOutputSpec
+
+    def _run_interface(self, runtime):
+        outputs = self._list_outputs()
+        apply_transforms([(self.inputs.atlas_image, 'BSpline', outputs['warped_atlas']),
+                          (self.inputs.atlas_segmentation, 'NearestNeighbor', outputs['warped_segmentation'])],
+                         self.inputs.reference_image, self.inputs.transforms,
+                         slab_size=self.inputs.slab_size, n_threads=self.inputs.num_threads)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['warped_atlas'] = os.path.abspath(with_output_type('warped_atlas', self.inputs.output_type))
+        outputs['warped_segmentation'] = os.path.abspath(with_output_type('warped_segmentation',
+                                                                          self.inputs.output_type))
+        return outputs